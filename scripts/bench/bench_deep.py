@@ -0,0 +1,52 @@
+import tega.tree
+import tega.util
+
+import sys
+import time
+
+DEPTH = 2000
+WIDTH = 500  # leaves per level
+
+def build(depth, width):
+    r = tega.tree.Cont('r')
+    c = r
+    for i in range(0, depth):
+        c = c._extend('n')
+        for j in range(0, width):
+            c[str(j)] = j
+    return r
+
+def bench(title, func, *args):
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+        print('{:<16} {:8.3f} sec'.format(title, time.perf_counter() - start))
+    except RecursionError:
+        result = None
+        print('{:<16} RecursionError'.format(title))
+    return result
+
+def consume(iterator):
+    for _ in iterator:
+        pass
+
+if __name__ == '__main__':
+
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else DEPTH
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else WIDTH
+
+    print('### Deep tree performance ###')
+    print('depth: {}, nodes: {}'.format(depth, depth * (width + 1) + 1))
+
+    r = bench('build', build, depth, width)
+    bench('serialize_', r.serialize_)
+    bench('dumps_', r.dumps_)
+    bench('deepcopy_', r.deepcopy_)
+    bench('align_vector', tega.util.align_vector, r)
+    bench('pack_trees', tega.util.pack_trees, [r])
+    bench('freeze_', r.freeze_)
+    bench('dumps_(frozen)', r.dumps_)
+
+    # A chain (no leaves), since edges are O(depth) long each
+    chain = build(depth, 0)
+    bench('edges(chain)', consume, tega.util.edges(chain))
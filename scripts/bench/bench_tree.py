@@ -0,0 +1,77 @@
+import tega.idb
+import tega.tree
+import tega.util
+
+import json
+import math
+import tempfile
+import time
+import tracemalloc
+
+MAXI = 100
+MAXJ = 100
+MAXK = 10
+
+def build():
+    r = tega.tree.Cont('r')
+    for i in range(0, MAXI):
+        for j in range(0, MAXJ):
+            c = r[str(i)][str(j)]
+            c.name = 'ne{}-{}'.format(i, j)
+            c.port = j
+            c.load = 0.5
+            c.up = True
+            for k in range(0, MAXK):
+                c.counters[str(k)] = k
+    return r
+
+def walk(cont):
+    n = 0
+    for k, v in cont.items():
+        n += 1
+        if isinstance(v, tega.tree.Cont):
+            n += walk(v)
+    return n
+
+def commit(cont):
+    with tega.idb.tx(durability=tega.idb.DURABILITY.MEMORY) as t:
+        t.put(cont, deepcopy=False)
+
+def get():
+    for i in range(0, MAXI):
+        for j in range(0, MAXJ):
+            tega.idb.get('r.{}.{}.counters.{}'.format(i, j, j % MAXK))
+
+def bench(title, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    delta = time.perf_counter() - start
+    print('{:<16} {:8.3f} sec'.format(title, delta))
+    return result
+
+if __name__ == '__main__':
+
+    print('### Tree node performance ###')
+
+    tracemalloc.start()
+    r = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    nodes = walk(r) + 1
+    print('nodes: {}, memory: {} bytes/node'.format(nodes,
+        math.floor(size/nodes)))
+
+    bench('build', build)
+    bench('walk', walk, r)
+    bench('serialize_', r.serialize_)
+    bench('serialize_(i)', r.serialize_, True)
+    bench('deepcopy_', r.deepcopy_)
+    body = json.loads(r.dumps_())  # e.g., a REST PUT body
+    bench('subtree', tega.util.subtree, 'r', body)
+    bench('freeze_', r.freeze_)
+
+    tega.idb.start(tempfile.mkdtemp(), 'bench')
+    bench('commit', commit, build())
+    bench('get(first)', get)  # builds the path index
+    bench('get', get)
+    tega.idb.stop()
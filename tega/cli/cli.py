@@ -41,7 +41,8 @@ roots                   list root object IDs
 old                     list old root object IDs
 sync                    synchronize with global idb 
 rollback    M     M     rollback a specific root to a previous version
-ss                      take a snapshot
+ss                      take a snapshot (in background)
+ss_progress             show the progress of the snapshot
 plugins                 show plugins attached to the tega db
 reload                  reload plugins
 
@@ -129,9 +130,12 @@ def process_cmd(tornado_loop=False):
         else:
             print('{} {}'.format(status, reason))
 
-    elif cmd == 'ss':
+    elif cmd in ('ss', 'ss_progress'):
         status, reason, data = getattr(driver, cmd)()
-        print('{} {}'.format(status, reason))
+        if data:
+            print(yaml.dump(data))
+        else:
+            print('{} {}'.format(status, reason))
 
     elif cmd == 'begin':
         try:
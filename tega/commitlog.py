@@ -0,0 +1,727 @@
+'''
+tega db commit-log format (version 1)
+
+Segment file
+------------
++----------+--------+--------+-----+--------+
+| MAGIC(8) | record | record | ... | record |
++----------+--------+--------+-----+--------+
+
+Record
+------
++---------+-----------+----------+----------------+-----------+
+| type(1) | length(4) | crc32(4) | payload(length)| length(4) |
++---------+-----------+----------+----------------+-----------+
+
+- type: RECORD_TX or RECORD_ROLLBACK, ORed with COMPRESSED if the payload
+  is compressed
+- crc32: CRC-32 of type and payload (as stored)
+- payload: UTF-8 JSON, or UTF-8 JSON compressed by zlib with the preset
+  dictionary ZDICT
+- the trailing length makes it possible to scan a segment backwards.
+
+A record is either completely valid or it is treated as the end of the
+segment: a torn record at the tail (e.g., after a crash) is ignored by the
+readers and cut off by truncate_tail() before new records are appended.
+
+Version index (sidecar of a segment)
+------------------------------------
++-------------+------------+-----------+-----------------------+
+| length(2)   | version(8) | offset(8) | root_oid(length)      |
++-------------+------------+-----------+-----------------------+
+
+An entry per root changed by a record: the record at the offset in the
+segment creates the version of the root. The index of the current segment
+is rebuilt from the segment by build_index() on start, since it is not
+fsynced at every commit.
+'''
+
+import ast
+from concurrent.futures import Future
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+FORMAT_VERSION = 1
+MAGIC = b'TEGALOG' + bytes([FORMAT_VERSION])
+
+RECORD_TX = b'T'  # a committed transaction
+RECORD_ROLLBACK = b'R'  # a rollback
+
+_HEADER = struct.Struct('>cII')  # type, length, crc32
+_TRAILER = struct.Struct('>I')  # length
+_OVERHEAD = _HEADER.size + _TRAILER.size
+_INDEX_ENTRY = struct.Struct('>HqQ')  # length of root_oid, version, offset
+
+COMPRESSED = 0x80  # flag on the type of a compressed record
+COMPRESSION_LEVEL = 6
+
+# Preset dictionary for compression: short records (e.g., a PUT of a leaf)
+# are mostly made of these keys.
+ZDICT = (b'"_ephemeral":false,"_frozen":"_oid":"_parent":"_value":'
+         b'"_version":{"ope":"SS","path":"{"ope":"DELETE","path":"'
+         b'"backto":"root_oid":"version":"versions":{"'
+         b'"tega_id":"","instance":{"ts":"20","logs":[{"ope":"PUT","path":"')
+
+_compression_stats = {'records': 0, 'bytes_in': 0, 'bytes_out': 0,
+                      'compress_cpu': 0.0, 'decompress_cpu': 0.0}
+_compression_stats_lock = threading.Lock()
+
+try:
+    _cpu_time = time.thread_time
+except AttributeError:  # Python < 3.7
+    _cpu_time = time.process_time
+
+# Legacy (text) commit-log markers
+LEGACY_COMMIT_START_MARKER = '?'
+LEGACY_COMMIT_FINISH_MARKER = '@'
+LEGACY_ROLLBACK_MARKER = '-'
+LEGACY_SYNC_CONFIRMED_MARKER = '*'
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+_decode = json.JSONDecoder().decode
+
+def _crc(type_, payload):
+    return zlib.crc32(payload, zlib.crc32(type_))
+
+def _compress(type_, payload):
+    '''
+    Compresses a payload. Returns the type with COMPRESSED and
+    the compressed payload, or them as they are if not compressible.
+    '''
+    started = _cpu_time()
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=ZDICT)
+    data = compressor.compress(payload) + compressor.flush()
+    with _compression_stats_lock:
+        _compression_stats['records'] += 1
+        _compression_stats['bytes_in'] += len(payload)
+        _compression_stats['bytes_out'] += min(len(data), len(payload))
+        _compression_stats['compress_cpu'] += _cpu_time() - started
+    if len(data) < len(payload):
+        return bytes([type_[0] | COMPRESSED]), data
+    else:
+        return type_, payload
+
+def _decompress(type_, payload):
+    '''
+    Returns the type and the payload of a record, decompressed if needed.
+    '''
+    if not type_[0] & COMPRESSED:
+        return type_, payload
+    started = _cpu_time()
+    decompressor = zlib.decompressobj(zdict=ZDICT)
+    data = decompressor.decompress(payload) + decompressor.flush()
+    with _compression_stats_lock:
+        _compression_stats['decompress_cpu'] += _cpu_time() - started
+    return bytes([type_[0] & ~COMPRESSED]), data
+
+def compression_stats():
+    '''
+    Returns the compression ratio (compressed/original) and the CPU time
+    (sec) spent in compression and decompression.
+    '''
+    with _compression_stats_lock:
+        stats = dict(_compression_stats)
+    stats['ratio'] = None
+    if stats['bytes_in'] > 0:
+        stats['ratio'] = stats['bytes_out'] / stats['bytes_in']
+    return stats
+
+def _frame(type_, payload):
+    length = len(payload)
+    return b''.join((_HEADER.pack(type_, length, _crc(type_, payload)),
+                     payload,
+                     _TRAILER.pack(length)))
+
+def encode_record(type_, obj, compress=False):
+    '''
+    Encodes an object into a framed record, compressed if compress is True.
+    '''
+    payload = _encoder.encode(obj).encode('utf-8')
+    if compress:
+        type_, payload = _compress(type_, payload)
+    return _frame(type_, payload)
+
+def decode_payload(payload):
+    '''
+    Decodes the payload of a record.
+    '''
+    return _decode(str(payload, 'utf-8'))
+
+def tx_record(logs, timestamp, versions=None, compress=False):
+    '''
+    Returns a framed record of a committed transaction.
+
+    versions is {root_oid: new version} of the roots changed by
+    the transaction.
+    '''
+    obj = {'ts': timestamp, 'logs': logs}
+    if versions is not None:
+        obj['versions'] = versions
+    return encode_record(RECORD_TX, obj, compress)
+
+def rollback_record(backto, tega_id, root_oid, version=None):
+    '''
+    Returns a framed record of a rollback.
+
+    version is the new version of the root.
+    '''
+    obj = {'backto': backto, 'tega_id': tega_id, 'root_oid': root_oid}
+    if version is not None:
+        obj['version'] = version
+    return encode_record(RECORD_ROLLBACK, obj)
+
+def record_versions(type_, obj):
+    '''
+    Returns {root_oid: new version} of a record ({} if not recorded).
+    '''
+    if type_ == RECORD_TX:
+        return obj.get('versions', {})
+    elif type_ == RECORD_ROLLBACK and 'version' in obj:
+        return {obj['root_oid']: obj['version']}
+    return {}
+
+def write_magic(fd):
+    '''
+    Writes the magic number if the segment is empty.
+    '''
+    fd.seek(0, os.SEEK_END)
+    if fd.tell() == 0:
+        fd.write(MAGIC)
+
+def is_legacy(path):
+    '''
+    True if the file is a non-empty text commit log (before version 1).
+    '''
+    with open(path, 'rb') as fd:
+        head = fd.read(len(MAGIC))
+    return len(head) > 0 and head != MAGIC
+
+class SegmentReader(object):
+    '''
+    Memory-mapped reader of a commit log segment.
+
+    Records are iterated forward or backward as zero-copy slices
+    (memoryview) of the segment, or as decompressed bytes if the records are
+    compressed. A torn or corrupted record is treated as the end of
+    the segment.
+
+    Usage example:
+
+    with open('log.global.0', 'rb') as fd, SegmentReader(fd) as reader:
+        for offset, type_, payload in reader.records_reverse():
+            print(decode_payload(payload))
+    '''
+
+    def __init__(self, fd):
+        self.name = getattr(fd, 'name', fd)
+        self._mmap = None
+        self.size = os.fstat(fd.fileno()).st_size
+        if self.size > 0:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self._mmap)
+        else:
+            self.view = memoryview(b'')
+        head = bytes(self.view[:len(MAGIC)])
+        if head and head != MAGIC:
+            self.close()
+            raise ValueError('not a tega commit log (format version {})'.
+                    format(FORMAT_VERSION))
+        self._end = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+    def close(self):
+        self.view.release()
+        if self._mmap:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # slices still referenced: closed when collected
+
+    def _record(self, offset):
+        '''
+        Returns (type, payload, offset of the next record) of the record at
+        the offset, or None if the record is torn or corrupted.
+        '''
+        view = self.view
+        if offset + _OVERHEAD > len(view):
+            return None
+        type_, length, crc = _HEADER.unpack_from(view, offset)
+        start = offset + _HEADER.size
+        end = start + length + _TRAILER.size
+        if end > len(view) or \
+                _TRAILER.unpack_from(view, start + length)[0] != length:
+            return None
+        payload = view[start:start+length]
+        if _crc(type_, payload) != crc:
+            return None
+        return type_, payload, end
+
+    def records(self, offset=None):
+        '''
+        Generates (offset, type, payload) of every valid record from the
+        beginning of the segment, or from the offset of a record.
+        '''
+        if self.size == 0:
+            return
+        offset = offset or len(MAGIC)
+        while True:
+            record = self._record(offset)
+            if record is None:
+                break
+            type_, payload, next_offset = record
+            yield (offset,) + _decompress(type_, payload)
+            offset = next_offset
+        self._end = offset
+        if offset < self.size:
+            logging.warning('torn record at the tail of {}, offset {}'.
+                    format(self.name, offset))
+
+    def end(self):
+        '''
+        Returns the end offset of the last valid record.
+        '''
+        if self._end is None:
+            if self.size == 0:
+                self._end = 0
+            elif self._scan_reverse() is None:
+                for record in self.records():
+                    pass
+        return self._end
+
+    def _scan_reverse(self):
+        '''
+        Returns [(offset, type, payload), ...] of the records from the end of
+        the segment following the trailers, or None if the tail is torn or
+        corrupted.
+        '''
+        records = []
+        end = self.size
+        view = self.view
+        while end > len(MAGIC):
+            if end - len(MAGIC) < _OVERHEAD:
+                return None
+            length = _TRAILER.unpack_from(view, end - _TRAILER.size)[0]
+            start = end - _OVERHEAD - length
+            if start < len(MAGIC):
+                return None
+            record = self._record(start)
+            if record is None or record[2] != end:
+                return None
+            records.append((start, record[0], record[1]))
+            end = start
+        self._end = self.size
+        return records
+
+    def records_reverse(self):
+        '''
+        Generates (offset, type, payload) of every valid record from the end
+        of the segment.
+        '''
+        if self.size == 0:
+            return
+        records = self._scan_reverse()
+        if records is None:  # torn or corrupted somewhere: forward scan
+            yield from list(self.records())[::-1]
+        else:
+            for offset, type_, payload in records:
+                yield (offset,) + _decompress(type_, payload)
+
+def read_raw_records(fd, offset=None):
+    '''
+    Generates (offset, type, payload) of every valid record from the
+    beginning of a segment, or from the offset of a record.
+    '''
+    with SegmentReader(fd) as reader:
+        yield from reader.records(offset)
+
+def read_records(fd, offset=None):
+    '''
+    Generates (type, object) of every valid record from the beginning of
+    a segment, or from the offset of a record.
+    '''
+    with SegmentReader(fd) as reader:
+        for offset, type_, payload in reader.records(offset):
+            yield type_, decode_payload(payload)
+
+def read_records_reverse(fd):
+    '''
+    Generates (type, object) of every valid record from the end of
+    a segment.
+    '''
+    with SegmentReader(fd) as reader:
+        for offset, type_, payload in reader.records_reverse():
+            yield type_, decode_payload(payload)
+
+def truncate_tail(path):
+    '''
+    Cuts off a torn record at the tail of a segment, so that new records
+    can be appended to it safely.
+    '''
+    with open(path, 'rb+') as fd:
+        with SegmentReader(fd) as reader:
+            end = max(reader.end(), len(MAGIC))
+            size = reader.size
+        if size > end:
+            fd.truncate(end)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+def compress_segment(path, index_path=None):
+    '''
+    Rewrites a sealed segment (or a snapshot) with compressed records, and
+    rebuilds its version index if index_path is given.
+
+    Returns the sizes of the segment before and after.
+    '''
+    tmp = path + '.tmp'
+    with open(path, 'rb') as fd, open(tmp, 'wb') as out:
+        out.write(MAGIC)
+        with SegmentReader(fd) as reader:
+            size = reader.size
+            for offset, type_, payload in reader.records():
+                out.write(_frame(*_compress(type_, bytes(payload))))
+        out.flush()
+        os.fsync(out.fileno())
+        compressed_size = out.tell()
+    os.rename(tmp, path)
+    if index_path:
+        build_index(path, index_path)
+    return size, compressed_size
+
+def index_entries(versions, offset):
+    '''
+    Returns version index entries of a record at the offset.
+    '''
+    entries = []
+    for root_oid, version in versions.items():
+        oid = root_oid.encode('utf-8')
+        entries.append(_INDEX_ENTRY.pack(len(oid), version, offset))
+        entries.append(oid)
+    return b''.join(entries)
+
+def read_index(fd):
+    '''
+    Generates (root_oid, version, offset) of the entries in a version index.
+    A torn entry at the tail is ignored.
+    '''
+    fd.seek(0)
+    data = fd.read()
+    pos = 0
+    while pos + _INDEX_ENTRY.size <= len(data):
+        length, version, offset = _INDEX_ENTRY.unpack_from(data, pos)
+        pos += _INDEX_ENTRY.size
+        if pos + length > len(data):
+            break
+        yield data[pos:pos+length].decode('utf-8'), version, offset
+        pos += length
+
+def build_index(log_path, index_path):
+    '''
+    Builds the version index of a segment from its records.
+    '''
+    tmp = index_path + '.tmp'
+    with open(log_path, 'rb') as fd, open(tmp, 'wb') as index_fd:
+        for offset, type_, payload in read_raw_records(fd):
+            versions = record_versions(type_, decode_payload(payload))
+            if versions:
+                index_fd.write(index_entries(versions, offset))
+        index_fd.flush()
+        os.fsync(index_fd.fileno())
+    os.rename(tmp, index_path)
+
+def _done_future(result=None):
+    future = Future()
+    future.set_result(result)
+    return future
+
+class LogWriter(object):
+    '''
+    Commit-log writer.
+
+    In background mode, a dedicated thread collects the records appended by
+    concurrent commits and makes every batch durable with one fsync (group
+    commit). Otherwise, records are written and fsynced in the caller's
+    thread. The thread is started by the first record, so that the process
+    can still be forked safely before (e.g., the replay on startup).
+
+    append() and rotate() return a concurrent.futures.Future that is resolved
+    when the record is durable or the segment has been switched.
+
+    If index_fd is given, version index entries of the records are written
+    to it (see index_entries()).
+
+    A failed write or fsync stops the writer: the segment (and its index) is
+    truncated back to the end of the last complete record and the records
+    appended afterwards are rejected (IOError), so that no record is ever
+    written after a torn one, which the replay would stop at.
+    '''
+
+    def __init__(self, fd, background=False, index_fd=None):
+        self.fd = fd
+        self.index_fd = index_fd
+        self.background = background
+        self.batches = 0  # the number of fsyncs
+        self.records = 0  # the number of records written
+        self.segment_records = 0  # the number of records in the segment
+        self.segment_started = time.time()  # when the segment was opened
+        self._pending = []  # [(record or None, new fds or None, sync, versions, future), ...]
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+        self._failed = None  # the error of a failed write
+        self._good = self._offsets()  # the end of the last complete record
+
+    @property
+    def running(self):
+        '''
+        True if the background thread has been started.
+        '''
+        return self._thread is not None
+
+    def append(self, record, sync=True, versions=None):
+        '''
+        Appends a record to the current segment.
+
+        If sync is False, the future is resolved once the record has been
+        written to the OS page cache (no fsync).
+
+        versions is {root_oid: new version} of the roots changed by
+        the record, for the version index.
+        '''
+        if self.background:
+            return self._enqueue(record, None, sync, versions)
+        else:
+            self._check()
+            try:
+                self._write(record, versions)
+                self._flush()
+                if sync:
+                    self._sync()
+            except Exception as e:
+                self._fail(e)
+                raise
+            return _done_future()
+
+    def rotate(self, fd, index_fd=None):
+        '''
+        Switches to a new segment after all the records appended so far have
+        been written to the current one. The current segment (and its index)
+        is closed.
+        '''
+        if self.background:
+            return self._enqueue(None, (fd, index_fd), True)
+        else:
+            self._check()
+            try:
+                self._sync()
+            except Exception as e:
+                self._fail(e)
+                raise
+            self._switch(fd, index_fd)
+            return _done_future()
+
+    def flush(self):
+        '''
+        Returns a Future resolved when all the records appended so far
+        are durable.
+        '''
+        if self.background:
+            return self._enqueue(b'', None, True)
+        else:
+            return _done_future()
+
+    def close(self):
+        '''
+        Writes the pending records and closes the current segment.
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+        if not self.fd.closed:
+            self.fd.close()
+        if self.index_fd and not self.index_fd.closed:
+            self.index_fd.close()
+
+    def _enqueue(self, record, fds, sync, versions=None):
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise ValueError('log writer closed')
+            self._check()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                        name='tega-log-writer', daemon=True)
+                self._thread.start()
+            self._pending.append((record, fds, sync, versions, future))
+            self._cond.notify()
+        return future
+
+    def _write(self, record, versions):
+        if versions and self.index_fd:
+            self.index_fd.write(index_entries(versions, self.fd.tell()))
+        self.fd.write(record)
+        self.records += 1
+        self.segment_records += 1
+
+    def _flush(self):
+        self.fd.flush()
+        if self.index_fd:
+            self.index_fd.flush()
+        self._good = self._offsets()
+
+    def _offsets(self):
+        return (self.fd.tell(), self.index_fd.tell() if self.index_fd else 0)
+
+    def _check(self):
+        if self._failed is not None:
+            raise IOError('commit log writer failed: {}'.format(self._failed))
+
+    def _fail(self, e):
+        '''
+        Stops the writer after a failed write, truncating the segment and
+        its index back to the end of the last complete record.
+        '''
+        logging.exception('commit log write failed')
+        self._failed = e
+        for fd, offset in zip((self.fd, self.index_fd), self._good):
+            if fd is None or fd.closed:
+                continue
+            try:
+                os.ftruncate(fd.fileno(), offset)
+                fd.raw.close()  # discards the bytes left in the buffer
+            except Exception:
+                logging.exception('commit log truncation failed')
+
+    def _sync(self):
+        self._flush()
+        os.fsync(self.fd.fileno())
+        self.batches += 1
+
+    def _switch(self, fd, index_fd):
+        old, old_index = self.fd, self.index_fd
+        if old_index:
+            os.fsync(old_index.fileno())
+        self.fd = fd
+        self.index_fd = index_fd
+        self.segment_records = 0
+        self.segment_started = time.time()
+        self._good = self._offsets()
+        for fd_ in (old, old_index):
+            if fd_ and not fd_.closed:
+                fd_.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    break
+                batch = self._pending
+                self._pending = []
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        '''
+        Writes a batch of records with one fsync.
+        '''
+        written = []
+        try:
+            self._check()
+            for record, fds, sync, versions, future in batch:
+                if record is not None:
+                    if record:
+                        self._write(record, versions)
+                    written.append((sync, future))
+                else:
+                    self._commit(written)
+                    written = []
+                    self._sync()
+                    self._switch(*fds)
+                    future.set_result(None)
+            self._commit(written)
+        except Exception as e:
+            if self._failed is None:
+                self._fail(e)
+            for record, fds, sync, versions, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _commit(self, written):
+        '''
+        Flushes the written records and fsyncs them if any of them requires.
+        '''
+        if not written:
+            return
+        self._flush()
+        for sync, future in written:
+            if not sync:
+                future.set_result(None)
+        if any([sync for sync, future in written]):
+            os.fsync(self.fd.fileno())
+            self.batches += 1
+            for sync, future in written:
+                if sync:
+                    future.set_result(None)
+
+def _legacy_transactions(fd):
+    '''
+    Parses a legacy text commit log and generates records.
+    '''
+    logs = []
+    begin = False
+    for line in fd:
+        line = line.rstrip('\n')
+        if line == '':
+            pass
+        elif line.startswith(LEGACY_COMMIT_START_MARKER):
+            logs = []
+            begin = True
+        elif line.startswith(LEGACY_COMMIT_FINISH_MARKER):
+            if begin and logs:
+                timestamp = line[1:].split(':!')[0]
+                yield tx_record(logs, timestamp)
+            logs = []
+            begin = False
+        elif line.startswith(LEGACY_SYNC_CONFIRMED_MARKER):
+            pass
+        elif line.startswith(LEGACY_ROLLBACK_MARKER):
+            args = line.split(' ')
+            yield rollback_record(int(args[0]), args[1], args[2])
+        elif begin:
+            logs.append(ast.literal_eval(line))
+
+def convert_legacy(src, dst):
+    '''
+    Converts a legacy text commit log (str(dict) per line) into
+    the framed format. An unfinished transaction at the tail is dropped.
+    '''
+    with open(src, 'r') as fd_in, open(dst, 'wb') as fd_out:
+        fd_out.write(MAGIC)
+        for record in _legacy_transactions(fd_in):
+            fd_out.write(record)
+        fd_out.flush()
+        os.fsync(fd_out.fileno())
+
+def convert_legacy_in_place(path):
+    '''
+    Converts a legacy commit log into the framed format, keeping the
+    original one as "<path>.legacy".
+    '''
+    tmp = path + '.tmp'
+    convert_legacy(path, tmp)
+    os.rename(path, path + '.legacy')
+    os.rename(tmp, path)
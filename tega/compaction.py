@@ -0,0 +1,98 @@
+'''
+Automatic log compaction
+
+A snapshot is taken (and the commit log is switched to a new segment) when
+the current segment exceeds one of the thresholds:
+
+- max_bytes: the size of the segment
+- max_records: the number of records in the segment
+- max_age: seconds since the segment was opened
+
+After the snapshot is complete, the segments and the snapshots older than
+the newest "retain" snapshots are deleted, or moved to archive_dir.
+
+Usage example:
+
+    policy = CompactionPolicy('global', max_bytes=64*1024*1024, retain=2)
+    tornado.ioloop.PeriodicCallback(policy.check, 10000).start()
+'''
+
+import tega.idb
+
+import logging
+import os
+
+class CompactionPolicy(object):
+    '''
+    Segment rotation and compaction policy.
+    '''
+
+    def __init__(self, tega_id, max_bytes=None, max_records=None, max_age=None,
+            retain=1, archive_dir=None):
+        if retain < 1:
+            raise ValueError('retain must be 1 or more')
+        if archive_dir and not os.path.isdir(archive_dir):
+            raise FileNotFoundError(archive_dir)
+        self.tega_id = tega_id
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.max_age = max_age
+        self.retain = retain
+        self.archive_dir = archive_dir
+        self.last_reason = None  # the threshold exceeded last time
+
+    def due(self):
+        '''
+        Returns the threshold exceeded by the current segment, or None.
+        '''
+        segment = tega.idb.segment_stats()
+        if segment['records'] == 0:
+            return None
+        if self.max_bytes and segment['bytes'] >= self.max_bytes:
+            return 'bytes'
+        if self.max_records and segment['records'] >= self.max_records:
+            return 'records'
+        if self.max_age and segment['age'] >= self.max_age:
+            return 'age'
+        return None
+
+    def check(self):
+        '''
+        Takes a snapshot in background if the current segment exceeds
+        one of the thresholds, and prunes the old segments after it.
+
+        Returns the Future of the snapshot, or None.
+        '''
+        if tega.idb.snapshot_progress().get('state') == 'running':
+            return None
+        reason = self.due()
+        if not reason:
+            return None
+        logging.info('compaction: segment {} exceeded'.format(reason))
+        self.last_reason = reason
+        future = tega.idb.save_snapshot(self.tega_id)
+        future.add_done_callback(self._snapshot_done)
+        return future
+
+    def _snapshot_done(self, future):
+        if future.exception() is None:
+            self.prune()
+
+    def prune(self):
+        '''
+        Deletes or archives the segments made redundant by the retained
+        snapshots.
+        '''
+        return tega.idb.prune_segments(retain=self.retain,
+                archive_dir=self.archive_dir)
+
+    def stats(self):
+        '''
+        Returns the thresholds of the policy.
+        '''
+        return {'max_bytes': self.max_bytes,
+                'max_records': self.max_records,
+                'max_age': self.max_age,
+                'retain': self.retain,
+                'archive_dir': self.archive_dir,
+                'last_reason': self.last_reason}
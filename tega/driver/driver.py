@@ -1,7 +1,7 @@
 #!/usr/bin/env python3.4
 
 from tega.env import HOST, PORT, HEADERS, WEBSOCKET_PUBSUB_URL
-from tega.idb import OPE
+from tega.idb import OPE, DURABILITY
 from tega.messaging import build_parser
 from tega.subscriber import SCOPE
 from tega.tree import Cont
@@ -18,6 +18,12 @@ PUT = OPE.PUT.name
 GET = OPE.GET.name 
 DELETE = OPE.DELETE.name 
 
+def _durability_value(durability):
+    if isinstance(durability, DURABILITY):
+        return durability.value
+    else:
+        return durability
+
 def _make_urlencode(base_url):
     def _urlencode(path_, **kwargs):
         _kwargs = {}
@@ -102,7 +108,8 @@ class Driver(object):
             self._tega_id = str(uuid.uuid4())
 
         for cmd in ('roots', 'old', 'channels', 'subscribers',
-                    'ids', 'global', 'forwarders', 'plugins', 'reload'):
+                    'ids', 'global', 'forwarders', 'plugins', 'reload',
+                    'stats'):
             setattr(self, cmd, self._build_cmd(cmd))
 
     @property
@@ -150,10 +157,22 @@ class Driver(object):
 
     def ss(self):
         '''
-        Saves a snapshot
+        Saves a snapshot in background, and returns its progress
         '''
         response, body = self._mgmt_cmd('ss', tega_id=self.tega_id)
-        return (response.status, response.reason, None)
+        if body:
+            body = json.loads(body.decode('utf-8'))
+        return (response.status, response.reason, body)
+
+    def ss_progress(self):
+        '''
+        Returns the progress of the ongoing (or last) snapshot
+        '''
+        response, body = self.conn.request(self._cmdencode('ss'),
+                                           GET, None, HEADERS)
+        if body:
+            body = json.loads(body.decode('utf-8'))
+        return (response.status, response.reason, body)
 
     def edges(self, root_oid=None, old_roots=False):
         '''
@@ -166,6 +185,22 @@ class Driver(object):
         body = json.loads(body.decode('utf-8'))
         return (response.status, response.reason, body)
 
+    def snapshot(self):
+        '''
+        Pins the newest roots in a snapshot handle, and returns its id and
+        the versions of the roots
+        '''
+        response, body = self._mgmt_cmd('snapshot', tega_id=self.tega_id)
+        body = json.loads(body.decode('utf-8'))
+        return (response.status, response.reason, body)
+
+    def release(self, snapshot):
+        '''
+        Releases a snapshot handle
+        '''
+        response, body = self._mgmt_cmd('release', snapshot=snapshot)
+        return (response.status, response.reason, None)
+
     def rollback(self, root_oid, backto):
         '''
         rollback command
@@ -179,34 +214,42 @@ class Driver(object):
         if response.status >= 300 or response.status < 200:
             raise CRUDException(response=response)
 
-    def put(self, instance, version=None, ephemeral=False):
+    def put(self, instance, version=None, ephemeral=False, durability=None):
         '''
         CRUD create/update operation
+
+        durability: DURABILITY level of the transaction (server default if
+        None).
         '''
         url = self._urlencode(instance2url(instance), txid=self.txid,
                              version=version, tega_id=self.tega_id,
-                             ephemeral=ephemeral)
+                             ephemeral=ephemeral,
+                             durability=_durability_value(durability))
         body_json = instance.dumps_()
         response, body = self.conn.request(url, PUT, body_json, HEADERS)
         self._response_check(response)
 
-    def delete(self, path, version=None):
+    def delete(self, path, version=None, durability=None):
         '''
         CRUD delete operation
         '''
         url = self._urlencode(path2url(path), txid=self.txid,
-                             version=version, tega_id=self.tega_id)
+                             version=version, tega_id=self.tega_id,
+                             durability=_durability_value(durability))
         response, body = self.conn.request(url, DELETE, None, HEADERS)
         self._response_check(response)
 
     def get(self, path, version=None, internal=False, python_dict=False,
-            regex_flag=False):
+            regex_flag=False, snapshot=None):
         '''
         CRUD read operation
+
+        snapshot: snapshot handle id (see snapshot()) to read from.
         '''
         url = self._urlencode(path2url(path), txid=self.txid,
                              version=version, tega_id=self.tega_id,
-                             internal=internal, regex_flag=str(regex_flag))
+                             internal=internal, regex_flag=str(regex_flag),
+                             snapshot=snapshot)
 
         response, body = self.conn.request(url, GET, None, HEADERS)
         if response.status >= 300 or response.status < 200:
@@ -268,10 +311,11 @@ class Driver(object):
         else:
             raise TransactionException(message='no ongoing transaction')
 
-    def commit(self):
+    def commit(self, durability=None):
         txid = self.txid
         if txid:
-            url = self._cmdencode('commit', txid=txid)
+            url = self._cmdencode('commit', txid=txid,
+                                  durability=_durability_value(durability))
             response, body = self.conn.request(url, POST, None, HEADERS)
             status = response.status
             reason = response.reason
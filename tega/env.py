@@ -23,6 +23,12 @@ CONNECT_RETRY_TIMER = 5
 # Directory for log and snapshot files
 DATA_DIR = './var'
 
+# Compaction policy check period in sec
+COMPACTION_CHECK_PERIOD = 10
+
+# Old roots expiration (by age) period in sec
+OLD_ROOTS_EXPIRE_PERIOD = 10
+
 # tega logo
 LOGO = '''
    __                  
@@ -0,0 +1,438 @@
+'''
+Persistent hash array mapped trie (HAMT)
+
+Hamt is a mutable mapping on top of a persistent trie: copy() is O(1), and
+the copy and the original share the trie nodes. A write copies the nodes on
+the path to the key only (O(log32 n)), unless the nodes have been created by
+the same Hamt object since the last copy(), in which case they are updated
+in place.
+
+Trie node
+---------
+bitmap: bit i is set if the slot i (5 bits of the hash) is used
+array: the used slots in the order of i; a slot is either a (key, value)
+       pair or a child node
+
+Keys with the same hash (64 bits) are kept in a collision node at the
+bottom of the trie.
+
+Insertion order
+---------------
+Like dict, the iteration order is the insertion order: an entry of the trie
+is a (key, value, sequence number) tuple, and the entries are also kept in
+a persistent vector (a trie of 32-slot chunks) indexed by the sequence
+numbers. A deleted entry leaves a hole (None) in the vector, and the vector
+is rebuilt once the holes outnumber the entries.
+'''
+
+from collections import MutableMapping
+from collections.abc import ItemsView, ValuesView
+import itertools
+import sys
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+_owners = itertools.count(1)
+
+try:
+    _popcount = int.bit_count
+except AttributeError:  # Python < 3.10
+    def _popcount(n):
+        return bin(n).count('1')
+
+class _Node(object):
+
+    __slots__ = ('bitmap', 'array', 'owner')
+
+    def __init__(self, bitmap, array, owner):
+        self.bitmap = bitmap
+        self.array = array
+        self.owner = owner
+
+class _Collision(object):
+
+    __slots__ = ('array', 'owner')
+
+    def __init__(self, array, owner):
+        self.array = array
+        self.owner = owner
+
+class _Chunk(object):
+
+    __slots__ = ('array', 'owner')
+
+    def __init__(self, array, owner):
+        self.array = array
+        self.owner = owner
+
+def _hash(key):
+    return hash(key) & HASH_MASK
+
+def _editable(node, owner):
+    '''
+    Returns the node if it is owned by the owner, or its copy.
+    '''
+    if node.owner == owner:
+        return node
+    elif type(node) is _Node:
+        return _Node(node.bitmap, list(node.array), owner)
+    else:
+        return type(node)(list(node.array), owner)
+
+def _merge(shift, pair1, hash1, pair2, hash2, owner):
+    '''
+    Returns a node containing two pairs.
+    '''
+    if shift >= HASH_BITS:
+        return _Collision([pair1, pair2], owner)
+    i1 = (hash1 >> shift) & MASK
+    i2 = (hash2 >> shift) & MASK
+    if i1 == i2:
+        child = _merge(shift + BITS, pair1, hash1, pair2, hash2, owner)
+        return _Node(1 << i1, [child], owner)
+    elif i1 < i2:
+        return _Node((1 << i1) | (1 << i2), [pair1, pair2], owner)
+    else:
+        return _Node((1 << i1) | (1 << i2), [pair2, pair1], owner)
+
+def _assoc(node, shift, hash_, entry, owner):
+    '''
+    Returns the node with the entry, replacing the one with the same key.
+    '''
+    key = entry[0]
+    if type(node) is _Collision:
+        node = _editable(node, owner)
+        for i, pair in enumerate(node.array):
+            if pair[0] == key:
+                node.array[i] = entry
+                return node
+        node.array.append(entry)
+        return node
+
+    bit = 1 << ((hash_ >> shift) & MASK)
+    index = _popcount(node.bitmap & (bit - 1))
+    if not node.bitmap & bit:
+        node = _editable(node, owner)
+        node.array.insert(index, entry)
+        node.bitmap |= bit
+        return node
+
+    item = node.array[index]
+    if type(item) is tuple:
+        key_ = item[0]
+        if key_ is key or key_ == key:
+            child = entry
+        else:
+            child = _merge(shift + BITS, item, _hash(key_), entry, hash_,
+                    owner)
+    else:
+        child = _assoc(item, shift + BITS, hash_, entry, owner)
+        if child is item:
+            return node
+    node = _editable(node, owner)
+    node.array[index] = child
+    return node
+
+def _dissoc(node, shift, hash_, key, owner):
+    '''
+    Returns the node without the key: None if the node becomes empty, or
+    a pair if a collision node has only one pair left.
+
+    Raises KeyError if the key is not found.
+    '''
+    if type(node) is _Collision:
+        for i, pair in enumerate(node.array):
+            if pair[0] == key:
+                if len(node.array) == 2:
+                    return node.array[1 - i]
+                node = _editable(node, owner)
+                del node.array[i]
+                return node
+        raise KeyError(key)
+
+    bit = 1 << ((hash_ >> shift) & MASK)
+    if not node.bitmap & bit:
+        raise KeyError(key)
+    index = _popcount(node.bitmap & (bit - 1))
+    item = node.array[index]
+    if type(item) is tuple:
+        if not (item[0] is key or item[0] == key):
+            raise KeyError(key)
+        child = None
+    else:
+        child = _dissoc(item, shift + BITS, hash_, key, owner)
+        if child is item:
+            return node
+        if type(child) is _Node and len(child.array) == 1 and \
+                type(child.array[0]) is tuple:
+            child = child.array[0]  # pulls up a single pair
+    if child is None:
+        if node.bitmap == bit:
+            return None
+        node = _editable(node, owner)
+        del node.array[index]
+        node.bitmap ^= bit
+    else:
+        node = _editable(node, owner)
+        node.array[index] = child
+    return node
+
+def _set_slot(node, shift, index, entry, owner):
+    '''
+    Returns the chunk (None if new) with the slot index of the vector set.
+    '''
+    if node is None:
+        node = _Chunk([], owner)
+    else:
+        node = _editable(node, owner)
+    i = (index >> shift) & MASK
+    if shift:
+        child = node.array[i] if i < len(node.array) else None
+        entry = _set_slot(child, shift - BITS, index, entry, owner)
+    if i < len(node.array):
+        node.array[i] = entry
+    else:
+        node.array.append(entry)
+    return node
+
+def _entries(node, shift):
+    '''
+    Generates the entries of the vector in order.
+    '''
+    if shift:
+        for child in node.array:
+            yield from _entries(child, shift - BITS)
+    else:
+        for entry in node.array:
+            if entry is not None:
+                yield entry
+
+def _sizeof(node, other):
+    '''
+    Returns the bytes of the trie (or vector) node and its descendants not
+    shared with the node in the same place of another trie (None if none),
+    including the entries in the trie but not the keys and the values.
+    '''
+    if node is other:
+        return 0
+    size = sys.getsizeof(node) + sys.getsizeof(node.array)
+    type_ = type(node)
+    if type(other) is not type_:
+        other = None
+    if type_ is _Node:
+        k = 0
+        for i in range(MASK + 1):
+            if not (node.bitmap >> i) & 1:
+                continue
+            item = node.array[k]
+            k += 1
+            other_item = None
+            if other is not None and (other.bitmap >> i) & 1:
+                other_item = other.array[_popcount(other.bitmap &
+                    ((1 << i) - 1))]
+            if item is other_item:
+                continue
+            if type(item) is tuple:
+                size += sys.getsizeof(item)
+            else:
+                size += _sizeof(item, other_item)
+    elif type_ is _Collision:
+        for item in node.array:
+            if other is None or all(item is not i for i in other.array):
+                size += sys.getsizeof(item)
+    else:  # the entries are in the trie
+        for i, item in enumerate(node.array):
+            if type(item) is _Chunk:
+                other_item = None
+                if other is not None and i < len(other.array):
+                    other_item = other.array[i]
+                size += _sizeof(item, other_item)
+    return size
+
+class _ItemsView(ItemsView):
+
+    __slots__ = ()
+
+    def __iter__(self):
+        for entry in self._mapping._entries():
+            yield entry[0], entry[1]
+
+class _ValuesView(ValuesView):
+
+    __slots__ = ()
+
+    def __iter__(self):
+        for entry in self._mapping._entries():
+            yield entry[1]
+
+class Hamt(MutableMapping):
+    '''
+    Mutable mapping on a persistent trie, copied in O(1).
+    '''
+
+    __slots__ = ('_root', '_order', '_shift', '_count', '_size', '_owner')
+
+    def __init__(self, items=None):
+        self._root = None
+        self._order = None  # vector of the entries in insertion order
+        self._shift = 0  # of the root chunk of the vector
+        self._count = 0  # sequence numbers used
+        self._size = 0
+        self._owner = next(_owners)
+        if items:
+            self._build(items.items())
+
+    def _build(self, items):
+        '''
+        Builds the tries of the items (unique keys) in order.
+        '''
+        owner = self._owner
+        entries = [(key, value, seq) for seq, (key, value)
+                in enumerate(items)]
+        root = _Node(0, [], owner)
+        for entry in entries:
+            root = _assoc(root, 0, _hash(entry[0]), entry, owner)
+        chunks = entries
+        shift = -BITS
+        while len(chunks) > 1 or shift < 0:
+            chunks = [_Chunk(chunks[i:i + MASK + 1], owner)
+                    for i in range(0, len(chunks), MASK + 1)]
+            shift += BITS
+        self._root = root
+        self._order = chunks[0] if chunks else None
+        self._shift = shift
+        self._count = self._size = len(entries)
+
+    def copy(self):
+        '''
+        Returns a copy sharing the trie.
+        '''
+        self._owner = next(_owners)  # the nodes are shared from now on
+        obj = Hamt()
+        obj._root = self._root
+        obj._order = self._order
+        obj._shift = self._shift
+        obj._count = self._count
+        obj._size = self._size
+        return obj
+
+    def __len__(self):
+        return self._size
+
+    def _entry(self, key):
+        '''
+        Returns the entry (key, value, sequence number) of the key, or None.
+        '''
+        node = self._root
+        hash_ = _hash(key)
+        shift = 0
+        while node is not None:
+            if type(node) is _Collision:
+                for pair in node.array:
+                    if pair[0] == key:
+                        return pair
+                break
+            bit = 1 << ((hash_ >> shift) & MASK)
+            if not node.bitmap & bit:
+                break
+            item = node.array[_popcount(node.bitmap & (bit - 1))]
+            if type(item) is tuple:
+                if item[0] is key or item[0] == key:
+                    return item
+                break
+            node = item
+            shift += BITS
+        return None
+
+    def __getitem__(self, key):
+        entry = self._entry(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[1]
+
+    def __contains__(self, key):
+        return self._entry(key) is not None
+
+    def _set_order(self, seq, entry):
+        if seq >> self._shift > MASK:  # the vector is full
+            self._order = _Chunk([self._order], self._owner)
+            self._shift += BITS
+        self._order = _set_slot(self._order, self._shift, seq, entry,
+                self._owner)
+
+    def __setitem__(self, key, value):
+        entry = self._entry(key)
+        if entry is None:
+            entry = (key, value, self._count)
+            self._count += 1
+            self._size += 1
+        elif entry[1] is value:
+            return
+        else:
+            entry = (key, value, entry[2])
+        if self._root is None:
+            self._root = _Node(0, [], self._owner)
+        self._root = _assoc(self._root, 0, _hash(key), entry, self._owner)
+        self._set_order(entry[2], entry)
+
+    def __delitem__(self, key):
+        entry = self._entry(key)
+        if entry is None:
+            raise KeyError(key)
+        self._root = _dissoc(self._root, 0, _hash(key), key, self._owner)
+        self._size -= 1
+        self._set_order(entry[2], None)  # a hole
+        if self._count - self._size > max(self._size, 1 << BITS):
+            self._compact()
+
+    def _compact(self):
+        '''
+        Rebuilds the tries without the holes of the vector.
+        '''
+        entries = [entry[:2] for entry in self._entries()]
+        self._owner = next(_owners)
+        self._build(entries)
+
+    def _entries(self):
+        if self._order is not None:
+            yield from _entries(self._order, self._shift)
+
+    def __iter__(self):
+        for entry in self._entries():
+            yield entry[0]
+
+    def items(self):
+        return _ItemsView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    def sizeof(self, other=None):
+        '''
+        Returns the bytes of the Hamt object and its tries, excluding the
+        keys and the values, but the trie nodes shared with other (Hamt).
+        '''
+        if type(other) is not Hamt:
+            other = None
+        size = sys.getsizeof(self)
+        other_root = other_order = None
+        if other is not None:
+            other_root = other._root
+            other_order = other._order
+            shift = other._shift
+            while shift > self._shift:  # the vector has grown
+                other_order = other_order.array[0]
+                shift -= BITS
+            if shift != self._shift:
+                other_order = None
+        if self._root is not None:
+            size += _sizeof(self._root, other_root)
+        if self._order is not None:
+            size += _sizeof(self._order, other_order)
+        return size
+
+    def __repr__(self):
+        return 'Hamt({})'.format(dict(self.items()))
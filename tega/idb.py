@@ -1,7 +1,13 @@
 from tega.subscriber import SCOPE
 from tega.messaging import request, REQUEST_TYPE
-from tega.tree import Cont, RPC
-from tega.util import path2qname, qname2path, dict2cont, subtree, deserialize, align_vector, align_vector2, commit_log_number, readline_reverse, edges, nested_regex_path
+from tega.hamt import Hamt
+from tega.tree import Cont, RPC, Vector, set_meta, supersede, json_cache_stats
+from tega.schema import validate
+from tega.util import path2qname, qname2path, dict2cont, subtree, deserialize, align_vector, commit_log_number, edges, nested_regex_path, pack_trees, unpack_trees
+from tega.syncbuffer import SyncBuffer, SYNC_BUFFER_BYTES
+from tega.commitlog import MAGIC, RECORD_TX, RECORD_ROLLBACK, LogWriter, tx_record, rollback_record, read_records, read_records_reverse, write_magic, is_legacy, convert_legacy_in_place, truncate_tail, record_versions, read_index, build_index, decode_payload, SegmentReader, compress_segment, compression_stats
+
+from concurrent.futures import Future, ProcessPoolExecutor
 
 import copy
 import collections
@@ -11,23 +17,37 @@ import logging
 import os
 import re
 import datetime
+import shutil
+import sys
+import threading
+import time
+import zlib
 from tornado import gen
+import tornado.ioloop
 import traceback
 import uuid
 import json 
 
 now = datetime.datetime.now
 
-COMMIT_START_MARKER = '?'
-COMMIT_FINISH_MARKER = '@'
-ROLLBACK_MARKER = '-'
-SYNC_CONFIRMED_MARKER = '*'
 OLD_ROOTS_LEN = 10
+PARALLEL_REPLAY_MIN_BYTES = 4 * 1024 * 1024  # smaller logs are replayed serially
 
 _idb = {}  # in-memory DB
 _old_roots = {}  # old roots at every version
+_path_indexes = {}  # root_oid: (root, path index) (see _path_index())
 _log_dir = None  # Log directory
 _log_fd = None  # Log file descriptor
+_log_writer = None  # Log writer (LogWriter)
+_group_commit = False  # Log writer runs in a background thread
+_commit_stats = {}  # commit latency and throughput per durability level
+_commit_stats_lock = threading.Lock()
+_commit_stats_since = time.time()
+_snapshot_future = None  # Future of the ongoing (or last) snapshot
+_snapshot_progress = {}  # Progress of the ongoing (or last) snapshot
+_replay_rate = None  # Replay throughput (bytes/sec) measured by reload_log
+_sync_buffer = SyncBuffer()  # Recent committed transactions for sync
+_compression = False  # Compresses snapshots and sealed segments
 _ephemeral_nodes = {}  # holder of ephemeral nodes
 
 server_tega_id = None  # Server's tega ID
@@ -36,11 +56,57 @@ channels = {}  # channels subscribed by subscribers
 global_channels = {}  # channels belonging to global or sync scope
 subscribers = {}  # subscribers subscribing channels
 subscribe_forwarders = set()
-old_roots_len = OLD_ROOTS_LEN  # The max number of old roots kept in idb 
+old_roots_len = OLD_ROOTS_LEN  # The max number of old roots kept in idb
+old_roots_bytes = None  # The max bytes of old roots kept in idb per root
+old_roots_age = None  # The max age (sec) of old roots kept in idb
 
 def _commit_log_filename(tega_id, num):
     return 'log.{}.{}'.format(tega_id, str(num))
 
+def _snapshot_filename(tega_id, num):
+    '''
+    Snapshot of idb at the beginning of the commit log segment "num".
+    '''
+    return 'ss.{}.{}'.format(tega_id, str(num))
+
+def _index_filename(tega_id, num):
+    '''
+    Version index of the commit log segment "num".
+    '''
+    return 'idx.{}.{}'.format(tega_id, str(num))
+
+def _open_log(log_file):
+    '''
+    Opens a commit log segment in append-only mode.
+    '''
+    if os.path.exists(log_file):
+        truncate_tail(log_file)
+    fd = open(log_file, 'ab+')  # append-only file
+    write_magic(fd)
+    fd.flush()
+    return fd
+
+def _open_index(num):
+    '''
+    Rebuilds the version index of the commit log segment "num" and opens it
+    in append-only mode.
+    '''
+    log_file = os.path.join(_log_dir, _commit_log_filename(server_tega_id, num))
+    index_file = os.path.join(_log_dir, _index_filename(server_tega_id, num))
+    build_index(log_file, index_file)
+    return open(index_file, 'ab')
+
+def _convert_legacy_logs():
+    '''
+    Converts legacy text commit logs into the framed format.
+    '''
+    max_ = commit_log_number(server_tega_id, _log_dir)
+    for i in range(0, max_ + 1):
+        log_file = os.path.join(_log_dir, _commit_log_filename(server_tega_id, i))
+        if os.path.exists(log_file) and is_legacy(log_file):
+            logging.info('converting legacy commit log: {}'.format(log_file))
+            convert_legacy_in_place(log_file)
+
 class OPE(Enum):
     '''
     CRUD operations
@@ -52,6 +118,16 @@ class OPE(Enum):
     SS = 5
     ROLLBACK = 6
 
+class DURABILITY(Enum):
+    '''
+    Durability levels of a transaction
+    '''
+    MEMORY = 'memory'  # in-memory only (only its version is logged)
+    WRITTEN = 'written'  # written to the OS page cache
+    FSYNC = 'fsync'  # fsynced to the disk
+
+default_durability = DURABILITY.FSYNC  # server-wide default
+
 class NonLocalRPC(Exception):
     '''
     "Non-local RPC called" exception.
@@ -63,23 +139,53 @@ class NonLocalRPC(Exception):
     def __str__(self):
         return self.reason
 
-def start(data_dir, tega_id, maxlen=OLD_ROOTS_LEN):
+def start(data_dir, tega_id, maxlen=OLD_ROOTS_LEN, group_commit=False,
+        durability=DURABILITY.FSYNC, sync_buffer_bytes=SYNC_BUFFER_BYTES,
+        compression=False, max_bytes=None, max_age=None):
     '''
     Starts tega db
+
+    If group_commit is True, commit logs are written by a background thread
+    and made durable in batches. Notifications of a transaction are released
+    on the Tornado IOLoop after its batch has been made durable.
+
+    durability is the default durability level of transactions.
+
+    sync_buffer_bytes is the size of the buffer of recent transactions
+    per root, from which sync() serves followers.
+
+    If compression is True, snapshots and sealed commit log segments are
+    compressed.
+
+    The old roots of a root are kept up to maxlen versions, max_bytes bytes
+    and/or max_age seconds (no limit if None, see OldRoots).
     '''
-    global _log_fd
+    global _log_fd, _log_writer, _group_commit, default_durability
+    global _sync_buffer, old_roots_len, old_roots_bytes, old_roots_age
+    global _compression
     global _log_dir
     global server_tega_id
     server_tega_id = tega_id
     _log_dir = os.path.join(os.path.expanduser(data_dir))
+    if not os.path.isdir(_log_dir):
+        raise FileNotFoundError(_log_dir)
+    _convert_legacy_logs()
     num = commit_log_number(server_tega_id, _log_dir)
     filename = _commit_log_filename(server_tega_id, num)
     log_file = os.path.join(_log_dir, filename)
     try:
-        _log_fd = open(log_file, 'a+')  # append-only file
+        _log_fd = _open_log(log_file)
     except FileNotFoundError:
         raise
+    _group_commit = group_commit
+    _log_writer = LogWriter(_log_fd, background=group_commit,
+            index_fd=_open_index(num))
+    default_durability = DURABILITY(durability)
+    _sync_buffer = SyncBuffer(sync_buffer_bytes)
+    _compression = compression
     old_roots_len = maxlen
+    old_roots_bytes = max_bytes
+    old_roots_age = max_age
 
 def is_started():
     '''
@@ -96,6 +202,8 @@ def stop():
     Stops tega db
     '''
     global _log_fd
+    if _log_writer:
+        _log_writer.close()
     if _log_fd:
         _log_fd.close()
 
@@ -103,23 +211,34 @@ def clear():
     '''
     Empties tega-db file and in-memory DB
     '''
-    global _log_fd, _log_dir, _idb, _old_roots, server_tega_id
+    global _log_fd, _log_writer, _log_dir, _idb, _old_roots, server_tega_id
+    global _path_indexes
 
     # Clears idb
     _idb = {}
     _old_roots = {}
+    _path_indexes = {}
+    _sync_buffer.clear()
 
-    # Removes commit log files
+    # Removes commit log files and snapshots
+    _log_writer.close()
     _log_fd.close()
+    if _snapshot_future:
+        _snapshot_future.exception()  # waits for the ongoing snapshot
     max_ = commit_log_number(server_tega_id, _log_dir)
     for i in range(0, max_ + 1):
-        log_file = os.path.join(_log_dir, _commit_log_filename(server_tega_id, i))
-        if os.path.exists(log_file):
-            os.remove(log_file)
+        for filename in (_commit_log_filename(server_tega_id, i),
+                _snapshot_filename(server_tega_id, i),
+                _index_filename(server_tega_id, i)):
+            log_file = os.path.join(_log_dir, filename)
+            if os.path.exists(log_file):
+                os.remove(log_file)
 
     # Reopens an empty commit log file
     log_file = os.path.join(_log_dir, _commit_log_filename(server_tega_id, 0))
-    _log_fd = open(log_file, 'a+')  # append-onlyfile
+    _log_fd = _open_log(log_file)
+    _log_writer = LogWriter(_log_fd, background=_group_commit,
+            index_fd=_open_index(0))
 
 def _backslash_dot(path):
     return re.sub('\.', '\\.', path)
@@ -303,8 +422,254 @@ def log_entry(ope, path, tega_id, instance, backto=None):
                 'tega_id': tega_id,
                 'instance': instance}
 
-def old_roots_deque():
-    return collections.deque(maxlen=old_roots_len)
+def _record_commit(durability, started, future):
+    '''
+    Records the latency of a commit when the commit log is durable.
+    '''
+    def _done(future):
+        latency = time.time() - started
+        with _commit_stats_lock:
+            if not durability in _commit_stats:
+                _commit_stats[durability] = {'commits': 0, 'latency_sum': 0.0,
+                                             'latency_max': 0.0}
+            stats = _commit_stats[durability]
+            stats['commits'] += 1
+            stats['latency_sum'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+    if future:
+        future.add_done_callback(_done)
+    else:
+        _done(None)
+
+def commit_stats():
+    '''
+    Returns commit latency (msec) and throughput (commits/sec) per
+    durability level since the last reset.
+    '''
+    elapsed = time.time() - _commit_stats_since
+    stats = {}
+    with _commit_stats_lock:
+        for durability, s in _commit_stats.items():
+            commits = s['commits']
+            stats[durability.value] = {
+                    'commits': commits,
+                    'latency_avg': s['latency_sum'] / commits * 1000,
+                    'latency_max': s['latency_max'] * 1000,
+                    'throughput': commits / elapsed if elapsed > 0 else 0}
+    return stats
+
+def reset_commit_stats():
+    '''
+    Resets the commit statistics.
+    '''
+    global _commit_stats_since
+    with _commit_stats_lock:
+        _commit_stats.clear()
+        _commit_stats_since = time.time()
+
+def stats():
+    '''
+    Returns statistics of tega db.
+    '''
+    stats_ = {'commit': commit_stats()}
+    if _log_writer:
+        stats_['log'] = {'records': _log_writer.records,
+                         'fsyncs': _log_writer.batches}
+        stats_['segment'] = segment_stats()
+        stats_['replay'] = replay_estimate()
+    stats_['sync'] = _sync_buffer.stats()
+    stats_['compression'] = compression_stats()
+    stats_['json_cache'] = json_cache_stats()
+    stats_['old_roots'] = old_roots_stats()
+    return stats_
+
+class OldRoots(object):
+    '''
+    Old roots of a root_oid keyed by version, from the oldest to the newest.
+
+    The oldest versions are evicted first while more than maxlen versions,
+    more than max_bytes bytes or the versions older than max_age seconds
+    are kept (no limit if None). The bytes of a version are the bytes not
+    shared with the next version (see _unshared_bytes()), that is, the
+    bytes freed by its eviction.
+    '''
+
+    __slots__ = ('maxlen', 'max_bytes', 'max_age', 'bytes', '_roots')
+
+    def __init__(self, maxlen=None, max_bytes=None, max_age=None):
+        self.maxlen = maxlen
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.bytes = 0
+        self._roots = collections.OrderedDict()  # version: (root, bytes, time)
+
+    def append(self, pair, size=0):
+        '''
+        Appends (version, root) retaining size bytes.
+        '''
+        version, root = pair
+        if version in self._roots:
+            self.bytes -= self._roots.pop(version)[1]
+        self._roots[version] = (root, size, time.time())
+        self.bytes += size
+        self.expire()
+
+    def expire(self):
+        '''
+        Evicts the oldest versions beyond the limits.
+        '''
+        roots = self._roots
+        deadline = None
+        if self.max_age is not None:
+            deadline = time.time() - self.max_age
+        while roots:
+            root, size, time_ = next(iter(roots.values()))
+            if (self.maxlen is not None and len(roots) > self.maxlen) or \
+                    (self.max_bytes is not None and
+                        self.bytes > self.max_bytes) or \
+                    (deadline is not None and time_ < deadline):
+                roots.popitem(last=False)
+                self.bytes -= size
+            else:
+                break
+
+    def pop(self):
+        '''
+        Removes and returns the newest (version, root).
+        '''
+        version, (root, size, time_) = self._roots.popitem()
+        self.bytes -= size
+        return version, root
+
+    def get(self, version):
+        '''
+        Returns the root of the version, or None.
+        '''
+        entry = self._roots.get(version)
+        return None if entry is None else entry[0]
+
+    def size(self, version):
+        '''
+        Returns the bytes retained by the version.
+        '''
+        return self._roots[version][1]
+
+    def __iter__(self):
+        for version, entry in self._roots.items():
+            yield version, entry[0]
+
+    def __len__(self):
+        return len(self._roots)
+
+def _new_old_roots():
+    return OldRoots(old_roots_len, old_roots_bytes, old_roots_age)
+
+def _node_bytes(node, copy_=None):
+    '''
+    Returns the bytes of a node, excluding its children, and the trie nodes
+    of the children (Hamt) shared with its copy (copy_) if given.
+    '''
+    size = sys.getsizeof(node)
+    type_ = type(node)
+    if type_ is Cont:
+        children = node._children
+        if type(children) is Hamt:
+            size += children.sizeof(copy_ and copy_._children)
+        else:
+            size += sys.getsizeof(children)
+        if node._cell is not None:
+            size += sys.getsizeof(node._cell)
+    elif type_ is Vector:
+        size += sys.getsizeof(node._value)
+    elif type_ in Cont._wrapped_types:
+        dict_ = getattr(node, '__dict__', None)  # no slots (int, str...)
+        if dict_ is not None:
+            size += sys.getsizeof(dict_)
+    return size
+
+def _subtree_bytes(node):
+    '''
+    Returns the bytes of a subtree.
+    '''
+    size = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        size += _node_bytes(node)
+        if type(node) is Cont:
+            stack.extend(node._children.values())
+    return size
+
+def _unshared_bytes(old_root, new_root, qnames):
+    '''
+    Returns the bytes of the old root version not shared with the new one,
+    following the paths put or deleted (qnames) by the transaction: the
+    nodes copied on write and the subtrees replaced or deleted.
+    '''
+    if new_root is None or any(len(qname) == 1 for qname in qnames):
+        return _subtree_bytes(old_root)
+    size = 0
+    copied = set()  # ids of the nodes copied on write
+    replaced = set()  # ids of the subtrees replaced or deleted
+    for qname in sorted(qnames, key=len):  # the ancestors first
+        old, new = old_root, new_root
+        for oid in qname[1:]:
+            if id(old) not in copied:
+                copied.add(id(old))
+                size += _node_bytes(old, new)
+            old = old._children.get(oid)
+            new = new._children.get(oid) if type(new) is Cont else None
+            if old is None or old is new or id(old) in replaced:
+                break
+            if type(old) is not Cont or type(new) is not Cont:
+                replaced.add(id(old))
+                size += _subtree_bytes(old)
+                break
+        else:
+            replaced.add(id(old))
+            size += _subtree_bytes(old)
+    return size
+
+def _supersede_copies(old_root, new_root, qnames, copies):
+    '''
+    Hands the children shared with the old root version over to the copies
+    made on write along the paths put or deleted (qnames), leaving the nodes
+    replaced or deleted under their old parents (see tega.tree.supersede).
+    '''
+    pair = copies.get(id(new_root))
+    if pair is None or pair[0] is not old_root:
+        return  # replaced or deleted
+    supersede(old_root, new_root)
+    for qname in qnames:
+        old, new = old_root, new_root
+        for oid in qname[1:]:
+            child = old._children.get(oid)
+            new_child = new._children.get(oid)
+            if child is None or child is new_child:
+                break
+            set_meta(child, '_parent', old)
+            pair = copies.get(id(new_child))
+            if pair is None or pair[0] is not child:
+                break
+            supersede(child, new_child)
+            old, new = child, new_child
+
+def old_roots_stats():
+    '''
+    Returns the versions and the bytes of the old roots retained per root.
+    '''
+    return {'max_len': old_roots_len,
+            'max_bytes': old_roots_bytes,
+            'max_age': old_roots_age,
+            'roots': {k: {'versions': len(v), 'bytes': v.bytes}
+                for k, v in _old_roots.items()}}
+
+def expire_old_roots():
+    '''
+    Evicts the old roots older than old_roots_age.
+    '''
+    for old_roots in _old_roots.values():
+        old_roots.expire()
 
 def _notify_broadcast(notify_batch, subscriber=None):
     '''
@@ -316,21 +681,63 @@ def _notify_broadcast(notify_batch, subscriber=None):
         if subscriber != _subscriber:
             _subscriber.on_notify(notifications)
 
+def _notify_when_durable(future, notify_batch, subscriber=None):
+    '''
+    Notifies CRUD operations after the commit log has been made durable.
+    '''
+    if not notify_batch:
+        return
+    if future is None or future.done():
+        if future is not None and future.exception():
+            logging.error('notifications discarded: {}'.
+                    format(future.exception()))
+        else:
+            _notify_broadcast(notify_batch=notify_batch, subscriber=subscriber)
+    else:
+        def _on_durable(future):
+            if future.exception():
+                logging.error('notifications discarded: {}'.
+                        format(future.exception()))
+            else:
+                _notify_broadcast(notify_batch=notify_batch,
+                        subscriber=subscriber)
+        tornado.ioloop.IOLoop.current().add_future(future, _on_durable)
+
+def _instance_version_set(instance, version):
+    '''
+    Sets "version" to the instance recursively.
+    '''
+    set_meta(instance, '_version', version)
+    stack = [instance._children]  # empty for leaves
+    while stack:
+        for v in stack.pop().values():
+            set_meta(v, '_version', version)
+            children = v._children
+            if children:
+                stack.append(children)
+
 class tx:
     '''
     tega-db transaction 
     '''
 
-    def __init__(self, tega_id=None, subscriber=None):
+    def __init__(self, tega_id=None, subscriber=None, durability=None):
         '''
         Note: subscriber includes tega_id. The user of this class w/o
         a subscriber client needs to set tega_id.
+
+        durability: DURABILITY level of this transaction (default_durability
+        if None).
         '''
         self.crud_queue = []  # requested CRUD operations
         self.commit_queue = []  # operations to be commited 
         self.candidate = {}  # candidate subtrees in a transaction
+        self.copies = {}  # id(copy): (original node, copy) by copy-on-write
+        self.qnames = {}  # root_oid: [qname put or deleted, ...]
         self.txid = str(uuid.uuid4())  # transaction ID
         self.notify_batch = {} 
+        self.future = None  # resolved when the commit log is durable
+        self.durability = durability
         self.subscriber = subscriber
         if self.subscriber:
             self.tega_id = self.subscriber.tega_id
@@ -344,19 +751,6 @@ class tx:
         if type_ is None:
             self.commit(write_log=True)
 
-    def _instance_version_set(self, instance, version):
-        '''
-        Sets "version" to the instance recursively.
-        '''
-        instance.__dict__['_version'] = version
-        instance_version_set = self._instance_version_set
-        if isinstance(instance, Cont):
-            for k,v in instance.items():
-                if isinstance(v, Cont):
-                    instance_version_set(v, version)
-                else:
-                    v.__dict__['_version'] = version
-
     def _copy_on_write(self, qname, above_tail=False):
         '''
         Copies the vertexes and edges for snapshot isolation.
@@ -397,9 +791,10 @@ class tx:
             new_root = Cont(root_oid)
         else:  # the root exists in _idb but its copy is not in self.candidate
             root = _idb[root_oid]
-            prev_version = root.__dict__['_version']
+            prev_version = root._version
             new_version = prev_version + 1
             new_root = root.copy_(freeze=True)
+            self.copies[id(new_root)] = (root, new_root)
             go = True
 
         original = root
@@ -415,18 +810,22 @@ class tx:
                 parent = tail
                 if go and iid in original:
                     original = original._extend(iid)
-                    if no_copy:
-                        tail = original
+                    if type(original) is not Cont:
+                        raise ValueError('{} is a leaf'.format(
+                            original.path_()))
+                    if no_copy and original._version == new_version:
+                        tail = original  # copied by an earlier operation
                     else:
                         tail = original.copy_(freeze=True)
-                    tail.__dict__['_parent'] = parent
-                    parent.__dict__[iid] = tail
+                        self.copies[id(tail)] = (original, tail)
+                    set_meta(tail, '_parent', parent)
+                    parent._children[iid] = tail
                 else:
                     go = False
                     tail = parent._extend(iid)
-                parent.__dict__['_version'] = new_version
+                set_meta(parent, '_version', new_version)
 
-            tail.__dict__['_version'] = new_version
+            set_meta(tail, '_version', new_version)
             
         return prev_version, new_version, new_root, tail
 
@@ -436,34 +835,39 @@ class tx:
 
         Note: since this data base is based on Tornado/coroutine,
         this commit function never interrupted by another process or thread.
-        '''
 
-        global _log_fd
-        write = _log_fd.write
+        Returns a concurrent.futures.Future resolved when the commit log
+        has been made durable (also set to self.future), or None if no log
+        is written.
+        '''
+        started = time.time()
+        durability = DURABILITY(self.durability or default_durability)
 
         for crud in self.crud_queue:
             func = crud[0]
             crud[0](*crud[1:])
 
-        if len(self.commit_queue) > 0:
-            finish_marker = COMMIT_FINISH_MARKER+'{}'.format(now())
-            if write_log:  # Writes log
-                if _log_fd:
-                    _log_fd.write(COMMIT_START_MARKER+'\n')  # commit start
-                    for log in self.commit_queue:
-                        log = str(log)
-                        write(log+'\n')
-                    write(finish_marker+'\n')  # commit finish marker
-                    _log_fd.flush()
-                    os.fsync(_log_fd)
+        if len(self.commit_queue) > 0 and write_log:
+            versions = {root_oid: candidate[1] for root_oid, candidate
+                    in self.candidate.items()}
+            record = tx_record(self.commit_queue, str(now()), versions)
+            if durability != DURABILITY.MEMORY and _log_writer:  # Writes log
+                self.future = _log_writer.append(record,
+                        sync=durability == DURABILITY.FSYNC,
+                        versions=versions)
+            elif _log_writer:  # Writes a version-only marker
+                _log_version_marker(versions)
+            _record_commit(durability, started, self.future)
+            for root_oid, version in versions.items():
+                notifications = [log for log in self.commit_queue
+                        if log['path'].split('.')[0] == root_oid]
+                _sync_buffer.append(root_oid, version, notifications,
+                        len(record), self.future)
 
         # old roots cache update
         for root_oid in self.candidate:
             prev_version, new_version, new_root = self.candidate[root_oid]
 
-            if new_root:
-               align_vector2(new_root, new_version)
-
             old_root = None
             if root_oid in _idb:
                 old_root = _idb[root_oid]
@@ -471,16 +875,23 @@ class tx:
                 _idb[root_oid] = new_root
             else:
                 del _idb[root_oid]
+                _sync_buffer.remove(root_oid)
+            qnames = self.qnames.get(root_oid, ())
             if old_root:
+                _supersede_copies(old_root, new_root, qnames, self.copies)
                 if not root_oid in _old_roots:
-                    _old_roots[root_oid] = old_roots_deque() 
-                _old_roots[root_oid].append((prev_version, old_root))
+                    _old_roots[root_oid] = _new_old_roots()
+                _old_roots[root_oid].append((prev_version, old_root),
+                        _unshared_bytes(old_root, new_root, qnames))
+            _update_path_index(root_oid, old_root, new_root, qnames)
 
         # Notifies the commited transaction to subscribers
-        _notify_broadcast(notify_batch=self.notify_batch,
+        _notify_when_durable(self.future, notify_batch=self.notify_batch,
                 subscriber=self.subscriber)
         self.notify_batch = {}
 
+        return self.future
+
     def _enqueue_commit(self, ope, path, tega_id, instance, ephemeral):
         '''
         Appends CRUD to the commit queue.
@@ -490,8 +901,14 @@ class tx:
         else:
             pass  # CRUD initiated by a notification or a tega db driver.
 
-        if instance and isinstance(instance, Cont):
+        if type(instance) is Vector:
+            instance = instance.encode_()
+        elif type(instance) is Cont:
+            instance = instance.serialize_(encode_vectors=True, builtin=True)
+        elif isinstance(instance, Cont):  # Bool (even if False) and RPC
             instance = instance.serialize_()
+        elif type(instance) in Cont._wrapped_types:
+            instance = Cont._wrapped_types[type(instance)](instance)
 
         log = log_entry(ope=ope.name, path=path, tega_id=tega_id, instance=instance)
 
@@ -507,21 +924,32 @@ class tx:
 
         Set "version" to the one from GET operation, when collision check is
         required.
+
+        The instance is copied (deepcopy), unless it is a frozen subtree
+        not in the tree yet: the tree takes it over as is (zero-copy), so
+        freeze the instance instead of copying it when putting a large one.
+        deepcopy=False always takes it over.
+
+        The instance is validated against the schema (see tega.schema),
+        raising SchemaError.
         '''
         if isinstance(instance, dict):
-            instance = subtree(path, instance)
+            instance = subtree(path, instance, freeze=True)
+            deepcopy = False  # the subtree is private
+        validate(instance)
         self.crud_queue.append((self._put, instance, tega_id, version, deepcopy,
             ephemeral))
 
     def _put(self, instance, tega_id=None, version=None, deepcopy=True,
             ephemeral=False):
 
-        qname = instance.qname_()
-        path = qname2path(qname)
+        qname = instance._qname_tuple()
+        path = instance.path_()
         if not tega_id:
             tega_id = self.tega_id
 
-        if deepcopy:
+        if deepcopy and not (isinstance(instance, Cont) and
+                instance.is_frozen_() and not _in_tree(instance)):
             instance = instance.deepcopy_()
 
         if ephemeral:
@@ -554,7 +982,8 @@ class tx:
                 instance.freeze_()
             root_oid = qname[0]
             prev_version, new_version, new_root, above_tail = self._copy_on_write(qname, above_tail=True)
-            self._instance_version_set(instance, new_version)
+            self.qnames.setdefault(root_oid, []).append(tuple(qname))
+            _instance_version_set(instance, new_version)
 
             if above_tail:
                 instance.change_(above_tail)
@@ -566,6 +995,36 @@ class tx:
             # Commit queue
             self._enqueue_commit(OPE.PUT, path, tega_id, instance, ephemeral)
 
+    def update_vector(self, path, values, start=0, tega_id=None,
+            version=None):
+        '''
+        Bulk update of the vector (Vector) on the path: the elements from
+        start are replaced with values, and the whole vector is committed
+        as one PUT (one log entry). The previous operations on the vector
+        in this transaction are included.
+
+        The updated vector is validated against the schema on commit,
+        raising SchemaError.
+        '''
+        self.crud_queue.append((self._update_vector, path, values, start,
+            tega_id, version))
+
+    def _update_vector(self, path, values, start, tega_id=None,
+            version=None):
+
+        qname = path2qname(path)
+        if qname[0] in self.candidate:  # updated in this transaction
+            vector = self.candidate[qname[0]][2]
+            for oid in qname[1:]:
+                vector = vector._children[oid]
+        else:
+            vector = get(path)
+        if type(vector) is not Vector:
+            raise ValueError('not a vector: {}'.format(path))
+        vector = vector.updated_(values, start)
+        validate(vector)
+        self._put(vector, tega_id, version, deepcopy=False)
+
     def delete(self, path, tega_id=None, version=None):
         '''
         DELETE operation.
@@ -581,7 +1040,7 @@ class tx:
             tega_id = self.tega_id
 
         if isinstance(path, Cont):
-            qname = path.qname_()
+            qname = path._qname_tuple()
         else:
             qname = path2qname(path)
 
@@ -605,11 +1064,12 @@ class tx:
             #
             root_oid = qname[0]
             prev_version, new_version, new_root, above_tail = self._copy_on_write(qname, above_tail=True)
+            self.qnames.setdefault(root_oid, []).append(tuple(qname))
             if above_tail:
                 oid = qname[-1]
                 instance = above_tail[oid]
                 #del above_tail[oid]
-                del above_tail.__dict__[oid]
+                del above_tail._children[oid]
                 if above_tail.is_empty_():
                     above_tail.delete_()
             else:
@@ -682,46 +1142,142 @@ class tx:
                                 format(subscriber))
                         channels[_path].remove(subscriber)
 
-def _fetch_root_with_version(root_oid, version):
-    root = _idb[root_oid]
+def _fetch_root_with_version(root_oid, version, snapshot=None):
+    '''
+    Returns the root of the version (the newest if None, relative to the
+    newest if negative), in the roots pinned by snapshot if any.
+    '''
+    if snapshot is None:
+        root = _idb[root_oid]
+    else:
+        root = snapshot.roots[root_oid]
     highest = root._version
     if version is None or version == highest:
         return root
-    else:
-        root = None
-        if version < 0:
-            version = highest + version
-        for tup in _old_roots[root_oid]:
-            if tup[0] == version:
-                root = tup[1]
-        if root:
-            return root
+    if version < 0:
+        version = highest + version
+    if version > highest:
+        raise KeyError
+    root = _old_roots[root_oid].get(version)
+    if root is None:
+        raise KeyError
+    return root
+
+def _index_subtree(index, node, path):
+    '''
+    Adds the path of the node and the paths of the Cont nodes under it to
+    the index.
+    '''
+    stack = [(node, path)]
+    while stack:
+        node, path = stack.pop()
+        index[path] = node
+        for k, v in node._children.items():
+            if type(v) is Cont and type(k) is str:
+                stack.append((v, path + '.' + k))
+
+def _unindex_subtree(index, node, path):
+    '''
+    Removes the path of the node and the paths of the Cont nodes under it
+    from the index.
+    '''
+    stack = [(node, path)]
+    while stack:
+        node, path = stack.pop()
+        index.pop(path, None)
+        for k, v in node._children.items():
+            if type(v) is Cont and type(k) is str:
+                stack.append((v, path + '.' + k))
+
+def _path_index(root, build=True):
+    '''
+    Returns the path index (dict, path: Cont node) of the current version
+    of a root, building it with a walk of the tree if build. Returns None
+    for the old versions and the roots not committed.
+
+    tx.commit() updates the index for the new version in place (see
+    _update_path_index()). The leaves are not indexed: they are looked up
+    in the parents.
+    '''
+    root_oid = root._oid
+    entry = _path_indexes.get(root_oid)
+    if entry is not None and entry[0] is root:
+        return entry[1]
+    if not build or not root._frozen or _idb.get(root_oid) is not root:
+        return None
+    index = {}
+    _index_subtree(index, root, root_oid)
+    _path_indexes[root_oid] = (root, index)
+    return index
+
+def _update_path_index(root_oid, old_root, new_root, qnames):
+    '''
+    Moves the index of the old root version to the new root version,
+    updating the paths put or deleted (qnames) and their parents copied on
+    write only.
+    '''
+    entry = _path_indexes.pop(root_oid, None)
+    if entry is None or entry[0] is not old_root or new_root is None or \
+            any(len(qname) == 1 for qname in qnames):
+        return  # built on demand
+    index = entry[1]
+    for qname in qnames:  # the old paths
+        path = root_oid
+        node = old_root
+        for oid in qname[1:]:
+            node = node._children.get(oid)
+            if type(node) is not Cont:
+                break
+            path = path + '.' + oid
+            index.pop(path, None)
         else:
-            raise KeyError
+            _unindex_subtree(index, node, path)
+    for qname in qnames:  # the new paths
+        path = root_oid
+        node = new_root
+        index[path] = node
+        for oid in qname[1:]:
+            node = node._children.get(oid)
+            if type(node) is not Cont:
+                break
+            path = path + '.' + oid
+            index[path] = node
+        else:
+            _index_subtree(index, node, path)
+    _path_indexes[root_oid] = (new_root, index)
 
 def _select(original, regex_qname, regex_groups):
     '''
     Selects children.
     '''
-    regex_oid = regex_qname[0]
-    for k, v in original.items():
-        m = re.match(regex_oid, k)
-        if m:
-            g = m.groups()
-            if g:
-                regex_groups_ = copy.copy(regex_groups)
-                regex_groups_.append(g)
-            else:
-                regex_groups_ = regex_groups
-            if isinstance(original, Cont) and len(regex_qname) > 1:
-                yield from _select(v, regex_qname[1:], regex_groups_)
-            else:
-                yield (qname2path(v.qname_()), v, regex_groups_)
+    stack = [(original, iter(original.items()), regex_qname, regex_groups)]
+    while stack:
+        original, items, regex_qname, regex_groups = stack[-1]
+        regex_oid = regex_qname[0]
+        for k, v in items:
+            m = re.match(regex_oid, k)
+            if m:
+                g = m.groups()
+                if g:
+                    regex_groups_ = copy.copy(regex_groups)
+                    regex_groups_.append(g)
+                else:
+                    regex_groups_ = regex_groups
+                if isinstance(original, Cont) and len(regex_qname) > 1:
+                    stack.append((v, iter(v.items()), regex_qname[1:],
+                        regex_groups_))
+                    break
+                else:
+                    yield (v.path_(), v, regex_groups_)
+        else:
+            stack.pop()
 
-def get(path, version=None, regex_flag=False):
+def get(path, version=None, regex_flag=False, snapshot=None):
     '''
     GET operation.
 
+    snapshot: Snapshot to read from (the newest roots if None).
+
     Raises KeyError if path is not found in idb.
     '''
     try:
@@ -729,14 +1285,16 @@ def get(path, version=None, regex_flag=False):
             regex_qname = path.split('\.')
             regex_oid = regex_qname[0]
             instances = []
-            for root_oid in _idb:
+            roots = _idb if snapshot is None else snapshot.roots
+            for root_oid in roots:
                 m = re.match(regex_oid, root_oid)
                 if m:
                     regex_groups = []
                     g = m.groups()
                     if g:
                         regex_groups.append(g)
-                    instance = _fetch_root_with_version(root_oid, version)
+                    instance = _fetch_root_with_version(root_oid, version,
+                            snapshot)
                     if len(regex_qname) > 1:
                         g = _select(instance, regex_qname[1:], regex_groups)
                         for match in g:
@@ -745,27 +1303,60 @@ def get(path, version=None, regex_flag=False):
                         instances.append((root_oid, instance, regex_groups))
             return instances
         else:
-            qname = path2qname(path)
-            root_oid = qname[0]
-            instance = _fetch_root_with_version(root_oid, version)
-            if len(qname) > 1:
-                for oid in qname[1:]:
-                    instance = instance.__dict__[oid]
-            return instance 
+            root_oid, sep, subpath = path.partition('.')
+            instance = _fetch_root_with_version(root_oid, version, snapshot)
+            if not sep:
+                return instance
+            index = _path_index(instance)
+            if index is not None:  # the parent in O(1)
+                parent, _, oid = path.rpartition('.')
+                return index[parent]._children[oid]
+            for oid in subpath.split('.'):
+                instance = instance._children[oid]
+            return instance
     except KeyError:
         raise
 
+def get_slice(path, start=None, stop=None, version=None):
+    '''
+    Returns the elements [start:stop] of the vector (Vector) on the path
+    as an array.array.
+    '''
+    vector = get(path, version)
+    if type(vector) is not Vector:
+        raise ValueError('not a vector: {}'.format(path))
+    return vector[start:stop]
+
 def get_version(path):
     '''
     Returns version of the tail node on the path.
     '''
     try:
         tail = get(path)
-        version = tail.__dict__['_version']
+        version = tail._version
         return version
     except KeyError:
         raise
 
+def _in_tree(instance):
+    '''
+    Returns True if the node is in the newest version of the tree or in
+    the old ones (shared with the readers).
+    '''
+    qname = instance._qname_tuple()
+    root_oid = qname[0]
+    roots = [root for version, root in _old_roots.get(root_oid, ())]
+    if root_oid in _idb:
+        roots.append(_idb[root_oid])
+    for node in roots:
+        for oid in qname[1:]:
+            node = node._children.get(oid)
+            if node is None:
+                break
+        if node is instance:
+            return True
+    return False
+
 def _collision_check(qname, version):
     '''
     Collision detection
@@ -785,11 +1376,50 @@ def _collision_check(qname, version):
         cont = _idb[root_oid]
     if cont and len(qname) > 1:
         for oid in qname[1:]:
-            cont = cont.__dict__[oid]
+            cont = cont._children[oid]
     if cont and cont._version == version:
         collision = False
     return collision
 
+class Snapshot(object):
+    '''
+    Snapshot handle (MVCC): pins the newest root of every root_oid at one
+    commit point, so that the reads through the handle are consistent across
+    the roots while the writers keep committing.
+
+    Usage example:
+
+        s = tega.idb.snapshot()
+        a = s.get('a.x')
+        b = s.get('b.y')  # of the same commit point as a.x
+    '''
+
+    __slots__ = ('id', 'roots', 'created')
+
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+        self.roots = dict(_idb)  # the roots are immutable once committed
+        self.created = time.time()
+
+    def get(self, path, version=None, regex_flag=False):
+        '''
+        GET operation on the pinned roots.
+        '''
+        return get(path, version=version, regex_flag=regex_flag,
+                snapshot=self)
+
+    def versions(self):
+        '''
+        Returns the versions of the pinned roots.
+        '''
+        return {k: v._version for k, v in self.roots.items()}
+
+def snapshot():
+    '''
+    Returns a Snapshot of the newest roots.
+    '''
+    return Snapshot()
+
 def roots():
     '''
     Lists roots
@@ -809,9 +1439,13 @@ def old():
         old_roots.append({k: version})
     return old_roots
 
-def rollback(tega_id, root_oid, backto, subscriber=None, write_log=True):
+def rollback(tega_id, root_oid, backto, subscriber=None, write_log=True,
+        durability=None):
     '''
     Rollbacks a specific root to a previous version
+
+    Returns a concurrent.futures.Future resolved when the commit log
+    has been made durable, or None if no log is written.
     '''
     next_version = _idb[root_oid]['_version'] + 1
 
@@ -829,89 +1463,566 @@ def rollback(tega_id, root_oid, backto, subscriber=None, write_log=True):
     version = pair[0]
     root = pair[1]
     align_vector(root)
-    root.__dict__['_version'] = next_version
+    set_meta(root, '_version', next_version)
     _idb[root_oid] = root
-    marker_rollback = '{} {} {}'.format(str(backto), tega_id, root_oid)
-    if _log_fd and write_log:
-        _log_fd.write(marker_rollback+'\n')
-        _log_fd.flush()
-        os.fsync(_log_fd)
-
+    future = None
+    durability = DURABILITY(durability or default_durability)
     log = log_entry(ope=OPE.ROLLBACK.name, path=root_oid, tega_id=tega_id,
             instance=None, backto=backto)
+    if write_log:
+        record = rollback_record(backto, tega_id, root_oid, next_version)
+        if _log_writer and durability != DURABILITY.MEMORY:
+            future = _log_writer.append(record,
+                    sync=durability == DURABILITY.FSYNC,
+                    versions={root_oid: next_version})
+        elif _log_writer:
+            _log_version_marker({root_oid: next_version})
+        _sync_buffer.append(root_oid, next_version, [log], len(record), future)
+
     notify_batch = {}
     for path_, subscriber in channels.items():
         if path_.split('.')[0] == root_oid:
             for s in subscribers:
                 notify_batch[s] = [log]
-    _notify_broadcast(notify_batch=notify_batch, subscriber=subscriber)
+    _notify_when_durable(future, notify_batch=notify_batch,
+            subscriber=subscriber)
+    return future
 
-def _timestamp(line):
+def _log_version_marker(versions):
     '''
-    Returns timestamp.
+    Logs the new versions of a commit not written to the commit log
+    (DURABILITY.MEMORY), so that the versions replayed after a restart
+    never go backwards.
     '''
-    return line.lstrip(COMMIT_FINISH_MARKER).rstrip('\n')
-    
-def reload_log():
+    _log_writer.append(tx_record([], str(now()), versions), sync=False,
+            versions=versions)
+
+def _replay_version(root_oid, version):
     '''
-    Reloads log to reorganize a tree in idb
+    Replays a version-only marker: the root takes the version of the
+    commit that was not written to the commit log.
     '''
-    PUT = OPE.PUT
-    DELETE = OPE.PUT
-    SS = OPE.SS
+    root = _idb.get(root_oid)
+    if root is not None and root._version < version:
+        set_meta(root, '_version', version)
 
-    t = None 
-    multi = []
+def _is_snapshot_record(type_, record):
+    return type_ == RECORD_TX and len(record['logs']) > 0 and \
+            all([log['ope'] == OPE.SS.name for log in record['logs']])
+
+def _replay_start():
+    '''
+    Returns the number of the first commit log segment to replay and
+    the snapshot file to load beforehand (None if no snapshot is found).
+
+    A segment starting with snapshot records (written by older versions of
+    tega) is also a starting point.
+    '''
+    max_ = commit_log_number(server_tega_id, _log_dir)
+    for num in reversed(range(0, max_ + 1)):
+        ss_file = os.path.join(_log_dir,
+                _snapshot_filename(server_tega_id, num))
+        if os.path.exists(ss_file):
+            return num, ss_file
+        log_file = os.path.join(_log_dir,
+                _commit_log_filename(server_tega_id, num))
+        if os.path.exists(log_file):
+            with open(log_file, 'rb') as fd:
+                for type_, record in read_records(fd):
+                    if _is_snapshot_record(type_, record):
+                        return num, None
+                    break
+    return 0, None
 
-    _log_fd.seek(0)
-    for line in _log_fd:
-        line = line.rstrip('\n')
-        if line.startswith(ROLLBACK_MARKER):
-            args = line.split(' ')
-            rollback(args[1], args[2], int(args[0]), write_log=False)
-        elif line.startswith(COMMIT_FINISH_MARKER) and len(multi) > 0:
-            timestamp = _timestamp(line)
-            t = tx()
-            put = t.put
-            delete = t.delete
-            for crud in multi:
-                ope = crud[0]
-                if ope == PUT:
-                    instance = crud[1]
-                    tega_id = crud[2]
-                    put(instance, tega_id=tega_id, deepcopy=False)
-                elif ope == DELETE:
-                    path = crud[1]
-                    tega_id = crud[2]
-                    delete(path, tega_id=tega_id)
-            t.commit(write_log=False)
-            del multi[:]
-        elif line.startswith(COMMIT_FINISH_MARKER):
-            pass
-        elif line.startswith(COMMIT_START_MARKER) or line.startswith(SYNC_CONFIRMED_MARKER):
-            pass
+def _replay_tx(logs):
+    '''
+    Replays the PUT/DELETE log entries as a transaction.
+    '''
+    t = tx()
+    for log in logs:
+        ope = log['ope']
+        path = log['path']
+        instance = log['instance']
+        tega_id = log['tega_id']
+        if ope == OPE.PUT.name:
+            if path:
+                root = subtree(path, instance, freeze=True)
+            else:
+                root = dict2cont(instance, freeze=True)
+            t.put(root, tega_id=tega_id, deepcopy=False)
+        elif ope == OPE.DELETE.name:
+            t.delete(path, tega_id=tega_id)
+    t.commit(write_log=False)
+
+class _Recovery(object):
+    '''
+    Bulk recovery: applies the replayed transactions to mutable trees
+    without copy-on-write, and freezes the trees once at the end.
+
+    The last "window" transactions of every root are deferred and replayed
+    as normal transactions at the end, so that the old roots are kept as if
+    every transaction had been replayed one by one. A root is replayed
+    normally after a rollback, since a rollback needs the old roots.
+    '''
+
+    def __init__(self, window):
+        self.window = window
+        self.roots = {}  # {root_oid: mutable root (None if deleted)}
+        self.deferred = {}  # {root_oid: deque([logs, ...])}
+        self.normal = set()  # roots replayed normally
+
+    def snapshot(self, root_oid, instance):
+        '''
+        Loads a root from a snapshot.
+        '''
+        self.roots.pop(root_oid, None)
+        self.deferred.pop(root_oid, None)
+        self.normal.discard(root_oid)
+        _idb[root_oid] = deserialize(instance)
+
+    def transaction(self, logs):
+        '''
+        Replays a transaction, root by root.
+        '''
+        by_root = collections.OrderedDict()
+        for log in logs:
+            root_oid = log['path'].split('.')[0]
+            by_root.setdefault(root_oid, []).append(log)
+        normal = []
+        for root_oid, logs_ in by_root.items():
+            if root_oid in self.normal:
+                normal.extend(logs_)
+                continue
+            if not root_oid in self.deferred:
+                self.deferred[root_oid] = collections.deque()
+            deferred = self.deferred[root_oid]
+            deferred.append(logs_)
+            if len(deferred) > self.window:
+                self._apply(root_oid, deferred.popleft())
+        if normal:
+            _replay_tx(normal)
+
+    def version(self, root_oid, version):
+        self._finish(root_oid)
+        _replay_version(root_oid, version)
+
+    def rollback(self, record):
+        root_oid = record['root_oid']
+        self._finish(root_oid)
+        rollback(record['tega_id'], root_oid, record['backto'],
+                write_log=False)
+
+    def finish(self):
+        '''
+        Freezes the mutable trees and replays the deferred transactions.
+        '''
+        for root_oid in list(self.deferred):
+            self._finish(root_oid)
+
+    def _finish(self, root_oid):
+        if root_oid in self.roots:
+            root = self.roots.pop(root_oid)
+            if root is None:
+                _idb.pop(root_oid, None)
+            else:
+                root.freeze_()
+                _idb[root_oid] = root
+        for logs in self.deferred.pop(root_oid, []):
+            _replay_tx(logs)
+        self.normal.add(root_oid)
+
+    def _apply(self, root_oid, logs):
+        '''
+        Applies the log entries of a root in place, setting the version of
+        the nodes on the paths like copy-on-write does.
+        '''
+        if root_oid in self.roots:
+            root = self.roots[root_oid]
         else:
-            log = eval(line)
-            ope = log['ope']
-            path = log['path']
-            instance = log['instance']
-            tega_id = log['tega_id']
-            if ope == PUT.name:
-                if path:
-                    root = subtree(path, instance)
+            root = _idb.get(root_oid)
+            if root is not None and root._frozen:
+                root = root.deepcopy_()
+        version = 0 if root is None else root._version + 1
+        for log in logs:
+            qname = path2qname(log['path'])
+            if log['ope'] == OPE.PUT.name:
+                instance = subtree(log['path'], log['instance'])
+                _instance_version_set(instance, version)
+                if len(qname) == 1:
+                    root = instance
+                    continue
+                above_tail = self._path(root_oid, root, qname, version)
+                root = above_tail.root_()
+                instance.change_(above_tail)
+            elif log['ope'] == OPE.DELETE.name:
+                if len(qname) == 1:
+                    root = None
+                    continue
+                above_tail = self._path(root_oid, root, qname, version)
+                root = above_tail.root_()
+                above_tail._children.pop(qname[-1], None)
+                if above_tail.is_empty_():
+                    above_tail.delete_()
+        self.roots[root_oid] = root
+
+    def _path(self, root_oid, root, qname, version):
+        '''
+        Returns the parent node of the qname, extending the path.
+        '''
+        if root is None:
+            root = Cont(root_oid)
+        node = root
+        set_meta(node, '_version', version)
+        for iid in qname[1:-1]:
+            node = node._extend(iid)
+            set_meta(node, '_version', version)
+        return node
+
+def _replay(fd, recovery=None, partition=None, index=None):
+    '''
+    Replays the records in a commit log segment or a snapshot.
+    If recovery (_Recovery) is given, the records are replayed in bulk.
+
+    If partition (a function of root_oid) is given, only the roots for which
+    it returns True are replayed. index is the version index of the segment
+    used to skip the records of the other roots without decoding them.
+
+    Returns the number of the records replayed.
+    '''
+    SS = OPE.SS.name
+
+    skip = set()
+    if index:
+        own = set()
+        for root_oid, version, offset in index:
+            if partition(root_oid):
+                own.add(offset)
+            else:
+                skip.add(offset)
+        skip -= own
+
+    records = 0
+    with SegmentReader(fd) as reader:
+        for offset, type_, payload in reader.records():
+            records += 1
+            if offset in skip:
+                continue
+            record = decode_payload(payload)
+            if type_ == RECORD_ROLLBACK:
+                if partition and not partition(record['root_oid']):
+                    continue
+                if recovery:
+                    recovery.rollback(record)
                 else:
-                    root = dict2cont(instance)
-                multi.append((PUT, root, tega_id))
-            elif ope == DELETE.name:
-                multi.append((DELETE, path, tega_id))
-            elif ope == SS.name:
-                root_oid = instance['_oid']
-                root = deserialize(instance)
-                _idb[root_oid] = root
+                    rollback(record['tega_id'], record['root_oid'],
+                            record['backto'], write_log=False)
+            elif type_ == RECORD_TX:
+                logs = []
+                for log in record['logs']:
+                    if partition and not partition(log['path'].split('.')[0]):
+                        continue
+                    if log['ope'] == SS:
+                        instance = log['instance']
+                        if recovery:
+                            recovery.snapshot(instance['_oid'], instance)
+                        else:
+                            _idb[instance['_oid']] = deserialize(instance)
+                    else:
+                        logs.append(log)
+                if logs:
+                    if recovery:
+                        recovery.transaction(logs)
+                    else:
+                        _replay_tx(logs)
+                elif not record['logs']:  # version-only marker
+                    for root_oid, version in \
+                            record_versions(type_, record).items():
+                        if partition and not partition(root_oid):
+                            continue
+                        if recovery:
+                            recovery.version(root_oid, version)
+                        else:
+                            _replay_version(root_oid, version)
+    return records
 
-def loglist_for_sync(root_oid, version):
+def _replay_files():
     '''
-    Accumulates log entries until the version.
+    Returns the snapshot file and the commit log segments to be replayed
+    if tega db restarted now.
+    '''
+    num, ss_file = _replay_start()
+    files = [ss_file] if ss_file else []
+    max_ = commit_log_number(server_tega_id, _log_dir)
+    for i in range(num, max_ + 1):
+        log_file = os.path.join(_log_dir, _commit_log_filename(server_tega_id, i))
+        if os.path.exists(log_file):
+            files.append(log_file)
+    return files
+
+def _partition(root_oid, part, parts):
+    return zlib.crc32(root_oid.encode('utf-8')) % parts == part
+
+def _recovery_window():
+    '''
+    Returns the number of the last transactions of a root replayed normally
+    on recovery, so that the old roots are kept (OLD_ROOTS_LEN if the old
+    roots are limited by bytes or age only).
+    '''
+    return OLD_ROOTS_LEN if old_roots_len is None else old_roots_len
+
+def _replay_partition(log_dir, tega_id, files, part, parts, retention):
+    '''
+    Replays the roots in a partition in a worker process of reload_log().
+    retention is (old_roots_len, old_roots_bytes, old_roots_age).
+
+    Returns the roots and the old roots packed by pack_trees() and
+    the number of the records in the last file.
+    '''
+    global _log_dir, _log_fd, _log_writer, server_tega_id
+    global old_roots_len, old_roots_bytes, old_roots_age
+    _log_dir = log_dir
+    server_tega_id = tega_id
+    old_roots_len, old_roots_bytes, old_roots_age = retention
+    _log_fd = _log_writer = None  # belong to the parent process
+    _idb.clear()
+    _old_roots.clear()
+
+    partition = lambda root_oid: _partition(root_oid, part, parts)
+    recovery = _Recovery(_recovery_window())
+    records = 0
+    for filename, index_file in files:
+        index = None
+        if index_file and os.path.exists(index_file):
+            with open(index_file, 'rb') as fd:
+                index = list(read_index(fd))
+        with open(filename, 'rb') as fd:
+            records = _replay(fd, recovery, partition, index)
+    recovery.finish()
+
+    trees = []
+    layout = {}
+    for root_oid in set(_idb) | set(_old_roots):
+        index = None
+        if root_oid in _idb:
+            index = len(trees)
+            trees.append(_idb[root_oid])
+        old = []
+        old_roots = _old_roots.get(root_oid)
+        for version, old_root in old_roots or ():
+            old.append((version, len(trees), old_roots.size(version)))
+            trees.append(old_root)
+        layout[root_oid] = (index, old)
+    return layout, pack_trees(trees), records
+
+def _reload_parallel(files, processes):
+    '''
+    Replays the roots partitioned by root_oid in a process pool, and returns
+    the number of the records in the last file.
+    '''
+    files_ = []
+    for filename in files:
+        num = os.path.basename(filename).split('.')[-1]
+        index_file = None
+        if os.path.basename(filename).startswith('log.'):
+            index_file = os.path.join(_log_dir,
+                    _index_filename(server_tega_id, num))
+        files_.append((filename, index_file))
+
+    records = 0
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(_replay_partition, _log_dir, server_tega_id,
+            files_, part, processes,
+            (old_roots_len, old_roots_bytes, old_roots_age))
+            for part in range(processes)]
+        for future in futures:
+            layout, packed, records = future.result()
+            trees = unpack_trees(packed)
+            for root_oid, (index, old) in layout.items():
+                if index is not None:
+                    _idb[root_oid] = trees[index]
+                if old:
+                    _old_roots[root_oid] = _new_old_roots()
+                    for version, index, size in old:
+                        _old_roots[root_oid].append((version, trees[index]),
+                                size)
+    return records
+
+def reload_log(bulk=True, processes=1):
+    '''
+    Reloads log to reorganize a tree in idb
+
+    Loads the latest snapshot and replays the commit log segments after it.
+    If bulk is True, the transactions are replayed in bulk recovery mode
+    (see _Recovery). The replay throughput is measured for replay_estimate().
+
+    If processes > 1, the roots are replayed in parallel by a process pool
+    (in bulk recovery mode), unless the files to replay are smaller than
+    PARALLEL_REPLAY_MIN_BYTES or the log writer thread is already running
+    (forking a process running threads may deadlock).
+    '''
+    global _replay_rate
+    started = time.time()
+    files = _replay_files()
+    size = sum([os.path.getsize(filename) for filename in files])
+    records = 0
+    forkable = not (_log_writer and _log_writer.running)
+    if processes > 1 and size >= PARALLEL_REPLAY_MIN_BYTES and forkable:
+        records = _reload_parallel(files, processes)
+    else:
+        recovery = _Recovery(_recovery_window()) if bulk else None
+        for filename in files:
+            with open(filename, 'rb') as fd:
+                records = _replay(fd, recovery)
+        if recovery:
+            recovery.finish()
+    elapsed = time.time() - started
+    if _log_writer:
+        _log_writer.segment_records = records  # records in the last segment
+    if size > len(MAGIC) and elapsed > 0:
+        _replay_rate = size / elapsed
+
+def segment_stats():
+    '''
+    Returns the size, the number of records and the age (sec) of the current
+    commit log segment.
+
+    The age is counted from when the segment was opened by this process.
+    '''
+    num = commit_log_number(server_tega_id, _log_dir)
+    log_file = os.path.join(_log_dir, _commit_log_filename(server_tega_id, num))
+    try:
+        size = os.path.getsize(log_file)
+    except FileNotFoundError:
+        size = 0
+    return {'segment': num,
+            'bytes': size,
+            'records': _log_writer.segment_records,
+            'age': time.time() - _log_writer.segment_started}
+
+def replay_estimate():
+    '''
+    Estimates how long reload_log() would take if tega db restarted now,
+    from the size of the files to replay and the replay throughput measured
+    at the last reload ('seconds' is None if it has not been measured).
+    '''
+    files = _replay_files()
+    size = sum([os.path.getsize(filename) for filename in files])
+    seconds = None
+    if _replay_rate:
+        seconds = size / _replay_rate
+    return {'files': len(files),
+            'bytes': size,
+            'rate': _replay_rate,
+            'seconds': seconds}
+
+def prune_segments(retain=1, archive_dir=None):
+    '''
+    Deletes the commit log segments and the snapshots made redundant by
+    the newest "retain" snapshots, or moves them to archive_dir.
+
+    Returns the file names pruned.
+    '''
+    if retain < 1:
+        raise ValueError('retain must be 1 or more')
+    max_ = commit_log_number(server_tega_id, _log_dir)
+    retained = [num for num in range(0, max_ + 1)
+            if os.path.exists(os.path.join(_log_dir,
+                _snapshot_filename(server_tega_id, num)))][-retain:]
+    if len(retained) < retain:
+        return []
+    pruned = []
+    for num in range(0, retained[0]):
+        ss_filename = _snapshot_filename(server_tega_id, num)
+        for filename in (_commit_log_filename(server_tega_id, num),
+                _index_filename(server_tega_id, num),
+                ss_filename, ss_filename + '.tmp'):
+            path = os.path.join(_log_dir, filename)
+            try:
+                if archive_dir:
+                    shutil.move(path, os.path.join(archive_dir, filename))
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+            pruned.append(filename)
+    if pruned:
+        logging.info('pruned commit logs: {}'.format(pruned))
+    return pruned
+
+def _record2notifications(root_oid, type_, record):
+    '''
+    Returns the notifications of a commit log record on the root.
+    '''
+    if type_ == RECORD_ROLLBACK:
+        if record['root_oid'] != root_oid:
+            return []
+        return [log_entry(ope=OPE.ROLLBACK.name, path=root_oid,
+                tega_id=record['tega_id'], instance=None,
+                backto=record['backto'])]
+    notifications = []
+    for log in record['logs']:
+        ope = log['ope']
+        path = log['path']
+        if ope != OPE.SS.name and path.split('.')[0] == root_oid:
+            notifications.append(log_entry(ope=ope, path=path,
+                tega_id=log['tega_id'], instance=log['instance']))
+    return notifications
+
+def _index_lookup(root_oid, version):
+    '''
+    Returns (segment number, offset) of the record creating the version of
+    the root, looking up the version indexes from the newest segment.
+
+    Returns None if the version is not indexed.
+    '''
+    max_ = commit_log_number(server_tega_id, _log_dir)
+    for num in reversed(range(0, max_ + 1)):
+        index_file = os.path.join(_log_dir,
+                _index_filename(server_tega_id, num))
+        if not os.path.exists(index_file):
+            return None
+        oldest = None
+        with open(index_file, 'rb') as fd:
+            for root_oid_, version_, offset in read_index(fd):
+                if root_oid_ != root_oid:
+                    continue
+                if version_ == version:
+                    return num, offset
+                if oldest is None:
+                    oldest = version_
+        if oldest is not None and oldest < version:
+            return None  # not logged (e.g., DURABILITY.MEMORY)
+    return None
+
+def _loglist_forward(root_oid, num, offset, version):
+    '''
+    Accumulates log entries from the offset of the segment "num" to the end
+    of the commit log. The record at the offset must create the version.
+
+    Returns None if the record does not match (e.g., the segment has been
+    compressed after the index lookup).
+    '''
+    multi = []
+    max_ = commit_log_number(server_tega_id, _log_dir)
+    for i in range(num, max_ + 1):
+        log_file = os.path.join(_log_dir, _commit_log_filename(server_tega_id, i))
+        if not os.path.exists(log_file):
+            continue
+        with open(log_file, 'rb') as fd:
+            for type_, record in read_records(fd, offset if i == num else None):
+                if version is not None:
+                    if record_versions(type_, record).get(root_oid) != version:
+                        return None  # the segment has been rewritten
+                    version = None
+                notifications = _record2notifications(root_oid, type_, record)
+                if notifications:
+                    multi.append(notifications)
+    return multi
+
+def _loglist_reverse(root_oid, version, version_):
+    '''
+    Accumulates log entries scanning the commit log backwards from
+    the current version (version_) until the version.
 
     log.global.0       log.global.l       log.global.n
     +------------+     +------------+     +------------+ ^
@@ -922,7 +2033,41 @@ def loglist_for_sync(root_oid, version):
     +------------+     +------------+ |   +------------+ |
     '''
     multi = []
-    notifications = []
+    max_ = commit_log_number(server_tega_id, _log_dir)
+
+    while max_ >= 0:
+        filename = _commit_log_filename(server_tega_id, max_)
+        log_file = os.path.join(_log_dir, filename)
+        max_ -= 1
+        if not os.path.exists(log_file):
+            continue
+
+        with open(log_file, 'rb') as fd:
+            for type_, record in read_records_reverse(fd):
+                notifications = _record2notifications(root_oid, type_, record)
+                if not notifications:
+                    continue
+                multi.insert(0, notifications)
+                version_ -= 1
+                if version_ <= version:
+                    return multi
+
+    # The segments before the version have been pruned: the whole root
+    # is sent in one transaction instead.
+    root = _idb[root_oid]
+    instance = root.serialize_(serialize_ephemeral=False, encode_vectors=True)
+    return [[log_entry(ope=OPE.PUT.name, path=root_oid, tega_id=server_tega_id,
+        instance=instance)]]
+
+def loglist_for_sync(root_oid, version):
+    '''
+    Accumulates log entries after the version.
+
+    The record creating the next version is looked up in the version
+    indexes, and the commit log is read forward from it. The commit log is
+    scanned backwards if the version is not indexed.
+    '''
+    multi = []
     if version < 0:
         version = -1
     try:
@@ -932,72 +2077,12 @@ def loglist_for_sync(root_oid, version):
     if version_ <= version:
         return multi 
 
-    max_ = commit_log_number(server_tega_id, _log_dir)
-
-    continue_ = True
-    begin = False
-    match = False
-
-    while continue_ and max_ >= 0:
-        filename = _commit_log_filename(server_tega_id, max_)
-        log_file = os.path.join(_log_dir, filename)
-        max_ -= 1
-
-        with open(log_file, 'r') as fd:
-            g = readline_reverse(fd)
-            while True:
-                try:
-                    line = next(g).rstrip('\n')
-                except StopIteration:
-                    break
-
-                if line == '':
-                    pass
-                elif line.startswith(COMMIT_FINISH_MARKER):
-                    begin = True
-                elif line.startswith(COMMIT_START_MARKER):
-                    begin = False
-                    if match:
-                        version_ -= 1
-                        match = False
-                        multi.insert(0, notifications)
-                        notifications = []
-                    if version_ <= version:
-                        continue_ = False
-                        break
-                elif line.startswith(ROLLBACK_MARKER):
-                    args = line.split(' ')
-                    root_oid_ = args[2]
-                    if root_oid_ == root_oid:
-                        backto = args[0]
-                        tega_id = args[1]
-                        log = log_entry(ope=OPE.ROLLBACK.name, path=root_oid,
-                                tega_id=tega_id, instance=None,
-                                backto=int(backto))
-                        if notifications:
-                            multi.insert(0, notifications)
-                        notifications = [log]
-                        multi.insert(0, notifications)
-                        notifications = []
-                        version_ -= 1
-                        if version_ <= version:
-                            continue_ = False
-                            break
-                elif begin:
-                    log = eval(line)
-                    ope = log['ope']
-                    path = log['path']
-                    tega_id = log['tega_id']
-                    instance = log['instance']
-                    if ope == OPE.SS.name:
-                        pass
-                    elif path.split('.')[0] == root_oid:
-                        match = True
-                        log = log_entry(ope=ope, path=path, tega_id=tega_id,
-                                instance=instance)
-                        notifications.insert(0, log)
-
-    return multi 
+    location = _index_lookup(root_oid, version + 1)
+    if location:
+        multi = _loglist_forward(root_oid, *location, version=version + 1)
+        if multi is not None:
+            return multi
+    return _loglist_reverse(root_oid, version, version_)
 
 def crud_batch(notifications, subscriber=None):
     '''
@@ -1009,7 +2094,7 @@ def crud_batch(notifications, subscriber=None):
             path = crud['path']
             tega_id = crud['tega_id']
             if ope == OPE.PUT.name:
-                instance = subtree(path, crud['instance'])
+                instance = subtree(path, crud['instance'], freeze=True)
                 t.put(instance, tega_id=tega_id, deepcopy=False)
             elif ope == OPE.DELETE.name:
                 t.delete(path, tega_id=tega_id)
@@ -1017,9 +2102,15 @@ def crud_batch(notifications, subscriber=None):
                 backto = crud['backto']
                 rollback(tega_id, path, backto, subscriber=subscriber)
 
+@gen.coroutine
 def sync(root_oid, version, subscriber):
     '''
     Leader-Follower synchronization on the root_oid.
+
+    The transactions after the version are served from the buffer of
+    recent transactions, or read from the commit log if they have been
+    evicted from it. The coroutine waits for the transactions to be
+    durable without blocking the IOLoop.
     '''
     global _idb
     logging.debug(
@@ -1030,7 +2121,15 @@ def sync(root_oid, version, subscriber):
         version_ = _idb[root_oid]['_version']
 
     if version_ > version:  # out of sync
-        multi = loglist_for_sync(root_oid, version)
+        hit = _sync_buffer.since(root_oid, version)
+        if hit:
+            multi, future = hit
+            if future:
+                yield future  # the transactions are durable
+        else:
+            if _log_writer:
+                yield _log_writer.flush()  # the log catches up with idb
+            multi = loglist_for_sync(root_oid, version)
         for notifications in multi:
             subscriber.on_notify(notifications)
     else:  # in sync
@@ -1050,33 +2149,95 @@ def _transactions2notifications(transactions):
         accumulated.extend(batch[1])
     return accumulated
 
-def save_snapshot(tega_id):
+def _write_snapshot(ss_file, roots, tega_id, progress):
+    '''
+    Serializes the roots and writes them to a snapshot file.
+
+    The file is written as "<ss_file>.tmp" and then renamed, so that
+    an incomplete snapshot is never loaded.
+    '''
+    tmp = ss_file + '.tmp'
+    with open(tmp, 'wb') as fd:
+        fd.write(MAGIC)
+        for root_oid, root in roots.items():
+            instance = root.serialize_(internal=True, serialize_ephemeral=False,
+                    encode_vectors=True)
+            log = log_entry(ope=OPE.SS.name, path=root_oid, tega_id=tega_id,
+                    instance=instance)
+            fd.write(tx_record([log], str(now()), compress=_compression))
+            progress['saved'] += 1
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.rename(tmp, ss_file)
+
+def save_snapshot(tega_id, background=True):
     '''
     Take a snapshot of _idb and saves it to the hard disk.
+
+    The commit log is switched to a new segment "n" and the current roots,
+    which are immutable (copy-on-write), are written to the snapshot file
+    "ss.<tega_id>.<n>" in a background thread while new transactions are
+    committed to the new segment.
+
+    Returns a concurrent.futures.Future resolved when the snapshot file is
+    complete. If a snapshot is ongoing, its Future is returned.
     '''
-    global _log_fd
-    _idb_snapshot = {}
-    for root_oid in _idb:
-        _idb_snapshot[root_oid] = _idb[root_oid].serialize_(internal=True,
-                serialize_ephemeral=False)
+    global _log_fd, _snapshot_future, _snapshot_progress
+    if _snapshot_future and not _snapshot_future.done():
+        return _snapshot_future
 
-    num = commit_log_number(server_tega_id, _log_dir)
-    filename = _commit_log_filename(server_tega_id, num+1)
-    log_file = os.path.join(_log_dir, filename)
-    if _log_fd:
-        _log_fd.close()
-    _log_fd = open(log_file, 'a+')  # append-only file
-
-    finish_marker = COMMIT_FINISH_MARKER+'{}'.format(now())
-
-    _log_fd.write(COMMIT_START_MARKER+'\n')  # commit start
-    for root_oid, instance in _idb_snapshot.items():
-        log = log_entry(ope=OPE.SS.name, path=root_oid, tega_id=tega_id, instance=instance)
-        log = str(log)
-        _log_fd.write(log+'\n')
-    _log_fd.write(finish_marker+'\n')  # commit finish marker
-    _log_fd.flush()
-    os.fsync(_log_fd)
+    roots = dict(_idb)
+
+    num = commit_log_number(server_tega_id, _log_dir) + 1
+    log_file = os.path.join(_log_dir, _commit_log_filename(server_tega_id, num))
+    _log_fd = _open_log(log_file)
+    rotated = _log_writer.rotate(_log_fd, _open_index(num))
+
+    ss_file = os.path.join(_log_dir, _snapshot_filename(server_tega_id, num))
+    progress = {'segment': num, 'state': 'running', 'roots': len(roots),
+                'saved': 0, 'started': str(now()), 'finished': None}
+    future = Future()
+    _snapshot_progress = progress
+    _snapshot_future = future
+
+    def _save():
+        try:
+            _write_snapshot(ss_file, roots, tega_id, progress)
+            if _compression:
+                rotated.result()  # the previous segment is sealed
+                _compress_segment(num - 1)
+            progress['state'] = 'done'
+            progress['finished'] = str(now())
+            future.set_result(ss_file)
+        except Exception as e:
+            logging.exception('snapshot failed')
+            progress['state'] = 'failed'
+            progress['finished'] = str(now())
+            future.set_exception(e)
+
+    if background:
+        threading.Thread(target=_save, name='tega-snapshot',
+                daemon=True).start()
+    else:
+        _save()
+    return future
+
+def _compress_segment(num):
+    '''
+    Compresses the sealed commit log segment "num".
+    '''
+    log_file = os.path.join(_log_dir, _commit_log_filename(server_tega_id, num))
+    index_file = os.path.join(_log_dir, _index_filename(server_tega_id, num))
+    if os.path.exists(log_file):
+        size, compressed_size = compress_segment(log_file, index_file)
+        logging.info('compressed {}: {} -> {} bytes'.format(log_file, size,
+            compressed_size))
+
+def snapshot_progress():
+    '''
+    Returns the progress of the ongoing (or last) snapshot.
+    '''
+    return dict(_snapshot_progress)
 
 def publish(channel, tega_id, message, subscriber):
     '''
@@ -0,0 +1,175 @@
+'''
+Schema validation
+
+A schema (see doc/memo/schema_sample.json) is compiled once into a
+Validator per path, and the validators are looked up by the qname pattern
+of a node: the qname without the ids of list entries (frozendict oids),
+which stay at the level of their parent in the schema.
+
+tega.idb.tx.put() validates a PUT subtree in one pass, and
+tega.idb.tx.update_vector() the updated vector. The roots not in the schema
+are schema-less.
+
+Schema
+------
+{"schema":
+   {"root":
+      {"a": {"type": "str"},
+       "c": {"d": {"id": {"type": "int"}}},
+       ...
+      }
+   }
+}
+
+A node having "type" is a leaf, and the others are containers. The keys
+starting with "_" (e.g., "_indexes") are not children.
+
+Usage example:
+
+    tega.schema.load_file('schema_sample.json')
+'''
+
+from tega.tree import Cont, Bool, RPC, Vector
+
+from collections.abc import Mapping
+import json
+
+# Python types of the leaf types in a schema
+_TYPES = {
+        'str': (str,),
+        'int': (int,),
+        'float': (float,),
+        'complex': (complex,),
+        'tuple': (tuple, list),
+        'list': (tuple, list),  # a list is kept as a tuple
+        'bool': (bool,),
+        'Func': (),
+        'vector': ()
+        }
+
+_validators = None  # qname pattern -> Validator
+_roots = frozenset()
+
+class SchemaError(ValueError):
+    '''
+    Schema violation.
+    '''
+    pass
+
+class Validator(object):
+    '''
+    Validator of the nodes on a path of the schema: a leaf (types) or a
+    container (children).
+    '''
+
+    __slots__ = ('types', 'children')
+
+    def __init__(self, types=frozenset(), children=None):
+        self.types = types
+        self.children = children
+
+def _leaf_types(type_):
+    '''
+    Returns the types of the leaves of a schema type, incl. the wrapped
+    ones.
+    '''
+    if type_ not in _TYPES:
+        raise ValueError('unknown schema type: {}'.format(type_))
+    types = set(_TYPES[type_])
+    types.update(Cont._types[t] for t in _TYPES[type_] if t in Cont._types)
+    if type_ == 'bool':
+        types.add(Bool)
+    elif type_ == 'Func':
+        types.add(RPC)
+    elif type_ == 'vector':
+        types.add(Vector)
+    return frozenset(types)
+
+def compile_(schema):
+    '''
+    Compiles a schema into a dict: qname pattern -> Validator.
+    '''
+    if 'schema' in schema:
+        schema = schema['schema']
+    validators = {}
+    stack = [((k, ), v) for k, v in schema.items()]
+    while stack:
+        pattern, spec = stack.pop()
+        if 'type' in spec:
+            validators[pattern] = Validator(types=_leaf_types(spec['type']))
+        else:
+            children = {}
+            validators[pattern] = Validator(children=children)
+            for k, v in spec.items():
+                if not k.startswith('_'):
+                    stack.append((pattern + (k,), v))
+        parent = validators.get(pattern[:-1])
+        if parent is not None:
+            parent.children[pattern[-1]] = validators[pattern]
+    return validators
+
+def load(schema):
+    '''
+    Compiles a schema (dict) and enables the validation.
+    '''
+    global _validators, _roots
+    validators = compile_(schema)
+    _roots = frozenset(k[0] for k in validators)
+    _validators = validators
+
+def load_file(filename):
+    '''
+    Loads a schema from a JSON file.
+    '''
+    with open(filename) as f:
+        load(json.load(f))
+
+def clear():
+    '''
+    Disables the validation.
+    '''
+    global _validators, _roots
+    _validators = None
+    _roots = frozenset()
+
+def _violation(node):
+    path = '.'.join(str(k) for k in node._qname_tuple())
+    if isinstance(node, Cont) and node._children:
+        return SchemaError('schema violation, {}'.format(path))
+    return SchemaError('schema violation, {}:{}'.format(path, node))
+
+def validate(instance):
+    '''
+    Validates a subtree (Cont or a leaf) against the schema, raising
+    SchemaError on violation.
+    '''
+    if _validators is None:
+        return
+    qname = instance._qname_tuple()
+    if qname[0] not in _roots:
+        return  # schema-less
+    pattern = tuple(k for k in qname if not isinstance(k, Mapping))
+    validator = _validators.get(pattern)
+    if validator is None:
+        raise _violation(instance)
+    stack = [(instance, validator)]
+    while stack:
+        node, validator = stack.pop()
+        if type(node) is not Cont:  # a leaf
+            if type(node) not in validator.types:
+                raise _violation(node)
+            continue
+        children = validator.children
+        if children is None:
+            raise _violation(node)
+        for k, v in node._children.items():
+            if isinstance(k, Mapping):  # an entry of a list
+                stack.append((v, validator))
+                continue
+            child = children.get(k)
+            if child is None:
+                raise _violation(v)
+            if type(v) is Cont:
+                stack.append((v, child))
+            elif type(v) not in child.types:
+                raise _violation(v)
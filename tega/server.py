@@ -1,12 +1,17 @@
 from tega.env import PORT, HEADERS, TRANSACTION_GC_PERIOD, DATA_DIR,\
+        COMPACTION_CHECK_PERIOD, OLD_ROOTS_EXPIRE_PERIOD,\
         WEBSOCKET_PUBSUB_URL, LOGO, CONNECT_RETRY_TIMER,\
         REQUEST_TIMEOUT
+from tega.compaction import CompactionPolicy
 import tega.idb
-from tega.idb import tx, clear, roots, old, NonLocalRPC
+from tega.idb import tx, clear, roots, old, stats, NonLocalRPC, DURABILITY
 from tega.messaging import build_parser, parse_rpc_body, request, on_response, REQUEST_TYPE
+import tega.schema
+from tega.schema import SchemaError
 import tega.subscriber
 from tega.subscriber import Subscriber, SCOPE
-from tega.tree import Cont, is_builtin_type
+from tega.syncbuffer import SYNC_BUFFER_BYTES
+from tega.tree import Cont, is_builtin_type, JSON_CACHE_BYTES, set_json_cache_limit
 from tega.util import url2path, qname2path, subtree, str2bool
 
 from tornado import gen
@@ -18,6 +23,7 @@ import argparse
 import httplib2
 import json
 import logging
+import os
 import socket
 import sys
 from threading import RLock
@@ -28,6 +34,7 @@ import uuid
 import yaml
 
 transactions = {}
+snapshots = {}  # snapshot handles (tega.idb.Snapshot) pinned by REST clients
 tx_lock = RLock()
 
 ghost = None
@@ -35,6 +42,7 @@ gport = None
 sync_path = None
 server_as_subscriber = None
 server_tega_id = None
+compaction_policy = None
 
 subscriber_clients = {}
 
@@ -51,6 +59,18 @@ def _tega_id2subscriber(tega_id):
         subscriber = subscriber_clients[tega_id]
     return subscriber
 
+def _durability(handler):
+    '''
+    Gets durability from a REST request param.
+    '''
+    durability = handler.get_argument('durability', None)
+    if durability:
+        try:
+            durability = DURABILITY(durability)
+        except ValueError:
+            raise tornado.web.HTTPError(400)  # Bad Request(400)
+    return durability
+
 @gen.coroutine
 def sync_check(root_oids, subscriber):
     kwargs = {}
@@ -100,10 +120,6 @@ class WebSocketSubscriber(Subscriber):
 
         [idb] -- on_notify(notifications) --> [server] -- NOTIFY -->
         '''
-        for d in notifications:
-            instance = d['instance']
-            if isinstance(instance, Cont):
-                d['instance'] = instance.serialize_()  # into JSON format
         self.write_message('NOTIFY\n' + json.dumps(notifications))
 
     def on_message(self, channel, tega_id, message):
@@ -117,6 +133,7 @@ class ManagementRestApiHandler(tornado.web.RequestHandler):
     '''
     REST API for tega-db management
     '''
+    @gen.coroutine
     def post(self, cmd):
         if cmd == 'clear':
             result = globals()[cmd]()  # commands in tega.idb
@@ -128,8 +145,10 @@ class ManagementRestApiHandler(tornado.web.RequestHandler):
             root_oid = self.get_argument('root_oid', None)
             backto = self.get_argument('backto', None)
             subscriber = _tega_id2subscriber(tega_id)
-            tega.idb.rollback(tega_id, root_oid, int(backto),
-                    subscriber=subscriber)
+            future = tega.idb.rollback(tega_id, root_oid, int(backto),
+                    subscriber=subscriber, durability=_durability(self))
+            if future:
+                yield future  # until the commit log is durable
         elif cmd == 'begin':
             tega_id = self.get_argument('tega_id')
             t = tx(subscriber=_tega_id2subscriber(tega_id))
@@ -163,16 +182,21 @@ class ManagementRestApiHandler(tornado.web.RequestHandler):
                     raise tornado.web.HTTPError(404)  # Not Found(404)
         elif cmd == 'commit':
             txid = self.get_argument('txid', None)
+            durability = _durability(self)
             with tx_lock:
                 if txid in transactions:
                     t = transactions[txid]['tx']
                     del transactions[txid]
+                    if durability:
+                        t.durability = durability
                     try:
                         t.commit()
                     except ValueError:
                         raise tornado.web.HTTPError(406)  # Not Acceptable(406)
                 else:
                     raise tornado.web.HTTPError(404)  # Not Found(404)
+            if t.future:
+                yield t.future  # until the commit log is durable
         elif cmd == 'sync':
             if server_as_subscriber:
                 sync_check(server_as_subscriber.config,
@@ -181,14 +205,41 @@ class ManagementRestApiHandler(tornado.web.RequestHandler):
                 raise tornado.web.HTTPError(404)
         elif cmd == 'ss':
             tega_id = self.get_argument('tega_id', None)
-            tega.idb.save_snapshot(tega_id)
+            tega.idb.save_snapshot(tega_id)  # runs in background
+            self.write(json.dumps(tega.idb.snapshot_progress()))
+            self.set_header('Content-Type', 'application/json')
+        elif cmd == 'snapshot':
+            s = tega.idb.snapshot()
+            with tx_lock:
+                snapshots[s.id] = {'snapshot': s, 'expire': 2}
+            data = {'snapshot': s.id, 'roots': s.versions()}
+            self.write(json.dumps(data))
+            self.set_header('Content-Type', 'application/json')
+        elif cmd == 'release':
+            snapshot_id = self.get_argument('snapshot', None)
+            with tx_lock:
+                if snapshot_id in snapshots:
+                    del snapshots[snapshot_id]
+                else:
+                    raise tornado.web.HTTPError(404)  # Not Found(404)
 
     def get(self, cmd):
-        if cmd  in ('roots', 'old'):
+        if cmd  in ('roots', 'old', 'stats'):
             result = globals()[cmd]()  # commands in tega.idb
+            if cmd == 'stats' and compaction_policy:
+                result['compaction'] = compaction_policy.stats()
             if result:
                 self.write(json.dumps(result))
                 self.set_header('Content-Type', 'application/json')
+        elif cmd == 'ss':
+            self.write(json.dumps(tega.idb.snapshot_progress()))
+            self.set_header('Content-Type', 'application/json')
+        elif cmd == 'snapshot':
+            with tx_lock:
+                data = {k: v['snapshot'].versions()
+                        for k, v in snapshots.items()}
+            self.write(json.dumps(data))
+            self.set_header('Content-Type', 'application/json')
         elif cmd == 'channels':
             channels = tega.idb.get_channels()
             self.write(json.dumps(channels))
@@ -231,37 +282,61 @@ class RestApiHandler(tornado.web.RequestHandler):
     REST API for tega-db CRUD operations
     '''
 
+    @gen.coroutine
     def get(self, id):
         '''
         GET(read) operation
+
+        A Cont tree is written chunk by chunk (Cont.iterdumps_), flushing
+        the chunks to the client as they are encoded.
+
+        snapshot: the id of a snapshot handle (POST /_snapshot) to read the
+        roots pinned by it.
         '''
         version = self.get_argument('version', None)
         internal = self.get_argument('internal', None)
         txid = self.get_argument('txid', None)
         tega_id = self.get_argument('tega_id')
         regex_flag = str2bool(self.get_argument('regex_flag', False))
+        snapshot_id = self.get_argument('snapshot', None)
         if version:
             version = int(version)
         internal = str2bool(internal)
         path = url2path(id)
         value = None
+        snapshot = None
+        if snapshot_id:
+            with tx_lock:
+                if snapshot_id in snapshots:
+                    snapshots[snapshot_id]['expire'] = 2
+                    snapshot = snapshots[snapshot_id]['snapshot']
+                else:
+                    raise tornado.web.HTTPError(404)  # Not Found(404)
         try:
             value = tega.idb.get(url2path(id), version=version,
-                    regex_flag=regex_flag)
-            if isinstance(value, Cont) or is_builtin_type(value):
+                    regex_flag=regex_flag, snapshot=snapshot)
+            self.set_header('Content-Type', 'application/json')
+            if isinstance(value, Cont):
+                flush = False
+                for chunk in value.iterdumps_(internal=internal):
+                    if flush:
+                        yield self.flush()
+                    self.write(chunk)
+                    flush = True
+            elif is_builtin_type(value):
                 self.write(value.dumps_(internal=internal))
             elif isinstance(value, list):
-                dict_ = {v[0]: {'groups':v[2],
-                    'instance':v[1].serialize_(internal=internal)} for v in
-                    value}
-                self.write(json.dumps(dict_))
+                self.write('{' + ', '.join(['{}: {{"groups": {}, '
+                    '"instance": {}}}'.format(json.dumps(v[0]),
+                        json.dumps(v[2]), v[1].dumps_(internal=internal))
+                    for v in value]) + '}')
             else:
                 self.write(json.dumps(value))
-            self.set_header('Content-Type', 'application/json')
         except KeyError:
             logging.info('path "{}" not found in global idb'.format(path))
             raise tornado.web.HTTPError(404)  # Not Found(404)
 
+    @gen.coroutine
     def put(self, id):
         '''
         PUT(create/update) operation
@@ -271,6 +346,7 @@ class RestApiHandler(tornado.web.RequestHandler):
         txid = self.get_argument('txid', None)
         tega_id = self.get_argument('tega_id')
         ephemeral = self.get_argument('ephemeral', False)
+        durability = _durability(self)
         if version:
             version = int(version)
         if ephemeral == 'True':
@@ -278,23 +354,34 @@ class RestApiHandler(tornado.web.RequestHandler):
         else:
             ephemeral = False
         path = url2path(id)
-        cont = subtree(path, data)
+        cont = subtree(path, data, freeze=True)
         if txid:
             with tx_lock:
                 if txid in transactions:
                     t = transactions[txid]['tx']
-                    t.put(cont, version=version, deepcopy=False,
-                            ephemeral=ephemeral)
+                    if durability:
+                        t.durability = durability
+                    try:
+                        t.put(cont, version=version, deepcopy=False,
+                                ephemeral=ephemeral)
+                    except SchemaError as e:
+                        raise tornado.web.HTTPError(400, str(e))
                 else:
                     raise tornado.web.HTTPError(404)  # Not Found(404)
         else:
-            with tx(subscriber=_tega_id2subscriber(tega_id)) as t:
-                try:
+            try:
+                with tx(subscriber=_tega_id2subscriber(tega_id),
+                        durability=durability) as t:
                     t.put(cont, version=version, deepcopy=False,
                             ephemeral=ephemeral)
-                except ValueError as e:
-                    raise tornado.web.HTTPError(409)  # Not Acceptible(409)
+            except SchemaError as e:
+                raise tornado.web.HTTPError(400, str(e))  # Bad Request
+            except ValueError as e:  # raised on commit
+                raise tornado.web.HTTPError(409)  # Not Acceptible(409)
+            if t.future:
+                yield t.future  # until the commit log is durable
 
+    @gen.coroutine
     def delete(self, id):
         '''
         DELETE operation
@@ -302,6 +389,7 @@ class RestApiHandler(tornado.web.RequestHandler):
         version = self.get_argument('version', None)
         txid = self.get_argument('txid', None)
         tega_id = self.get_argument('tega_id')
+        durability = _durability(self)
         if version:
             version = int(version)
         path = url2path(id)
@@ -309,16 +397,21 @@ class RestApiHandler(tornado.web.RequestHandler):
             with tx_lock:
                 if txid in transactions:
                     t = transactions[txid]['tx']
+                    if durability:
+                        t.durability = durability
                     t.delete(path, version=version)
                 else:
                     raise tornado.web.HTTPError(404)  # Not Found(404)
         else:
             tega_id = self.get_argument('tega_id')
-            with tx(subscriber=_tega_id2subscriber(tega_id)) as t:
-                try:
+            try:
+                with tx(subscriber=_tega_id2subscriber(tega_id),
+                        durability=durability) as t:
                     t.delete(path, version=version)
-                except ValueError as e:
-                    raise tornado.web.HTTPError(409)  # Not Acceptible(409)
+            except ValueError as e:  # raised on commit
+                raise tornado.web.HTTPError(409)  # Not Acceptible(409)
+            if t.future:
+                yield t.future  # until the commit log is durable
 
 class PubSubHandler(tornado.websocket.WebSocketHandler):
     '''
@@ -395,7 +488,7 @@ class PubSubHandler(tornado.websocket.WebSocketHandler):
             if type_ == REQUEST_TYPE.RPC:
                 self._route_rpc_request(param, body)
             elif type_ == REQUEST_TYPE.SYNC:
-                self._sync_request(param, body)
+                return self._sync_request(param, body)  # awaited by Tornado
             elif type_ == REQUEST_TYPE.REFER:
                 self._refer_request(param, body)
         elif cmd == 'RESPONSE':
@@ -447,12 +540,13 @@ class PubSubHandler(tornado.websocket.WebSocketHandler):
                            tega_id,
                            json.dumps(body)))
 
+    @gen.coroutine
     def _sync_request(self, param, body):
         seq_no = int(param[0])
         path = param[3]
         args, kwargs = parse_rpc_body(body)
         for root_oid, version in kwargs.items():
-            notifications = tega.idb.sync(root_oid, version, self.subscriber)
+            yield tega.idb.sync(root_oid, version, self.subscriber)
         self.write_message('RESPONSE {} {} {}\n{}'.
                 format(seq_no,
                        REQUEST_TYPE.SYNC.name,
@@ -504,16 +598,17 @@ class RpcHandler(tornado.web.RequestHandler):
 
 def transaction_gc():
     '''
-    Transaction objects garbage collector
+    Transaction objects and snapshot handles garbage collector
     '''
     with tx_lock:
-        for txid in list(transactions.keys()):
-            expire = transactions[txid]['expire']
-            if expire == 0:
-                del transactions[txid]
-                print('id: {} expired'.format(txid))
-            else:
-                transactions[txid]['expire'] = expire - 1
+        for objects in (transactions, snapshots):
+            for id_ in list(objects.keys()):
+                expire = objects[id_]['expire']
+                if expire == 0:
+                    del objects[id_]
+                    print('id: {} expired'.format(id_))
+                else:
+                    objects[id_]['expire'] = expire - 1
 
 class _SubscriberClient(object):
     '''
@@ -691,6 +786,7 @@ def reload_plugins():
 def main():
 
     global ghost, gport, sync_path, server_as_subscriber, server_tega_id, plugins, extensions
+    global compaction_policy
 
     logging.basicConfig(
             level=logging.DEBUG,
@@ -714,13 +810,54 @@ def main():
             help="root object IDs of operational trees", type=str, nargs='*', default=None)
     parser.add_argument("-e", "--extensions", help="directory of tega plugins",
             type=str, nargs='*', default=None)
-    parser.add_argument("-l", "--maxlen", help="the number of old roots kept in idb", type=int, default=tega.idb.OLD_ROOTS_LEN)
+    parser.add_argument("-l", "--maxlen", help="the number of old roots kept in idb (default: {} unless --old-roots-bytes or --old-roots-age)".format(tega.idb.OLD_ROOTS_LEN), type=int, default=None)
+    parser.add_argument("--old-roots-bytes",
+            help="bytes of old roots kept in idb per root",
+            type=int, default=None)
+    parser.add_argument("--old-roots-age",
+            help="the max age (sec) of old roots kept in idb",
+            type=int, default=None)
     parser.add_argument("-L", "--loglevel", help="logging level", type=str,
             default='INFO')
+    parser.add_argument("-D", "--durability",
+            help="default durability level of transactions", type=str,
+            choices=[d.value for d in DURABILITY],
+            default=DURABILITY.FSYNC.value)
+    parser.add_argument("--replay-processes",
+            help="the number of processes replaying commit logs on startup",
+            type=int, default=os.cpu_count())
+    parser.add_argument("--sync-buffer",
+            help="bytes of recent transactions per root kept in memory for sync",
+            type=int, default=SYNC_BUFFER_BYTES)
+    parser.add_argument("--compaction-bytes",
+            help="take a snapshot when a commit log segment exceeds the size",
+            type=int, default=None)
+    parser.add_argument("--compaction-records",
+            help="take a snapshot when a commit log segment exceeds the number of records",
+            type=int, default=None)
+    parser.add_argument("--compaction-age",
+            help="take a snapshot when a commit log segment is older than the seconds",
+            type=int, default=None)
+    parser.add_argument("--retain-snapshots",
+            help="the number of snapshots retained by compaction",
+            type=int, default=1)
+    parser.add_argument("--archive-dir",
+            help="directory to move pruned commit logs to (deleted if not specified)",
+            type=str, default=None)
+    parser.add_argument("--json-cache",
+            help="bytes of JSON of committed nodes cached for GET",
+            type=int, default=JSON_CACHE_BYTES)
+    parser.add_argument("--schema",
+            help="schema (JSON) validating PUT operations",
+            type=str, default=None)
+    parser.add_argument("--compress",
+            help="compress snapshots and sealed commit log segments",
+            action='store_true')
 
     args = parser.parse_args()
 
     logging.getLogger().setLevel(args.loglevel)
+    set_json_cache_limit(args.json_cache)
 
     server_tega_id = args.tegaid
     print('{}\n\ntega_id: {}, config: {}, operational: {}\n'.format(LOGO,
@@ -741,7 +878,16 @@ def main():
 
     # idb initialization
     try:
-        tega.idb.start(args.logdir, server_tega_id, args.maxlen)  # idb start
+        maxlen = args.maxlen
+        if maxlen is None and not (args.old_roots_bytes or args.old_roots_age):
+            maxlen = tega.idb.OLD_ROOTS_LEN
+        tega.idb.start(args.logdir, server_tega_id, maxlen,
+                group_commit=True,
+                durability=DURABILITY(args.durability),
+                sync_buffer_bytes=args.sync_buffer,
+                compression=args.compress,
+                max_bytes=args.old_roots_bytes,
+                max_age=args.old_roots_age)  # idb start
     except FileNotFoundError:
         print('{} not found'.format(args.logdir))
         print('hint: create {} directory'.format(args.logdir))
@@ -749,9 +895,22 @@ def main():
 
     # Reloads previous logs from tega db file
     logging.info('Reloading log from {}...'.format(args.logdir))
-    tega.idb.reload_log()  # reloads tega-db log
+    tega.idb.reload_log(processes=args.replay_processes)  # reloads tega-db log
     logging.info('Reloading done')
 
+    # Schema validation of the PUT operations (not of the reloaded logs)
+    if args.schema:
+        tega.schema.load_file(args.schema)
+
+    # Automatic log compaction
+    if args.compaction_bytes or args.compaction_records or args.compaction_age:
+        compaction_policy = CompactionPolicy(server_tega_id,
+                max_bytes=args.compaction_bytes,
+                max_records=args.compaction_records,
+                max_age=args.compaction_age,
+                retain=args.retain_snapshots,
+                archive_dir=args.archive_dir)
+
     # Attaches plugins to idb
     if args.extensions:
         extensions = args.extensions
@@ -767,6 +926,12 @@ def main():
     try:
         tornado.ioloop.PeriodicCallback(transaction_gc,
                 TRANSACTION_GC_PERIOD * 1000).start()
+        if compaction_policy:
+            tornado.ioloop.PeriodicCallback(compaction_policy.check,
+                    COMPACTION_CHECK_PERIOD * 1000).start()
+        if args.old_roots_age:
+            tornado.ioloop.PeriodicCallback(tega.idb.expire_old_roots,
+                    OLD_ROOTS_EXPIRE_PERIOD * 1000).start()
         
         if args.ghost and args.gport and args.config:
             server_as_subscriber = _SubscriberClient(
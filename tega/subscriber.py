@@ -99,11 +99,11 @@ class PlugIn(Subscriber):
         '''
         pass
 
-    def tx(self):
+    def tx(self, durability=None):
         '''
         Calls tega.idb.tx().
         '''
-        return tega.idb.tx(subscriber=self)
+        return tega.idb.tx(subscriber=self, durability=durability)
 
     def func(self, method, *args, **kwargs):
         '''
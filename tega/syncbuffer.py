@@ -0,0 +1,87 @@
+'''
+In-memory buffer of recent committed transactions per root
+
+Followers reconnecting to the server are usually a few versions behind:
+SyncBuffer serves their catch-up from memory, and idb.sync() reads the
+commit log only if the versions have already been evicted from the buffer.
+'''
+
+import collections
+
+SYNC_BUFFER_BYTES = 1024 * 1024  # per root
+
+class SyncBuffer(object):
+    '''
+    Ring buffer of recent committed transactions per root, sized by bytes.
+    '''
+
+    def __init__(self, max_bytes=SYNC_BUFFER_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}  # {root_oid: deque([(version, notifications, size, future), ...])}
+        self._bytes = {}  # {root_oid: bytes}
+
+    def append(self, root_oid, version, notifications, size, future=None):
+        '''
+        Appends the notifications of a transaction creating the version of
+        the root. future is resolved when the transaction is durable.
+
+        The oldest transactions are evicted if the buffer of the root
+        exceeds max_bytes.
+        '''
+        if not root_oid in self._entries:
+            self._entries[root_oid] = collections.deque()
+            self._bytes[root_oid] = 0
+        entries = self._entries[root_oid]
+        entries.append((version, notifications, size, future))
+        self._bytes[root_oid] += size
+        while entries and self._bytes[root_oid] > self.max_bytes:
+            self._bytes[root_oid] -= entries.popleft()[2]
+
+    def since(self, root_oid, version):
+        '''
+        Returns (multi, future) of the transactions after the version:
+        multi is a list of notifications, and future is of the newest
+        transaction (None if it needs no wait).
+
+        Returns None if the transactions have been evicted (a miss).
+        '''
+        entries = self._entries.get(root_oid)
+        if not entries or entries[0][0] > version + 1:
+            self.misses += 1
+            return None
+        self.hits += 1
+        multi = []
+        future = None
+        for version_, notifications, size, future_ in entries:
+            if version_ > version:
+                if notifications:
+                    multi.append(notifications)
+                future = future_
+        return multi, future
+
+    def remove(self, root_oid):
+        '''
+        Removes the transactions of the root.
+        '''
+        self._entries.pop(root_oid, None)
+        self._bytes.pop(root_oid, None)
+
+    def clear(self):
+        '''
+        Removes all the transactions.
+        '''
+        self._entries.clear()
+        self._bytes.clear()
+
+    def stats(self):
+        '''
+        Returns the hit/miss counters and the usage of the buffer.
+        '''
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'max_bytes': self.max_bytes,
+                'bytes': sum(self._bytes.values()),
+                'transactions': sum([len(entries) for entries
+                    in self._entries.values()])}
@@ -1,6 +1,284 @@
-from collections import MutableMapping
-import copy
+from tega.hamt import Hamt
+
+from collections import MutableMapping, OrderedDict
+from types import MappingProxyType
+import array
+import base64
 import json
+import sys
+import threading
+import weakref
+
+# Sets metadata (_oid, _parent, _version...) of a node, bypassing
+# Cont.__setattr__ (no immutability check).
+set_meta = object.__setattr__
+
+_no_children = MappingProxyType({})  # children of leaves
+
+# Counts the freeze_() calls and the moves under frozen nodes: a node found
+# not frozen (Cont.is_frozen_()) is checked again after either of them.
+_freezes = 0
+
+class _Cell:
+    '''
+    Refers to a Cont object as a parent (see Cont._parent).
+
+    When a copy of the node replaces it in a newer version, the cell is
+    forwarded to the copy's (supersede()), so that the children shared with
+    the old versions follow it without being re-parented one by one, and
+    keep no reference to the old version of the parent.
+    '''
+
+    __slots__ = ('node', 'next')
+
+    def __init__(self, node):
+        self.node = node
+        self.next = None
+
+def _cell_of(node):
+    '''
+    Returns the cell referring to the node, creating it if needed.
+    '''
+    cell = node._cell
+    if cell is None or cell.node is not node:
+        cell = _Cell(node)
+        set_meta(node, '_cell', cell)
+    return cell
+
+def supersede(original, copy_):
+    '''
+    Forwards the children of the original node to its copy.
+    '''
+    cell = original._cell
+    if cell is not None and cell.node is original:
+        cell.next = _cell_of(copy_)
+        cell.node = None
+
+def _get_parent(node):
+    cell = node._parent_cell
+    if type(cell) is not _Cell:
+        return cell  # None or the oid of a detached root's parent
+    if cell.next is not None:
+        while cell.next is not None:
+            cell = cell.next
+        set_meta(node, '_parent_cell', cell)
+    return cell.node
+
+def _set_parent(node, parent):
+    if isinstance(parent, Cont):
+        parent = _cell_of(parent)
+    set_meta(node, '_parent_cell', parent)
+
+def set_parent(node, parent):
+    '''
+    Sets the parent of a node, dropping the cached qname and path of the
+    subtree if the node has moved to another place in the tree.
+    '''
+    global _freezes
+    set_meta(node, '_parent', parent)
+    if parent is not None and parent.is_frozen_():
+        _freezes += 1
+    qname = getattr(node, '_qname_cache', None)
+    if qname is not None and (parent is None or
+            parent._qname_tuple() != qname[:-1]):
+        _drop_qname(node)
+
+def _drop_qname(node):
+    '''
+    Drops the cached qname and path of the node and its descendants.
+    '''
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if getattr(node, '_qname_cache', None) is not None:
+            set_meta(node, '_qname_cache', None)
+            set_meta(node, '_path_cache', None)
+            stack.extend(node._children.values())
+
+# JSON of frozen nodes (LRU): (id(node), internal) -> (weakref to the node,
+# _version, JSON). The entries of the nodes freed are dropped.
+_json_cache = OrderedDict()
+_json_cache_lock = threading.Lock()
+_json_cache_dead = []  # weakrefs to the nodes freed
+_json_cache_stats = {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0}
+JSON_CACHE_BYTES = 64 * 1024 * 1024
+_json_cache_limit = JSON_CACHE_BYTES
+
+class _JsonRef(weakref.ref):
+    '''
+    Weak reference to a node in the JSON cache, with the cache key.
+    '''
+
+    __slots__ = ('key',)
+
+def _json_cache_drop_dead():
+    '''
+    Drops the entries of the nodes freed (_json_cache_lock held): the
+    callback of the weakref may run in the middle of a cache operation, so
+    that it only appends to _json_cache_dead.
+    '''
+    while _json_cache_dead:
+        ref = _json_cache_dead.pop()
+        entry = _json_cache.get(ref.key)
+        if entry is not None and entry[0] is ref:
+            del _json_cache[ref.key]
+            _json_cache_stats['bytes'] -= len(entry[2])
+    _json_cache_stats['entries'] = len(_json_cache)
+
+def _json_cache_get(node, internal):
+    with _json_cache_lock:
+        _json_cache_drop_dead()
+        entry = _json_cache.get((id(node), internal))
+        if entry is not None and entry[0]() is node and \
+                entry[1] == node._version:
+            _json_cache.move_to_end((id(node), internal))
+            _json_cache_stats['hits'] += 1
+            return entry[2]
+        _json_cache_stats['misses'] += 1
+        return None
+
+def _json_cache_put(node, internal, json_):
+    with _json_cache_lock:
+        _json_cache_drop_dead()
+        key = (id(node), internal)
+        entry = _json_cache.pop(key, None)
+        if entry is not None:
+            _json_cache_stats['bytes'] -= len(entry[2])
+        ref = _JsonRef(node, _json_cache_dead.append)
+        ref.key = key
+        _json_cache[key] = (ref, node._version, json_)
+        _json_cache_stats['bytes'] += len(json_)
+        while _json_cache and _json_cache_stats['bytes'] > _json_cache_limit:
+            key, entry = _json_cache.popitem(last=False)
+            _json_cache_stats['bytes'] -= len(entry[2])
+        _json_cache_stats['entries'] = len(_json_cache)
+
+def json_cache_stats():
+    '''
+    Returns the statistics of the JSON cache (the size in bytes).
+    '''
+    with _json_cache_lock:
+        _json_cache_drop_dead()
+        stats = dict(_json_cache_stats)
+    stats['limit'] = _json_cache_limit
+    return stats
+
+def set_json_cache_limit(limit):
+    '''
+    Sets the size (bytes) of the JSON cache (0 disables it).
+    '''
+    global _json_cache_limit
+    with _json_cache_lock:
+        _json_cache_limit = limit
+        while _json_cache and _json_cache_stats['bytes'] > limit:
+            key, entry = _json_cache.popitem(last=False)
+            _json_cache_stats['bytes'] -= len(entry[2])
+        _json_cache_stats['entries'] = len(_json_cache)
+
+def json_cache_clear():
+    '''
+    Clears the JSON cache.
+    '''
+    with _json_cache_lock:
+        _json_cache.clear()
+        del _json_cache_dead[:]
+        _json_cache_stats.update(entries=0, bytes=0, hits=0, misses=0)
+
+_encode = json.JSONEncoder().encode
+
+def _json_key(key):
+    '''
+    Encodes a child key as a JSON object key (like json.dumps() does).
+    '''
+    if isinstance(key, str):
+        return _encode(key)
+    return _encode(_encode(key))
+
+def _json_atom(node, internal, serialize_ephemeral, frozen):
+    '''
+    Returns the JSON of a node encoded at once: a leaf, a cached node or a
+    node with leaves only. Returns '' if the leaf is filtered out, or None
+    if the node needs to be walked.
+
+    frozen is True if an ancestor of the node is frozen.
+    '''
+    if node._children is _no_children:  # a leaf
+        value = node.serialize_(internal=internal)
+        if not serialize_ephemeral and not value:
+            return ''  # see Cont.serialize_
+        return _encode(value)
+    if serialize_ephemeral:
+        frozen = frozen or node._frozen
+        if frozen:
+            json_ = _json_cache_get(node, internal)
+            if json_ is not None:
+                return json_
+        if all(type(v) is not Cont for v in node._children.values()):
+            json_ = _encode(node.serialize_(internal=internal))
+            if frozen:
+                _json_cache_put(node, internal, json_)
+            return json_
+    return None
+
+def _json_metadata(node, internal):
+    '''
+    Returns the JSON of the metadata ('"key": value') if internal.
+    '''
+    if not internal:
+        return []
+    out = {}
+    node._serialize_metadata(out)
+    return [_encode(k) + ': ' + _encode(v) for k, v in out.items()]
+
+def _json_frame(node, internal, key, frozen):
+    '''
+    Returns a frame of Cont._json_(): [node, children, parts, key, count,
+    size, frozen].
+    '''
+    parts = ['{']
+    metadata = _json_metadata(node, internal)
+    if metadata:
+        parts.append(', '.join(metadata))
+    return [node, iter(node._children.items()), parts, key, len(metadata),
+            sum(len(m) for m in metadata), frozen or node._frozen]
+
+def _join_parts(parts):
+    '''
+    Joins the parts of Cont._json_(), including the nested lists of parts.
+    '''
+    out = []
+    stack = [iter(parts)]
+    while stack:
+        for part in stack[-1]:
+            if type(part) is list:
+                stack.append(iter(part))
+                break
+            out.append(part)
+        else:
+            stack.pop()
+    return ''.join(out)
+
+def _prefixes(stack, pending):
+    '''
+    Returns the pending prefixes of the frames (the top ones on the stack)
+    in Cont.iterdumps_(), counting them as written.
+    '''
+    texts = []
+    for i in range(len(stack) - pending, len(stack)):
+        frame = stack[i]
+        if frame[2] is not None:
+            if stack[i - 1][1]:
+                texts.append(', ')
+            stack[i - 1][1] += 1
+            texts.append(frame[2])
+            frame[2] = None
+    return ''.join(texts)
+
+# Size of the chunks yielded by Cont.iterdumps_()
+CHUNK_SIZE = 64 * 1024
+
+# Children of a node wider than this are copied structurally (Hamt).
+WIDE_NODE = 1024
 
 class Cont(MutableMapping):
     '''
@@ -28,29 +306,65 @@ class Cont(MutableMapping):
            +-- Cont --+-- RPC(Func)
 
     Note: dict is converted into Cont.
+
+    Node layout
+    -----------
+    The metadata (_oid, _parent, _version, _frozen and _ephemeral) is kept
+    in slots, and the children in a separate dict (_children), so that a
+    Cont object has no instance __dict__.
+
+    copy_() copies the children of a wide node (more than WIDE_NODE children)
+    into a Hamt, which is copied in O(1) the next time and shares the
+    children with the original.
+
+    _parent is a property referring to the parent through a cell (_Cell):
+    a copy of the node replacing it in a newer version takes over the cell
+    (see tega.idb.tx), so that the children shared with the old versions
+    are under the newest version of the parent.
+
+    freeze_() marks the root of the subtree only (_frozen): a node is frozen
+    if it or one of its ancestors is marked (is_frozen_()). A node found not
+    frozen remembers it (_unfrozen_at) until the next freeze_() or move
+    under a frozen node, so that the mutations of a tree do not walk up
+    every time.
+
+    The qname (tuple) and the path of a node are computed once and cached
+    (_qname_cache and _path_cache): the cache is dropped when the node moves
+    to another place (set_parent(), change_() or setting _oid or _parent).
+    Wrapped types compute them from the parent's.
     '''
-    
-    # Schema initialization
-    __schema = None
-    #try:
-    #    with open('schema_sample.json') as __f: 
-    #       __schema = json.loads(__f.read()) 
-    #    __schema = __schema['schema']
-    #except:
-    #    pass
-    
+
+    __slots__ = ('_oid', '_parent_cell', '_version', '_frozen', '_ephemeral',
+            '_children', '_cell', '_qname_cache', '_path_cache',
+            '_unfrozen_at', '__weakref__')
+    _metadata = frozenset(('_oid', '_parent', '_version', '_frozen',
+        '_ephemeral'))
+
     def __init__(self, _oid=None, _parent=None, _version=0):
         '''
         _oid is a hashable object such as str, int or frozendict.
         '''
-        self.__dict__['_oid'] = _oid
-        self.__dict__['_parent'] = _parent
-        self.__dict__['_version'] = _version
-        self.__dict__['_frozen'] = False
-        self.__dict__['_ephemeral'] = False
+        set_meta(self, '_oid', _oid)
+        set_meta(self, '_cell', None)
+        set_meta(self, '_parent', _parent)
+        set_meta(self, '_version', _version)
+        set_meta(self, '_frozen', False)
+        set_meta(self, '_ephemeral', False)
+        set_meta(self, '_children', {})
+        set_meta(self, '_qname_cache', None)
+        set_meta(self, '_path_cache', None)
+        set_meta(self, '_unfrozen_at', -1)
+
+    _parent = property(_get_parent, _set_parent)
 
     def __len__(self):
-        return len(self.__dict__)
+        return len(self._children)
+
+    def __bool__(self):
+        '''
+        A Cont object is true even if it has no children.
+        '''
+        return True
     
     def _get_wrapped_type(self, type_):
         '''
@@ -79,24 +393,39 @@ class Cont(MutableMapping):
         '''
         Sets attributes to a wrapped one.
         '''
-        value.__dict__['_version'] = 0
-        value.__dict__['_parent'] = self
-        value.__dict__['_oid'] = key
-        value.__dict__['_ephemeral'] = False
-        self.__dict__[key] = value
+        value._version = 0
+        value._parent = self
+        value._oid = key
+        value._ephemeral = False
+        self._children[key] = value
 
     def __setattr__(self, key, value):
 
         self._immutability_check()
-        self._validation(key, value) 
+        if key in self._metadata:
+            set_meta(self, key, value)
+            if key == '_oid' or key == '_parent':
+                _drop_qname(self)
+            if key == '_parent' and value is not None and value.is_frozen_():
+                global _freezes
+                _freezes += 1
+            return
         types = self.__class__._types
         wrapped_types = self.__class__._wrapped_types
         type_ = type(value)
         if type_ == dict: # dict => Cont conversion
             c = Cont(_oid=key, _parent=self)
-            for k,v in value.items():
-                c[k] = v
-            self.__dict__[key] = c
+            stack = [(c, value)]
+            while stack:
+                c_, value_ = stack.pop()
+                for k,v in value_.items():
+                    if type(v) == dict:
+                        child = Cont(_oid=k, _parent=c_)
+                        c_._children[k] = child
+                        stack.append((child, v))
+                    else:
+                        c_[k] = v
+            self._children[key] = c
         elif type_ == list: # list => tuple (immutable list)
             value = tuple(value)
             self._set_builtin_attr(key, value)
@@ -105,37 +434,51 @@ class Cont(MutableMapping):
         elif type_ in wrapped_types: # Wrapped built-in types
             self._set_wrapped_attr(key, value)
         elif type_ == Cont: # Cont
-            self.__dict__[key] = value
-            value.__dict__['_parent'] = self
+            self._children[key] = value
+            set_parent(value, self)
         elif type_ == bool:
-            self.__dict__[key] = Bool(key, self, value)
+            self._children[key] = Bool(key, self, value)
         elif type_ == Func: # RPC function
-            self.__dict__[key] = RPC(key, self, value)
+            self._children[key] = RPC(key, self, value)
+        elif type_ == array.array: # array => Vector
+            self._children[key] = Vector(key, self, value)
+        elif type_ == Vector:
+            self._children[key] = value
+            set_parent(value, self)
         else:
             raise ValueError('Unidentifed type: {}'.format(type_))
 
     def __getattr__(self, key):
+        if key == '_children':  # not initialized yet
+            raise AttributeError(key)
+        children = self._children
+        if key in children:
+            return children[key]
         self._immutability_check()
         cont = Cont(key, self)
-        self.__dict__[key] = cont
+        children[key] = cont
         return cont
 
     def __delattr__(self, key):
         self._immutability_check()
-        del self.__dict__[key]
+        del self._children[key]
 
     def __getitem__(self, key):
-        if key in self.__dict__:
-            return self.__dict__[key]
+        children = self._children
+        if key in children:
+            return children[key]
+        elif key in self._metadata:
+            return object.__getattribute__(self, key)
         else:
             return self.__getattr__(key)
 
     def _extend(self, key):
-        if key in self.__dict__:
-            return self.__dict__[key]
+        children = self._children
+        if key in children:
+            return children[key]
         else:
             cont = Cont(key, self)
-            self.__dict__[key] = cont
+            children[key] = cont
             return cont
 
     __setitem__ = __setattr__
@@ -154,39 +497,81 @@ class Cont(MutableMapping):
     def freeze_(self):
         '''
         Makes the self Cont object immutable recursively (incl. all the
-        children).
+        children) in O(1): the children are frozen with the self Cont
+        object (see is_frozen_()).
         '''
-        self.__dict__['_frozen'] = True
-        for v in self.values():
-            if isinstance(v, Cont):
-                v.freeze_()
+        global _freezes
+        set_meta(self, '_frozen', True)
+        _freezes += 1
+
+    def is_frozen_(self):
+        '''
+        Returns True if the self Cont object or one of its ancestors has
+        been frozen.
+        '''
+        freezes = _freezes
+        nodes = []
+        node = self
+        while node is not None:
+            if node._frozen:
+                return True
+            if node._unfrozen_at == freezes:
+                break
+            nodes.append(node)
+            node = node._parent
+        for node in nodes:
+            set_meta(node, '_unfrozen_at', freezes)
+        return False
 
     def _immutability_check(self):
         '''
         Checks if the self Cont object is immutable.
         '''
-        if self.__dict__['_frozen']:
+        if self.is_frozen_():
             raise AttributeError()
 
     def root_(self):
         '''
         Returns a root Cont object.
         '''
-        if self._parent:
-            return self._parent.root_()
-        else:
-            return self
+        node = self
+        while node._parent is not None:
+            node = node._parent
+        return node
 
-    def _qname(self):
-        if self._parent:
-            yield from self._parent._qname()
-        yield self.__dict__['_oid']
+    def _qname_tuple(self):
+        '''
+        Returns Qualified Name (QName) as a tuple (cached).
+        '''
+        qname = self._qname_cache
+        if qname is None:
+            # Up to the nearest ancestor with the cache, and then down
+            nodes = [self]
+            parent = self._parent
+            while parent is not None and parent._qname_cache is None:
+                nodes.append(parent)
+                parent = parent._parent
+            qname = () if parent is None else parent._qname_cache
+            for node in reversed(nodes):
+                qname = qname + (node._oid,)
+                set_meta(node, '_qname_cache', qname)
+        return qname
 
     def qname_(self):
         '''
         Returns Qualified Name (QName).
         '''
-        return [oid for oid in self._qname()]
+        return list(self._qname_tuple())
+
+    def path_(self):
+        '''
+        Returns the path ('a.b.c') of the node (cached).
+        '''
+        path = self._path_cache
+        if path is None:
+            path = sys.intern('.'.join(self._qname_tuple()))
+            set_meta(self, '_path_cache', path)
+        return path
 
     def subtree_(self, path):
         '''
@@ -205,34 +590,42 @@ class Cont(MutableMapping):
 
     def _deepcopy_parents(self, subtree):
         '''
-        "deep" copies the parent nodes.
-        '''
-        qname = self.qname_()
-        if len(qname) > 0:
-            parent = self.__dict__['_parent']
-            child = subtree
-            for cont in reversed(qname[:-1]):
-                p = parent.copy_()
-                _oid = child.__dict__['_oid']
-                p.__dict__[_oid] = child
-                child.__dict__['_parent'] = p
+        "deep" copies the parent nodes (not frozen), unless the subtree has
+        been copied under a new parent.
+        '''
+        if subtree._parent is not None:
+            return subtree
+        parent = self._parent
+        child = subtree
+        while parent is not None:
+            p = parent.copy_()
+            set_meta(p, '_frozen', False)
+            p._children[child._oid] = child
+            set_meta(child, '_parent', p)
+            child = p
+            parent = parent._parent
         return subtree
     
     def deepcopy_(self, new_parent=None):
         '''
         "deep" copy.
         '''
-        _oid = self.__dict__['_oid']
-        obj = Cont(_oid, _parent=new_parent)
+        obj = Cont(self._oid, _parent=new_parent, _version=self._version)
+        set_meta(obj, '_ephemeral', self._ephemeral)
 
         # Deepcopies the subtree
-        for k,v in self.__dict__.items():
-            if k == '_parent' or k == '_frozen':
-                pass  # These attributes are set in __init__().
-            elif isinstance(v, Cont) or self.is_wrapped(v):
-                obj.__dict__[k] = v.deepcopy_(new_parent=obj)
-            else:
-                obj.__dict__[k] = copy.deepcopy(v)
+        stack = [(self, obj)]
+        while stack:
+            node, copy_ = stack.pop()
+            children = copy_._children
+            for k,v in node._children.items():
+                if type(v) is Cont:
+                    c = Cont(v._oid, _parent=copy_, _version=v._version)
+                    set_meta(c, '_ephemeral', v._ephemeral)
+                    stack.append((v, c))
+                    children[k] = c
+                else:
+                    children[k] = v.deepcopy_(new_parent=copy_)
 
         # Deepcopies the parents 
         self._deepcopy_parents(obj)
@@ -243,11 +636,21 @@ class Cont(MutableMapping):
         '''
         "shallow" copy.
         '''
-        obj = self.__class__() # Cont
-        for k,v in self.__dict__.items():
-            obj.__dict__[k] = v
+        obj = Cont.__new__(self.__class__)
+        set_meta(obj, '_cell', None)
+        for k in self._metadata:
+            set_meta(obj, k, object.__getattribute__(self, k))
+        children = self._children
+        if type(children) is dict and len(children) > WIDE_NODE:
+            children = Hamt(children)
+        elif children is not _no_children:
+            children = children.copy()
+        set_meta(obj, '_children', children)
+        set_meta(obj, '_qname_cache', self._qname_cache)
+        set_meta(obj, '_path_cache', self._path_cache)
+        set_meta(obj, '_unfrozen_at', -1)
         if freeze:
-            obj.__dict__['_frozen'] = True
+            set_meta(obj, '_frozen', True)
         return obj
 
     def merge_(self, instance, _version=None):
@@ -262,38 +665,44 @@ class Cont(MutableMapping):
         o   o o   o  o   o i   o
        
         '''
-        if _version:
-            self.__dict__['_version'] = 0
-        for k,v in instance.items():
-            if isinstance(v, Cont):
-                child = self[k]  # Calls Cont.__getattr__(k)
-                child.merge_(v, _version)
-            else:
-                self[k] = v 
-                if _version:
-                    v.__dict__['_version'] = _version
-        if _version:
-            self.__dict__['_version'] = _version
+        stack = [(self, instance)]
+        while stack:
+            self_, instance = stack.pop()
+            if _version:
+                set_meta(self_, '_version', _version)
+            for k,v in instance.items():
+                if isinstance(v, Cont):
+                    child = self_[k]  # Calls Cont.__getattr__(k)
+                    stack.append((child, v))
+                else:
+                    self_[k] = v 
+                    if _version:
+                        set_meta(v, '_version', _version)
 
     def __iter__(self):
         '''
-        Returs an iterator(generator) excluding hidden keys (_*).
+        Returs an iterator over the children (excluding metadata).
         '''
-        for k in self.__dict__:
-            if not k.startswith('_'):
-                yield k
+        return iter(self._children)
 
     def __contains__(self, key):
         '''
-        Returs True if key is in __dict__: 
+        Returs True if key is a child or metadata.
         '''
-        return key in self.__dict__
+        return key in self._children or key in self._metadata
 
     def _iter(self):
         '''
-        Returns an iterator(generator) including hidden keys (_*)
+        Returns an iterator(generator) including metadata
         '''
-        return iter(self.__dict__)
+        yield from self._metadata
+        yield from self._children
+
+    def keys(self):
+        return self._children.keys()
+
+    def values(self):
+        return self._children.values()
 
     def items(self):
         '''
@@ -301,9 +710,7 @@ class Cont(MutableMapping):
         Caveat: The keyword 'iteritems' cannot be used as an attribute
         for Cont
         '''
-        for k in self:
-            if not k.startswith('_'):
-                yield k, self.__dict__[k]
+        return self._children.items()
 
     def change_(self, to):
         '''
@@ -312,9 +719,8 @@ class Cont(MutableMapping):
         so that the tree can rollback to the previous state in case some trouble
         has happened. 
         '''
-        self.__dict__['_parent'] = to
-        _oid = self.__dict__['_oid']
-        to.__dict__[_oid] = self # The parent makes a link (an attribute) to the object
+        set_parent(self, to)
+        to._children[self._oid] = self # The parent makes a link (an attribute) to the object
     
     def __str__(self):
         return self.walk_()
@@ -323,46 +729,66 @@ class Cont(MutableMapping):
         '''
         Sets the node ephemeral.
         '''
-        self.__dict__['_ephemeral'] = True
+        set_meta(self, '_ephemeral', True)
 
     def is_ephemeral_(self):
-        return self.__dict__['_ephemeral']
+        return self._ephemeral
 
-    def _is_serializable(self, key):
-        #return not key in ('_frozen', '_ephemeral')
-        return not key in ('_frozen',)
+    def _serialize_metadata(self, out):
+        '''
+        Serializes the metadata except for _frozen.
+        '''
+        parent = self._parent
+        out['_oid'] = self._oid
+        out['_parent'] = parent._oid if isinstance(parent, Cont) else parent
+        out['_version'] = self._version
+        out['_ephemeral'] = self._ephemeral
 
-    def serialize_(self, internal=False, out=None, serialize_ephemeral=True):
+    def serialize_(self, internal=False, out=None, serialize_ephemeral=True,
+            encode_vectors=False, builtin=False):
         '''
         Serializes a Cont object into Python dict.
+
+        Vectors are serialized into lists, or encoded (see Vector.encode_())
+        if encode_vectors, e.g., for the commit log.
+
+        The values of the wrapped types are the ones in the tree, or copies
+        of built-in types if builtin, so that the dict does not keep the
+        tree alive (e.g., the notifications retained by tega.idb).
         '''
+        wrapped_types = Cont._wrapped_types if builtin else {}
         if out is None:
             out = {}
-        for k,v in self.__dict__.items():
-            type_v = type(v)
-            is_child_or_value = not k.startswith('_')
-            if not serialize_ephemeral and is_child_or_value and v.is_ephemeral_():
-                continue
-            if is_child_or_value:
-                if type_v == Cont:
-                    out[k] = {}
-                elif type_v == Bool or type_v == RPC or self.is_wrapped(v):
-                    out[k] = v.serialize_(internal=internal)
-            elif internal and not is_child_or_value:
-                if type_v == Cont or internal and type_v == RPC:
-                    s = v.__dict__['_oid']
-                    out[k] = s
-                elif type_v == Func:
-                    out[k] = str(v)
-                elif self._is_serializable(k):
-                    out[k] = v
-
-            if k != '_parent' and isinstance(v, Cont):
-                v.serialize_(internal=internal, out=out[k],
-                        serialize_ephemeral=serialize_ephemeral)
-
-            if is_child_or_value and not serialize_ephemeral and not out[k]:
-                del out[k]
+        if internal:
+            self._serialize_metadata(out)
+        # Frames: (children, out, the parent's out, key)
+        stack = [(iter(self._children.items()), out, None, None)]
+        while stack:
+            items, out_, parent_out, key = stack[-1]
+            for k,v in items:
+                if not serialize_ephemeral and v.is_ephemeral_():
+                    continue
+                if type(v) == Cont:
+                    child_out = {}
+                    if internal:
+                        v._serialize_metadata(child_out)
+                    out_[k] = child_out
+                    stack.append((iter(v._children.items()), child_out,
+                        out_, k))
+                    break
+                elif encode_vectors and type(v) is Vector:
+                    out_[k] = v.encode_(internal=internal)
+                else:
+                    out_[k] = v.serialize_(internal=internal)
+                    if not serialize_ephemeral and not out_[k]:
+                        del out_[k]
+                    elif type(v) in wrapped_types:
+                        out_[k] = wrapped_types[type(v)](v)
+            else:
+                stack.pop()
+                if not serialize_ephemeral and parent_out is not None \
+                        and not out_:
+                    del parent_out[key]
 
         return out
 
@@ -375,84 +801,190 @@ class Cont(MutableMapping):
     def dumps_(self, internal=False):
         '''
         Dumps data in JSON format.
+
+        The JSON of a frozen tree is assembled from the cached JSON of the
+        nodes (see _json_), and the other trees are encoded in one pass
+        (see iterdumps_).
+        '''
+        if self.is_frozen_():
+            return self._json_(internal)
+        return ''.join(self.iterdumps_(internal=internal,
+            chunk_size=sys.maxsize))
+
+    def iterdumps_(self, internal=False, serialize_ephemeral=True,
+            chunk_size=CHUNK_SIZE):
+        '''
+        Dumps data in JSON format chunk by chunk (about chunk_size long),
+        walking the tree iteratively instead of building a dict first.
+        The output is the same as json.dumps() of serialize_() with the
+        options.
         '''
-        out = self.serialize_(internal=internal)
-        return json.dumps(out)
+        if self._children is _no_children:
+            yield _encode(self.serialize_(internal=internal))
+            return
+        frozen = self.is_frozen_()
+        atom = _json_atom(self, internal, serialize_ephemeral, frozen)
+        if atom is not None:
+            yield atom
+            return
+
+        out = []
+        size = 0
+        # Frames: [children, the number of children written, prefix, frozen]
+        # The prefix ('"key": {') of a node is pending until its first
+        # child is written, since an empty node is dropped unless
+        # serialize_ephemeral (see serialize_).
+        stack = [[iter(self._children.items()), 0, None, frozen]]
+        pending = 0
+        node = self
+        out.append('{')
+        while stack:
+            if node is not None:  # enters the node
+                if pending and (serialize_ephemeral or internal):
+                    out.append(_prefixes(stack, pending))
+                    pending = 0
+                if internal:
+                    metadata = _json_metadata(node, internal)
+                    out.append(', '.join(metadata))
+                    stack[-1][1] = len(metadata)
+                node = None
+            frame = stack[-1]
+            for k, v in frame[0]:
+                if not serialize_ephemeral and v.is_ephemeral_():
+                    continue
+                atom = _json_atom(v, internal, serialize_ephemeral, frame[3])
+                if atom is None:  # walks the child
+                    stack.append([iter(v._children.items()), 0,
+                        _json_key(k) + ': {', frame[3] or v._frozen])
+                    pending += 1
+                    node = v
+                    break
+                elif atom:
+                    if pending:
+                        out.append(_prefixes(stack, pending))
+                        pending = 0
+                    if frame[1]:
+                        out.append(', ')
+                    out.append(_json_key(k) + ': ' + atom)
+                    size += len(atom)
+                    frame[1] += 1
+                    if size >= chunk_size:
+                        yield ''.join(out)
+                        out = []
+                        size = 0
+            else:  # leaves the node
+                stack.pop()
+                if frame[2] is None:
+                    out.append('}')
+                else:
+                    pending -= 1  # dropped
+        yield ''.join(out)
+
+    def _json_(self, internal):
+        '''
+        Encodes the node into JSON, assembling it from the children's JSON.
+
+        The JSON of a frozen node is cached (_json_cache) until the node
+        or its version is gone. A node larger than 1/16 of the cache limit
+        is not cached, and its parts are joined once with its ancestors'
+        rather than at every level.
+        '''
+        frozen = self.is_frozen_()
+        json_ = _json_atom(self, internal, True, frozen)
+        if json_ is not None:  # a leaf, cached or leaves only
+            return json_
+        limit = _json_cache_limit // 16
+        stack = [_json_frame(self, internal, None, frozen)]
+        while True:
+            frame = stack[-1]
+            parts = frame[2]
+            for k, v in frame[1]:
+                json_ = _json_atom(v, internal, True, frame[6])
+                if json_ is None:
+                    stack.append(_json_frame(v, internal, _json_key(k),
+                        frame[6]))
+                    break
+                if frame[4]:
+                    parts.append(', ')
+                parts.append(_json_key(k) + ': ' + json_)
+                frame[4] += 1
+                frame[5] += len(json_)
+            else:
+                stack.pop()
+                parts.append('}')
+                size = frame[5]
+                if size <= limit:
+                    part = ''.join(parts)
+                    if frame[6]:
+                        _json_cache_put(frame[0], internal, part)
+                elif stack:
+                    part = parts  # joined later
+                else:
+                    part = _join_parts(parts)
+                if not stack:
+                    return part
+                parent = stack[-1]
+                if parent[4]:
+                    parent[2].append(', ')
+                parent[2].append(frame[3] + ': ')
+                parent[2].append(part)
+                parent[4] += 1
+                parent[5] += size
 
     def __repr__(self):
-        return "'<{} _oid={}>'".format(self.__class__, self.__dict__['_oid'])
+        return "'<{} _oid={}>'".format(self.__class__, self._oid)
 
     def is_empty_(self):
-        _is_empty = True 
-        for k in self.__dict__.keys():
-            if type(k) != str or not k.startswith('_'):
-                _is_empty = False
-        return _is_empty
+        return not self._children
 
     def delete_(self):
-        parent = self.__dict__['_parent']
-        if parent:
-            _oid = self.__dict__['_oid']
-            del parent.__dict__[_oid]
-        if parent and parent.is_empty_():
-            parent.delete_()
-
-    def _validation(self, key, value):
-        '''
-        Checks if the input value conforms to the schema.
-        '''
-        schema = self.__class__.__schema
-        if schema:
-            qname = self.qname_()
-            if qname[0] in schema:
-                for k in qname:
-                    if isinstance(k, frozendict):
-                        pass
-                    else:
-                        schema = schema[k]
-                s = schema[key]
-                if isinstance(value, dict):
-                    for k,v in value.items():
-                        if isinstance(v, dict): 
-                            pass
-                        else:
-                            if k in s and s[k]['type'] == type(v).__name__:
-                                pass
-                            else:
-                                raise Exception("schema violation, {}:{}".format(k,v))
-                else:
-                    if s['type'] == type(value).__name__:
-                        pass
-                    else:
-                        raise Exception("schema violation, {}:{}".format(key, value))
+        node = self
+        parent = node._parent
+        while parent:
+            del parent._children[node._oid]
+            if not parent.is_empty_():
+                break
+            node = parent
+            parent = node._parent
 
     # Python built-in types
     _builtin_types = [int, float, complex, str, tuple]
 
-    def _deepcopy_(self, new_parent=None):
+    def _copy_wrapped(self, parent):
         '''
-        It needs to remove all the attributes before copy operation,
-        otherwise the built-in type raises error.
+        Copies a wrapped value with its metadata (the value is immutable).
+        '''
+        c = type(self)(self)
+        c._version = self._version
+        c._parent = parent
+        c._oid = self._oid
+        c._ephemeral = self._ephemeral
+        return c
+
+    def _wrapped_qname_tuple(self):
+        '''
+        Returns the qname of a wrapped value (not cached: wrapped values
+        have no slots for it).
         '''
-        version = self._version
         parent = self._parent
-        oid = self._oid
-        ephemeral = self._ephemeral
-        del self._version
-        del self._parent
-        del self._oid
-        del self._ephemeral
-        # TODO: support deepcopy for wrapped types
-        #c = copy.deepcopy(self)
-        c = copy.copy(self)
-        self._version = version
-        self._parent = parent
-        self._oid = oid
-        self._ephemeral = ephemeral
-        c._parent = new_parent
-        c._version = version
-        c._oid = oid
-        c._ephemeral = ephemeral 
+        if parent is None:
+            return (self._oid,)
+        return parent._qname_tuple() + (self._oid,)
+
+    def _wrapped_path(self):
+        parent = self._parent
+        if parent is None:
+            return self._oid
+        return parent.path_() + '.' + self._oid
+
+    def _wrapped_json(self, internal):
+        return _encode(self.serialize_(internal=internal))
+
+    def _wrapped_dumps(self, internal=False):
+        return self._json_(internal)
+
+    def _deepcopy_(self, new_parent=None):
+        c = self._copy_wrapped(new_parent)
         self._deepcopy_parents(c)
         return c
     
@@ -461,24 +993,7 @@ class Cont(MutableMapping):
         Note: no operation for "freeze", since wrapped types are
         always immutable.
         '''
-        version = self._version
-        parent = self._parent
-        oid = self._oid
-        ephemeral = self._ephemeral
-        del self._version
-        del self._parent
-        del self._oid
-        del self._ephemeral
-        self._version = version
-        self._parent = parent
-        self._oid = oid
-        self._ephemeral = ephemeral
-        c = copy.copy(self)
-        c._parent = parent
-        c._version = version
-        c._oid = oid
-        c._ephemeral = ephemeral
-        return c
+        return self._copy_wrapped(self._parent)
 
     def _serialize_(self, internal=False, serialize_ephemeral=True):
         
@@ -488,23 +1003,29 @@ class Cont(MutableMapping):
         if internal:
             wrapped = {}
             wrapped['_value'] = self
-            wrapped['_version'] = self.__dict__['_version']
-            wrapped['_oid'] = self.__dict__['_oid']
-            wrapped['_parent'] = self.__dict__['_parent'].__dict__['_oid']
-            wrapped['_ephemeral'] = self.__dict__['_ephemeral']
+            wrapped['_version'] = self._version
+            wrapped['_oid'] = self._oid
+            wrapped['_parent'] = self._parent._oid
+            wrapped['_ephemeral'] = self._ephemeral
             return wrapped
         else:
             return self
 
     _attrs = {
-            '_qname': _qname,
+            '_parent': _parent,
+            '_children': _no_children,
+            '_copy_wrapped': _copy_wrapped,
+            '_qname_tuple': _wrapped_qname_tuple,
             'qname_': qname_,
+            'path_': _wrapped_path,
             '_deepcopy_parents': _deepcopy_parents,
             'deepcopy_': _deepcopy_,
             'copy_': _copy_,
             'change_': change_,
             'serialize_': _serialize_,
-            'dumps_': dumps_,
+            'dumps_': _wrapped_dumps,
+            'iterdumps_': iterdumps_,
+            '_json_': _wrapped_json,
             'delete_': delete_,
             'ephemeral_': ephemeral_,
             'is_ephemeral_': is_ephemeral_,
@@ -514,8 +1035,16 @@ class Cont(MutableMapping):
     _types = {}
     _wrapped_types = {}
 
+    # Wrapped types keep the metadata in slots, except for the types not
+    # supporting them (variable-size types such as int, str and tuple).
+    _wrapped_slots = ('_oid', '_parent_cell', '_version', '_ephemeral')
+
     for type_ in _builtin_types:
-        wrapped_type = type('wrapped_'+type_.__name__, (type_,), _attrs)
+        try:
+            wrapped_type = type('wrapped_'+type_.__name__, (type_,),
+                    dict(_attrs, __slots__=_wrapped_slots))
+        except TypeError:
+            wrapped_type = type('wrapped_'+type_.__name__, (type_,), _attrs)
         _types[type_] = wrapped_type 
         _wrapped_types[wrapped_type] = type_
 
@@ -537,25 +1066,29 @@ class Bool(Cont):
 
     Note: bool type cannot be extended.
     '''
+
+    __slots__ = ('_value',)
+    _metadata = Cont._metadata | {'_value'}
     
     def __init__(self, _oid, _parent, v):
         super().__init__(_oid, _parent)
+        set_meta(self, '_children', _no_children)
         if v == True or v == False:
-            self.__dict__['_value'] = v
+            set_meta(self, '_value', v)
         else:
             raise ValueError('Not boolean type')
 
     def __bool__(self):
-        return self.__dict__['_value']
+        return self._value
 
     def __str__(self):
-        return str(self.__dict__['_value'])
+        return str(self._value)
 
     def __repr__(self):
-        return repr(self.__dict__['_value'])
+        return repr(self._value)
 
     def __eq__(self, v):
-        if self.__dict__['_value'] == v:
+        if self._value == v:
             return True
         else:
             return False
@@ -568,21 +1101,14 @@ class Bool(Cont):
         if out is None:
             out = {}
         if internal:
-            for k,v in self.__dict__.items():
-                if k == '_value':
-                    out[k] = v
-                elif k == '_parent':
-                    s = v.__dict__['_oid']
-                    out[k] = s
-                elif self._is_serializable(k):
-                    out[k] = v
+            self._serialize_metadata(out)
+            out['_value'] = self._value
             return out
         else:
             return self.__bool__()
 
     def deepcopy_(self, new_parent=None):
-        _oid = self.__dict__['_oid']
-        bool_ = Bool(_oid, _parent=new_parent, v=self.__bool__())
+        bool_ = Bool(self._oid, _parent=new_parent, v=self.__bool__())
         self._deepcopy_parents(bool_)
         return bool_ 
 
@@ -590,26 +1116,30 @@ class RPC(Cont):
     '''
     This class is a wrapper for Func class.
     '''
+
+    __slots__ = ('_value',)
+    _metadata = Cont._metadata | {'_value'}
     
     def __init__(self, _oid, _parent, func):
         super().__init__(_oid, _parent)
-        self.__dict__['_value'] = func
+        set_meta(self, '_children', _no_children)
+        set_meta(self, '_value', func)
 
     @property
     def owner_id(self):
-        return self.__dict__['_value'].owner_id
+        return self._value.owner_id
 
     def _get_func(self):
-        return self.__dict__['_value']
+        return self._value
 
     def __str__(self):
-        return str(self.__dict__['_value'])
+        return str(self._value)
 
     def __repr__(self):
-        return repr(self.__dict__['_value'])
+        return repr(self._value)
 
     def __eq__(self, func):
-        if self.__dict__['_value'] == func:
+        if self._value == func:
             return True
         else:
             return False
@@ -622,24 +1152,148 @@ class RPC(Cont):
         if out is None:
             out = {}
         if internal:
-            for k,v in self.__dict__.items():
-                if k == '_value':
-                    out[k] = str(v)
-                elif k == '_parent':
-                    s = v.__dict__['_oid']
-                    out[k] = s
-                elif k != '_frozen':
-                    out[k] = v
+            self._serialize_metadata(out)
+            out['_value'] = str(self._value)
             return out
         else:
             return self.__str__()
 
     def deepcopy_(self, new_parent=None):
-        _oid = self.__dict__['_oid']
-        rpc = RPC(_oid, _parent=new_parent, func=self._get_func())
+        rpc = RPC(self._oid, _parent=new_parent, func=self._get_func())
         self._deepcopy_parents(rpc)
         return rpc 
 
+class Vector(Cont):
+    '''
+    Homogeneous numeric vector (e.g., a counter table) kept in an
+    array.array buffer as one leaf.
+
+    A Vector is immutable like the other leaves: updated_() returns a copy
+    with some of the elements replaced. The elements are read with
+    indexes and slices, or through a read-only memoryview (buffer_()),
+    e.g., numpy.frombuffer(vector.buffer_(), dtype).
+
+    It is serialized into a list, or encoded into base64 of the
+    little-endian buffer (encode_()).
+    '''
+
+    __slots__ = ('_value',)
+    _metadata = Cont._metadata | {'_value'}
+
+    def __init__(self, _oid, _parent, values, typecode=None):
+        '''
+        values is an array.array or a sequence of numbers, and typecode is
+        the one of array.array ('d' by default unless values is an
+        array.array).
+        '''
+        super().__init__(_oid, _parent)
+        set_meta(self, '_children', _no_children)
+        if typecode is None:
+            typecode = getattr(values, 'typecode', 'd')
+        if typecode not in VECTOR_TYPECODES:
+            raise ValueError('Not numeric typecode: {}'.format(typecode))
+        set_meta(self, '_value', array.array(typecode, values))
+
+    @property
+    def typecode(self):
+        return self._value.typecode
+
+    def __len__(self):
+        return len(self._value)
+
+    def __getitem__(self, index):
+        '''
+        Returns an element, or an array.array of a slice.
+        '''
+        return self._value[index]
+
+    def __iter__(self):
+        return iter(self._value)
+
+    def __str__(self):
+        return str(self._value.tolist())
+
+    def __repr__(self):
+        return repr(self._value)
+
+    def __eq__(self, v):
+        if isinstance(v, Vector):
+            v = v._value
+        return self._value.tolist() == list(v)
+
+    def buffer_(self):
+        '''
+        Returns a read-only memoryview of the buffer (of a copy of it before
+        Python 3.8).
+        '''
+        view = memoryview(self._value)
+        try:
+            return view.toreadonly()
+        except AttributeError:  # Python < 3.8
+            return memoryview(view.tobytes()).cast(view.format)
+
+    def updated_(self, values, start=0):
+        '''
+        Returns a copy with the elements from start replaced with values
+        (extended if values go beyond the end).
+        '''
+        vector = Vector(self._oid, self._parent, self._value)
+        values = array.array(self._value.typecode, values)
+        vector._value[start:start+len(values)] = values
+        return vector
+
+    def serialize_(self, internal=False, out=None,
+            serialize_ephemeral=True):
+
+        if not serialize_ephemeral and self.is_ephemeral_():
+            return None
+        if out is None:
+            out = {}
+        if internal:
+            self._serialize_metadata(out)
+            out['_value'] = self._value.tolist()
+            out['_typecode'] = self._value.typecode
+            return out
+        else:
+            return self._value.tolist()
+
+    def encode_(self, internal=False):
+        '''
+        Encodes the vector into a dict: {'_typecode': typecode, '_value':
+        base64 of the little-endian buffer} (with the metadata if
+        internal), which decode_vector() decodes.
+        '''
+        out = {}
+        if internal:
+            self._serialize_metadata(out)
+        value = self._value
+        if sys.byteorder == 'big':
+            value = array.array(value.typecode, value)
+            value.byteswap()
+        out['_value'] = base64.b64encode(value.tobytes()).decode('ascii')
+        out['_typecode'] = value.typecode
+        return out
+
+    def deepcopy_(self, new_parent=None):
+        vector = Vector(self._oid, new_parent, self._value)
+        self._deepcopy_parents(vector)
+        return vector
+
+# array.array typecodes of Vector
+VECTOR_TYPECODES = frozenset('bBhHiIlLqQfd')
+
+def decode_vector(_oid, _parent, value, typecode):
+    '''
+    Returns a Vector of a list or of base64 (see Vector.encode_()).
+    '''
+    if isinstance(value, str):
+        values = array.array(typecode)
+        values.frombytes(base64.b64decode(value))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        value = values
+    return Vector(_oid, _parent, value, typecode)
+
 class Func(object):
     '''
     A function as RPC.
@@ -1,5 +1,6 @@
-from tega.tree import Cont
+from tega.tree import Cont, Bool, Vector, decode_vector, set_meta, set_parent
 
+import array
 import copy
 import os
 import re
@@ -29,91 +30,145 @@ def path2url(path):
     return '/' + path.replace('.', '/') + '/'
 
 def instance2url(instance):
-    qname = instance.qname_()
-    url = ''
-    for v in qname:
-        url += '/' + v
-    url += '/'
-    return url
+    return path2url(instance.path_())
 
-def _dict2cont(cont, instance):
-    if isinstance(instance, dict):
-        for k,v in instance.items():
-            version = None
-            if isinstance(v, dict):
-                _dict2cont(cont[k], v)
-            else:
-                value = None
-                oid = None
-                if k.startswith('_'):
-                    if k == '_version':
-                        version = v
-                    elif k == '_value':
-                        value = instance['_value']
-                else:
-                    cont[k] = v
-                if value:
-                    parent = cont.__dict__['_parent']
-                    oid = cont.__dict__['_oid']
-                    parent[oid] = value
-                    cont = parent[oid]
-                    version = instance['_version']
-                if version:
-                    cont.__dict__['_version'] = version
+def _new_leaf(oid, parent, value):
+    '''
+    Creates a leaf of a built-in type value like Cont.__setattr__ does, or
+    sets the other values (e.g., wrapped types and Func) through
+    Cont.__setattr__.
+    '''
+    type_ = type(value)
+    if type_ in Cont._wrapped_types:  # copied, not re-parented
+        type_ = Cont._wrapped_types[type_]
+        value = type_(value)
+    elif type_ is list:  # list => tuple (immutable list)
+        value = tuple(value)
+        type_ = tuple
+    if type_ is bool:
+        leaf = Bool(oid, parent, value)
+    elif type_ in Cont._types:
+        leaf = Cont._types[type_](value)
+        set_meta(leaf, '_version', 0)
+        set_meta(leaf, '_parent', parent)
+        set_meta(leaf, '_oid', oid)
+        set_meta(leaf, '_ephemeral', False)
+        return leaf
     else:
-        parent = cont._parent
-        parent[cont._oid] = instance
+        parent[oid] = value
+        leaf = parent._children.pop(oid)
+    return leaf
+
+def _dict2cont(cont, instance):
+    '''
+    Builds the children of cont from a dict in one pass, bypassing
+    Cont.__setattr__ (immutability check, validation and type dispatch per
+    key).
 
+    A dict with "_value" is a leaf, and "_version" is the version of the
+    node (serialize_(internal=True)). The other keys starting with "_" are
+    ignored.
+    '''
+    types = Cont._types
+    stack = [(cont, instance)]
+    while stack:
+        cont, instance = stack.pop()
+        children = cont._children
+        for k, v in instance.items():
+            if type(k) is str and k[:1] == '_':
+                if k == '_version' and v:
+                    set_meta(cont, '_version', v)
+                continue
+            type_ = type(v)
+            if type_ in types:  # str, int, float...
+                leaf = types[type_](v)
+                set_meta(leaf, '_version', 0)
+                set_meta(leaf, '_parent', cont)
+                set_meta(leaf, '_oid', k)
+                set_meta(leaf, '_ephemeral', False)
+                children[k] = leaf
+            elif type_ is dict:
+                if '_typecode' in v:
+                    child = decode_vector(k, cont, v['_value'], v['_typecode'])
+                    if v.get('_version'):
+                        set_meta(child, '_version', v['_version'])
+                elif '_value' in v:
+                    child = _new_leaf(k, cont, v['_value'])
+                    if v.get('_version'):
+                        set_meta(child, '_version', v['_version'])
+                else:
+                    child = Cont(k, cont)
+                    stack.append((child, v))
+                children[k] = child
+            else:
+                children[k] = _new_leaf(k, cont, v)
 
-def dict2cont(dict_):
+def dict2cont(dict_, freeze=False):
     '''
-    Python dict to Cont
+    Python dict to Cont (frozen if freeze)
     '''
     root_oid = list(dict_)[0]
     cont = Cont(root_oid)
     _dict2cont(cont, dict_[root_oid])
+    if freeze:
+        cont.freeze_()
     return cont
 
-def subtree(path, value):
+def subtree(path, value, freeze=False):
     '''
-    Cont subtree
+    Cont subtree (frozen if freeze, including the parents on the path)
     '''
     qname = path2qname(path)
-    root_oid = qname[0]
-    cont = None
+    root = cont = Cont(qname[0])
     if len(qname) > 1:
-        cont = Cont(root_oid)
-        if isinstance(value, dict):
-            for k in qname[1:]:
-                cont = cont[k]
-            _dict2cont(cont, value)
+        for k in qname[1:-1]:
+            child = Cont(k, cont)
+            cont._children[k] = child
+            cont = child
+        k = qname[-1]
+        if isinstance(value, dict) and '_typecode' in value:
+            child = decode_vector(k, cont, value['_value'], value['_typecode'])
+            if value.get('_version'):
+                set_meta(child, '_version', value['_version'])
+        elif isinstance(value, dict) and '_value' in value:
+            child = _new_leaf(k, cont, value['_value'])
+            if value.get('_version'):
+                set_meta(child, '_version', value['_version'])
+        elif isinstance(value, dict):
+            child = Cont(k, cont)
+            _dict2cont(child, value)
         else:
-            if len(qname) > 2:
-                for k in qname[1:-1]:
-                    cont = cont[k]
-            k = qname[-1]
-            cont[k] = value
-            cont = cont[k]
+            child = _new_leaf(k, cont, value)
+        cont._children[k] = child
+    elif isinstance(value, dict):
+        child = cont
+        _dict2cont(child, value)
     else:
-        cont = Cont(root_oid)
-        if isinstance(value, dict):
-            _dict2cont(cont, value)
-        else:
-            raise ValueError('len(qname) <= 1 and its value is not dict')
-
-    return cont
+        raise ValueError('len(qname) <= 1 and its value is not dict')
+    if freeze:
+        root.freeze_()
+    return child
 
 def _deserialize(root, dict_):
-    for k, v in dict_.items():
-        if k.startswith('_'):
-            root.__dict__[k] = v
-        else:
-            value = dict_[k]
-            if '_value' in value: 
-                root[k] = value['_value']
-                root[k].__dict__['_version'] = value['_version']
+    stack = [(root, dict_)]
+    while stack:
+        cont, dict_ = stack.pop()
+        for k, v in dict_.items():
+            if k.startswith('_'):
+                if k != '_parent' or cont is root:
+                    set_meta(cont, k, v)
             else:
-                root[k] = _deserialize(Cont(k), value)
+                value = dict_[k]
+                if '_typecode' in value:
+                    cont[k] = decode_vector(k, cont, value['_value'],
+                            value['_typecode'])
+                    set_meta(cont[k], '_version', value['_version'])
+                elif '_value' in value: 
+                    cont[k] = value['_value']
+                    set_meta(cont[k], '_version', value['_version'])
+                else:
+                    cont[k] = Cont(k)
+                    stack.append((cont[k], value))
     return root
 
 def deserialize(dict_):
@@ -125,51 +180,143 @@ def deserialize(dict_):
     _deserialize(root, dict_)
     return root
 
+def _pack_node(node, ids, nodes):
+    key = id(node)
+    if key in ids:
+        return ids[key]
+    index = len(nodes)
+    ids[key] = index
+    nodes.append(node)  # packed below with the new nodes in its subtree
+    i = index
+    while i < len(nodes):
+        node = nodes[i]
+        type_ = type(node)
+        frozen = None
+        if type_ == Cont:
+            kind = 'Cont'
+            value = []
+            for k, v in node.items():
+                key = id(v)
+                if key not in ids:
+                    ids[key] = len(nodes)
+                    nodes.append(v)
+                value.append((k, ids[key]))
+            frozen = node._frozen
+        elif type_ == Bool:
+            kind = 'Bool'
+            value = node._value
+            frozen = node._frozen
+        elif type_ == Vector:
+            kind = 'Vector'
+            value = (node._value.typecode, node._value.tobytes())
+            frozen = node._frozen
+        elif type_ in Cont._wrapped_types:
+            builtin = Cont._wrapped_types[type_]
+            kind = builtin.__name__
+            value = builtin(node)
+        else:
+            raise ValueError('unsupported node: {}'.format(type_))
+        nodes[i] = [kind, node._oid, node._version, node._ephemeral, frozen,
+                value, node._parent]
+        i += 1
+    return index
+
+def pack_trees(trees):
+    '''
+    Packs trees into a list of plain tuples (picklable), keeping the
+    subtrees shared among the trees (e.g., old roots) and the parent
+    references.
+
+    Returns (nodes, indexes of the trees).
+    '''
+    ids = {}
+    nodes = []
+    indexes = [_pack_node(tree, ids, nodes) for tree in trees]
+    i = 0
+    while i < len(nodes):  # the parents might be out of the trees
+        parent = nodes[i][6]
+        if parent is not None:
+            nodes[i][6] = _pack_node(parent, ids, nodes)
+        else:
+            nodes[i][6] = -1
+        i += 1
+    return [tuple(node) for node in nodes], indexes
+
+def unpack_trees(packed):
+    '''
+    Unpacks the trees packed by pack_trees().
+    '''
+    nodes, indexes = packed
+    objs = []
+    for kind, oid, version, ephemeral, frozen, value, parent in nodes:
+        if kind == 'Cont':
+            obj = Cont(oid, _version=version)
+        elif kind == 'Bool':
+            obj = Bool(oid, None, value)
+            set_meta(obj, '_version', version)
+        elif kind == 'Vector':
+            obj = Vector(oid, None, array.array(value[0]))
+            obj._value.frombytes(value[1])
+            set_meta(obj, '_version', version)
+        else:
+            obj = Cont._types[type(value)](value)
+            set_meta(obj, '_version', version)
+            set_meta(obj, '_parent', None)
+            set_meta(obj, '_oid', oid)
+        set_meta(obj, '_ephemeral', ephemeral)
+        if frozen is not None:
+            set_meta(obj, '_frozen', frozen)
+        objs.append(obj)
+    for obj, node in zip(objs, nodes):
+        kind, value, parent = node[0], node[5], node[6]
+        if parent >= 0:
+            set_meta(obj, '_parent', objs[parent])
+        if kind == 'Cont':
+            for k, child in value:
+                obj._children[k] = objs[child]
+    return [objs[index] for index in indexes]
+
 _quoted_arg_matcher = re.compile('\s*([\'\"]+[\w\s\.\/-]*[\'\"]+)\s*')
 
 def align_vector(cont):
     '''
     Aligns references between parents and children
     '''
-    for k in cont:
-        child = cont[k]
-        child.__dict__['_parent'] = cont
-        if isinstance(child, Cont):
-            align_vector(child)
-
-def align_vector2(cont, version):
-    '''
-    Aligns references between parents and children
-    with older versions
-    '''
-    for k in cont:
-        child = cont[k]
-        if child._version != version:
-            child.__dict__['_parent'] = cont
-        elif isinstance(child, Cont):
-            align_vector2(child, version)
+    stack = [cont]
+    while stack:
+        cont = stack.pop()
+        for child in cont._children.values():
+            set_parent(child, cont)
+            if isinstance(child, Cont):
+                stack.append(child)
 
-def _edge(qname, version):
-    return '{}({})'.format('.'.join(qname), version)
+def _edge(path, version):
+    return '{}({})'.format(path, version)
 
 def edges(cont):
     '''
     Generates edges of a Cont object recursively
     '''
-    parent_qname = cont.qname_()
-    parent_version = cont['_version']
-    for child in cont.values():
-        child_qname = child.qname_()
-        child_version = child.__dict__['_version']
-        yield [_edge(parent_qname, parent_version),
-                _edge(child_qname, child_version)]
-        c_parent = child.__dict__['_parent']
-        c_parent_qname = c_parent.qname_()
-        c_parent_version = c_parent['_version']
-        yield [_edge(child_qname, child_version),
-                _edge(c_parent_qname, c_parent_version)]
-        if isinstance(child, Cont):
-            yield from edges(child)
+    stack = [(cont, iter(cont.values()))]
+    while stack:
+        cont, children = stack[-1]
+        parent_path = cont.path_()
+        parent_version = cont._version
+        for child in children:
+            child_path = child.path_()
+            child_version = child._version
+            yield [_edge(parent_path, parent_version),
+                    _edge(child_path, child_version)]
+            c_parent = child._parent
+            c_parent_path = c_parent.path_()
+            c_parent_version = c_parent._version
+            yield [_edge(child_path, child_version),
+                    _edge(c_parent_path, c_parent_version)]
+            if isinstance(child, Cont):
+                stack.append((child, iter(child.values())))
+                break
+        else:
+            stack.pop()
 
 def eval_arg(arg):
     '''
@@ -221,41 +368,13 @@ def commit_log_number(server_tega_id, dir_):
     list_ = os.listdir(dir_)
     for n in list_:
         s = n.split('.')
-        if s[0] == 'log' and s[1] == server_tega_id:
+        if len(s) == 3 and s[0] == 'log' and s[1] == server_tega_id and \
+                s[2].isdigit():
             num = int(s[-1])
             if num > max_:
                 max_ = num
     return max_
 
-def readline_reverse(fd):
-    '''
-    readline() in reversed order
-
-    Caveat: the first value yielded by this generator is ''
-    that should be ignored by the consumer in most of cases.
-
-    Usage example:
-
-    with open('test.txt') as fd:
-        g = readline_reverse(fd)
-        print(next(g))
-        print(next(g))
-             :
-    '''
-    fd.seek(0, os.SEEK_END)
-    p = fd.tell()
-    line = ''
-    while p >= 0:
-        fd.seek(p)
-        char = fd.read(1)
-        if char == "\n":
-            yield line[::-1]
-            line = ''
-        else:
-            line += char
-        p -= 1
-    yield line[::-1]
-
 def nested_regex_path(regex_path):
     '''
     Returns nested regex path as a match pattern
@@ -1,6 +1,9 @@
 DIR=`pwd`
+python $DIR/test_hamt.py
 python $DIR/test_tree.py
 python $DIR/test_util.py
+python $DIR/test_schema.py
+python $DIR/test_commitlog.py
 python $DIR/test_idb.py
 python $DIR/test_driver.py
 
@@ -0,0 +1,245 @@
+import errno
+import os
+import tempfile
+import unittest
+
+import tega.commitlog
+from tega.commitlog import RECORD_TX, RECORD_ROLLBACK
+
+class TornFile(object):
+    '''
+    Writes half of a record and fails (e.g., the disk is full).
+    '''
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __getattr__(self, name):
+        return getattr(self.fd, name)
+
+    def write(self, b):
+        self.fd.write(b[:len(b) // 2])
+        self.fd.flush()
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+class TestSequence(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'log.test.0')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _write(self, *records):
+        with open(self.path, 'ab+') as fd:
+            tega.commitlog.write_magic(fd)
+            for record in records:
+                fd.write(record)
+
+    def test_read_records(self):
+        log = {'ope': 'PUT', 'path': 'r.a', 'tega_id': 'x',
+                'instance': {'b': 1, 'c': [1, 2]}}
+        self._write(tega.commitlog.tx_record([log], 'ts0'),
+                tega.commitlog.rollback_record(-1, 'x', 'r'))
+        with open(self.path, 'rb') as fd:
+            records = list(tega.commitlog.read_records(fd))
+        self.assertEqual([(RECORD_TX, {'ts': 'ts0', 'logs': [log]}),
+            (RECORD_ROLLBACK, {'backto': -1, 'tega_id': 'x', 'root_oid': 'r'})],
+            records)
+
+    def test_read_records_reverse(self):
+        records = [tega.commitlog.tx_record([{'n': n}], str(n))
+                for n in range(10)]
+        self._write(*records)
+        with open(self.path, 'rb') as fd:
+            n = [record['logs'][0]['n'] for type_, record
+                    in tega.commitlog.read_records_reverse(fd)]
+        self.assertEqual(list(reversed(range(10))), n)
+
+    def test_torn_tail(self):
+        record = tega.commitlog.tx_record([{'n': 1}], 'ts')
+        self._write(record, record[:-3])
+        with open(self.path, 'rb') as fd:
+            self.assertEqual(1, len(list(tega.commitlog.read_records(fd))))
+            self.assertEqual(1,
+                    len(list(tega.commitlog.read_records_reverse(fd))))
+
+        tega.commitlog.truncate_tail(self.path)
+        self._write(record)
+        with open(self.path, 'rb') as fd:
+            self.assertEqual(2, len(list(tega.commitlog.read_records(fd))))
+
+    def test_segment_reader(self):
+        records = [tega.commitlog.tx_record([{'n': n}], str(n))
+                for n in range(5)]
+        corrupted = bytearray(records[3])
+        corrupted[12] ^= 0xff  # a byte in the payload
+        self._write(records[0], records[1], records[2], bytes(corrupted),
+                records[4])
+        with open(self.path, 'rb') as fd:
+            with tega.commitlog.SegmentReader(fd) as reader:
+                forward = [(offset, type_, bytes(payload)) for
+                        offset, type_, payload in reader.records()]
+                reverse = [(offset, type_, bytes(payload)) for
+                        offset, type_, payload in reader.records_reverse()]
+                self.assertEqual(3, len(forward))
+                self.assertEqual(forward[::-1], reverse)
+                end = forward[-1][0] + len(records[2])
+                self.assertEqual(end, reader.end())
+                offset, type_, payload = next(reader.records(forward[1][0]))
+                self.assertIsInstance(payload, memoryview)  # zero-copy
+                self.assertEqual({'ts': '1', 'logs': [{'n': 1}]},
+                        tega.commitlog.decode_payload(payload))
+                del payload
+
+    def test_compression(self):
+        logs = [{'ope': 'PUT', 'path': 'r.a{}'.format(n), 'tega_id': 'x',
+            'instance': {'name': 'NE{}'.format(n), 'address': '10.10.10.10/24'}}
+            for n in range(20)]
+        records = [tega.commitlog.tx_record(logs, str(n), {'r': n},
+            compress=True) for n in range(5)]
+        self.assertTrue(len(records[0]) <
+                len(tega.commitlog.tx_record(logs, '0', {'r': 0})))
+        self._write(*records)
+        with open(self.path, 'rb') as fd:
+            forward = [record['ts'] for type_, record
+                    in tega.commitlog.read_records(fd)]
+            reverse = [record['ts'] for type_, record
+                    in tega.commitlog.read_records_reverse(fd)]
+        self.assertEqual(['0', '1', '2', '3', '4'], forward)
+        self.assertEqual(forward[::-1], reverse)
+        stats = tega.commitlog.compression_stats()
+        self.assertTrue(stats['ratio'] < 1)
+
+    def test_compress_segment(self):
+        index_path = os.path.join(self.dir.name, 'idx.test.0')
+        logs = [{'ope': 'PUT', 'path': 'r.a', 'tega_id': 'x',
+            'instance': {'b': 'x' * 100}}]
+        self._write(*[tega.commitlog.tx_record(logs, str(n), {'r': n})
+            for n in range(10)])
+        tega.commitlog.build_index(self.path, index_path)
+        with open(self.path, 'rb') as fd:
+            expected = list(tega.commitlog.read_records(fd))
+        size, compressed_size = tega.commitlog.compress_segment(self.path,
+                index_path)
+        self.assertEqual(os.path.getsize(self.path), compressed_size)
+        self.assertTrue(compressed_size < size)
+        with open(self.path, 'rb') as fd:
+            self.assertEqual(expected, list(tega.commitlog.read_records(fd)))
+            with open(index_path, 'rb') as index_fd:
+                offset = [offset for root_oid, version, offset
+                        in tega.commitlog.read_index(index_fd)
+                        if version == 7][0]
+            type_, record = next(tega.commitlog.read_records(fd, offset))
+            self.assertEqual('7', record['ts'])
+
+    def test_log_writer(self):
+        fd = open(self.path, 'ab+')
+        tega.commitlog.write_magic(fd)
+        writer = tega.commitlog.LogWriter(fd, background=True)
+        self.assertFalse(writer.running)  # started by the first record
+        futures = [writer.append(tega.commitlog.tx_record([{'n': n}], str(n)))
+                for n in range(100)]
+        path2 = os.path.join(self.dir.name, 'log.test.1')
+        fd2 = open(path2, 'ab+')
+        tega.commitlog.write_magic(fd2)
+        futures.append(writer.rotate(fd2))
+        futures.append(writer.append(tega.commitlog.tx_record([{'n': 100}],
+            '100')))
+        writer.flush().result()
+        self.assertTrue(writer.running)
+        self.assertTrue(all([future.done() for future in futures]))
+        self.assertEqual(101, writer.records)
+        self.assertTrue(writer.batches <= 101)
+        writer.close()
+        self.assertTrue(fd.closed and fd2.closed)
+
+        with open(self.path, 'rb') as fd:
+            n = [record['logs'][0]['n'] for type_, record
+                    in tega.commitlog.read_records(fd)]
+        self.assertEqual(list(range(100)), n)
+        with open(path2, 'rb') as fd:
+            n = [record['logs'][0]['n'] for type_, record
+                    in tega.commitlog.read_records(fd)]
+        self.assertEqual([100], n)
+
+    def test_log_writer_failure(self):
+        index_path = os.path.join(self.dir.name, 'idx.test.0')
+        for background in (True, False):
+            fd = open(self.path, 'ab+')
+            tega.commitlog.write_magic(fd)
+            writer = tega.commitlog.LogWriter(fd, background=background,
+                    index_fd=open(index_path, 'ab'))
+            writer.append(tega.commitlog.tx_record([{'n': 0}], '0', {'a': 0}),
+                    versions={'a': 0}).result()
+            size = os.path.getsize(self.path)
+            index_size = os.path.getsize(index_path)
+
+            writer.fd = TornFile(fd)
+            with self.assertRaises(OSError):
+                writer.append(tega.commitlog.tx_record([{'n': 1}], '1',
+                    {'a': 1}), versions={'a': 1}).result()
+            with self.assertRaises(IOError):  # rejected
+                writer.append(tega.commitlog.tx_record([{'n': 2}], '2'))
+            writer.close()
+
+            self.assertEqual(size, os.path.getsize(self.path))
+            self.assertEqual(index_size, os.path.getsize(index_path))
+            with open(self.path, 'rb') as fd:
+                self.assertEqual([0], [record['logs'][0]['n'] for type_, record
+                    in tega.commitlog.read_records(fd)])
+            os.remove(self.path)
+            os.remove(index_path)
+
+    def test_version_index(self):
+        index_path = os.path.join(self.dir.name, 'idx.test.0')
+        fd = open(self.path, 'ab+')
+        tega.commitlog.write_magic(fd)
+        writer = tega.commitlog.LogWriter(fd, background=True,
+                index_fd=open(index_path, 'ab'))
+        for n in range(10):
+            versions = {'a': n, 'b': n * 2} if n % 2 else {'a': n}
+            writer.append(tega.commitlog.tx_record([{'n': n}], str(n),
+                versions), versions=versions)
+        writer.append(tega.commitlog.rollback_record(-1, 'x', 'a', 10),
+                versions={'a': 10})
+        writer.close()
+
+        with open(index_path, 'rb') as fd:
+            entries = list(tega.commitlog.read_index(fd))
+        self.assertEqual(list(range(11)),
+                [version for root_oid, version, offset in entries
+                    if root_oid == 'a'])
+        with open(self.path, 'rb') as fd:
+            offset = [offset for root_oid, version, offset in entries
+                    if root_oid == 'b' and version == 14][0]
+            type_, record = next(tega.commitlog.read_records(fd, offset))
+            self.assertEqual(7, record['logs'][0]['n'])
+
+        # Rebuilt from the segment
+        os.remove(index_path)
+        tega.commitlog.build_index(self.path, index_path)
+        with open(index_path, 'rb') as fd:
+            self.assertEqual(entries, list(tega.commitlog.read_index(fd)))
+
+    def test_convert_legacy(self):
+        with open(self.path, 'w') as fd:
+            fd.write("?\n{'instance': 1, 'path': 'r.a', 'tega_id': 'x', 'ope': 'PUT'}\n")
+            fd.write("@2016-01-11 23:36:34.876741\n")
+            fd.write("-1 x r\n")
+            fd.write("?\n{'instance': 2, 'path': 'r.b', 'tega_id': 'x', 'ope': 'PUT'}\n")
+        self.assertTrue(tega.commitlog.is_legacy(self.path))
+        tega.commitlog.convert_legacy_in_place(self.path)
+        self.assertFalse(tega.commitlog.is_legacy(self.path))
+        self.assertTrue(os.path.exists(self.path + '.legacy'))
+        with open(self.path, 'rb') as fd:
+            records = list(tega.commitlog.read_records(fd))
+        self.assertEqual([(RECORD_TX, {'ts': '2016-01-11 23:36:34.876741',
+            'logs': [{'instance': 1, 'path': 'r.a', 'tega_id': 'x',
+                'ope': 'PUT'}]}),
+            (RECORD_ROLLBACK, {'backto': -1, 'tega_id': 'x', 'root_oid': 'r'})],
+            records)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
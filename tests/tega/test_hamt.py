@@ -0,0 +1,109 @@
+import random
+import unittest
+
+from tega.hamt import Hamt
+
+class Collider(object):
+    '''
+    A key with a given hash
+    '''
+
+    def __init__(self, value, hash_):
+        self.value = value
+        self.hash_ = hash_
+
+    def __hash__(self):
+        return self.hash_
+
+    def __eq__(self, other):
+        return isinstance(other, Collider) and self.value == other.value
+
+class TestSequence(unittest.TestCase):
+
+    def test_mapping(self):
+        h = Hamt({'a': 1, 'b': 2})
+        h['c'] = 3
+        h['a'] = 0
+        self.assertEqual(3, len(h))
+        self.assertEqual({'a': 0, 'b': 2, 'c': 3}, dict(h.items()))
+        self.assertTrue('b' in h)
+        self.assertEqual(2, h.pop('b'))
+        self.assertFalse('b' in h)
+        self.assertIsNone(h.get('b'))
+        with self.assertRaises(KeyError):
+            del h['b']
+        del h['a']
+        del h['c']
+        self.assertEqual(0, len(h))
+        self.assertEqual([], list(h))
+
+    def test_copy(self):
+        h = Hamt({str(i): i for i in range(1000)})
+        h2 = h.copy()
+        h2['0'] = -1
+        del h2['1']
+        h['2'] = -2
+        self.assertEqual(0, h['0'])
+        self.assertEqual(1, h['1'])
+        self.assertEqual(2, h2['2'])
+        self.assertEqual(-1, h2['0'])
+        self.assertEqual(1000, len(h))
+        self.assertEqual(999, len(h2))
+        self.assertTrue(any(n1 is n2 for n1, n2 in
+            zip(h._root.array, h2._root.array)))  # shared
+        self.assertLess(h.sizeof(h2), h.sizeof() / 10)
+        self.assertEqual(h.sizeof(), h.sizeof(Hamt()))
+
+    def test_collision(self):
+        keys = [Collider(i, 7) for i in range(5)]
+        h = Hamt()
+        for i, key in enumerate(keys):
+            h[key] = i
+        self.assertEqual(list(range(5)), [h[key] for key in keys])
+        h2 = h.copy()
+        for key in keys[:4]:
+            del h2[key]
+        self.assertEqual([4], list(h2.values()))
+        self.assertEqual(5, len(list(h.items())))
+
+    def test_order(self):
+        keys = [str(i) for i in range(2000)]
+        random.seed(0)
+        random.shuffle(keys)
+        h = Hamt({key: 0 for key in keys})
+        h2 = h.copy()
+        h2[keys[0]] = 1  # keeps the position
+        for key in keys[1:1500]:
+            del h2[key]  # compacted
+        h2['new'] = 2
+        self.assertEqual(keys, list(h))
+        self.assertEqual(keys[:1] + keys[1500:] + ['new'], list(h2))
+        self.assertEqual(([1] + [0] * 500 + [2]), list(h2.values()))
+        items = h2.items()
+        self.assertEqual(list(items), list(items))  # a view
+        self.assertIn(('new', 2), items)
+        self.assertEqual(len(h2), len(items))
+
+    def test_random(self):
+        random.seed(0)
+        keys = [str(i) for i in range(200)] + list(range(100)) + \
+                [Collider(i, i % 3) for i in range(20)]
+        d = {}
+        h = Hamt()
+        copies = []
+        for i in range(5000):
+            key = random.choice(keys)
+            if random.random() < 0.6:
+                d[key] = h[key] = i
+            elif key in d:
+                del d[key]
+                del h[key]
+            if i % 500 == 0:
+                copies.append((dict(d), h.copy()))
+        self.assertEqual(list(d.items()), list(h.items()))
+        for d_, h_ in copies:
+            self.assertEqual(list(d_.items()), list(h_.items()))
+            self.assertEqual(len(d_), len(h_))
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
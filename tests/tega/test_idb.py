@@ -1,8 +1,17 @@
+import gc
 import os
+import tempfile
+import time
+import tracemalloc
 import unittest
 
+from tega.compaction import CompactionPolicy
 import tega.idb
+import tega.hamt
 import tega.tree
+import tega.util
+
+import tornado.ioloop
 
 tega_id = 'test_idb'
 script_dir = os.getcwd() + '/servers'
@@ -28,6 +37,9 @@ class TestSequence(unittest.TestCase):
         tega.idb.clear()
         tega.idb.stop()
 
+    def run_sync(self, func, *args):
+        return tornado.ioloop.IOLoop.current().run_sync(lambda: func(*args))
+
     def set_up_idb(self):
 
         inventory = tega.tree.Cont('inventory')
@@ -91,6 +103,272 @@ class TestSequence(unittest.TestCase):
         self.assertEqual(tega.idb.get(path='a.b.c'), 1)
 
 
+    def test_put_bool_rpc(self):
+        a = tega.tree.Cont('a')
+        a.b.t = True
+        a.b.f = tega.tree.Func(tega_id, max)
+        with tega.idb.tx() as t:
+            t.put(a.b.t)
+            t.put(a.b.f)
+        self.assertIs(True, t.commit_queue[0]['instance'])
+        self.assertIsInstance(tega.idb.get('a.b.t'), tega.tree.Bool)
+        self.assertEqual(3, tega.idb.rpc('a.b.f', args=[1, 3]))
+
+    def test_put_false(self):
+        a = tega.tree.Cont('a')
+        a.b.f = False
+        with tega.idb.tx() as t:
+            t.put(a.b.f)
+        self.assertIs(False, t.commit_queue[0]['instance'])
+        tega.idb._idb.clear()
+        tega.idb._old_roots.clear()
+        tega.idb.reload_log()
+        self.assertIsInstance(tega.idb.get('a.b.f'), tega.tree.Bool)
+        self.assertFalse(tega.idb.get('a.b.f'))
+
+    def test_put_below_leaf(self):
+        with tega.idb.tx() as t:
+            t.put(path='a.b', instance=dict(c=1, d=True))
+        for path in ('a.b.c.x', 'a.b.c.x.y', 'a.b.d.x'):
+            with self.assertRaises(ValueError):
+                with tega.idb.tx() as t:
+                    t.put(path=path, instance=dict(z=1))
+        with self.assertRaises(ValueError):
+            with tega.idb.tx() as t:
+                t.delete('a.b.c.x')
+        with self.assertRaises(ValueError):
+            with tega.idb.tx() as t:
+                t.put(path='a.b', instance=dict(e=1))
+                t.put(path='a.b.e.x', instance=dict(z=1))
+        self.assertEqual({'b': {'c': 1, 'd': True}}, tega.idb.get('a'))
+        self.assertEqual(0, tega.idb.get('a')._version)
+
+    def test_put_frozen(self):
+        a = tega.tree.Cont('a')
+        a.b.c = 1
+        a.freeze_()
+        with tega.idb.tx() as t:
+            t.put(a.b)  # zero-copy
+        self.assertIs(a.b, tega.idb.get('a.b'))
+        self.assertIs(a.b.c, tega.idb.get('a.b.c'))
+        self.assertEqual(0, a.b._version)
+
+        x = tega.tree.Cont('a')
+        x.b.d = 2
+        with tega.idb.tx() as t:
+            t.put(x.b)  # copied
+        self.assertIsNot(x.b, tega.idb.get('a.b'))
+        self.assertIs(a.b, tega.idb.get('a.b', version=0))
+
+        b = tega.idb.get('a.b', version=0)
+        with tega.idb.tx() as t:
+            t.put(b)  # copied (in the old version)
+        self.assertIsNot(b, tega.idb.get('a.b'))
+        self.assertEqual(0, b._version)
+        self.assertEqual({'c': 1}, tega.idb.get('a.b'))
+
+    def test_vector(self):
+        with tega.idb.tx() as t:
+            t.put(path='r.counters', instance={'_typecode': 'q',
+                '_value': list(range(1000))})
+        with tega.idb.tx() as t:
+            t.update_vector('r.counters', [-1, -2], start=10)
+        self.assertEqual(1, len(t.commit_queue))  # one log entry
+        self.assertEqual('q', t.commit_queue[0]['instance']['_typecode'])
+        with tega.idb.tx() as t:
+            t.update_vector('r.counters', [0], start=998)
+            t.update_vector('r.counters', [-3], start=999)
+        vector = tega.idb.get('r.counters')
+        self.assertIsInstance(vector, tega.tree.Vector)
+        self.assertEqual([9, -1, -2, 12], list(
+            tega.idb.get_slice('r.counters', 9, 13)))
+        self.assertEqual([0, -3], list(vector[998:]))
+        self.assertEqual(10, tega.idb.get_slice('r.counters', 10, 11,
+            version=0)[0])
+        with self.assertRaises(ValueError):
+            with tega.idb.tx() as t:
+                t.update_vector('r', [1])
+
+        tega.idb.save_snapshot(tega_id).result()
+        with tega.idb.tx() as t:
+            t.update_vector('r.counters', [7])
+        expected = tega.idb.get('r').serialize_(internal=True)
+        tega.idb._idb.clear()
+        tega.idb._old_roots.clear()
+        tega.idb.reload_log()
+        self.assertIsInstance(tega.idb.get('r.counters'), tega.tree.Vector)
+        self.assertEqual(expected, tega.idb.get('r').serialize_(internal=True))
+
+    def test_path_index(self):
+        with tega.idb.tx() as t:
+            t.put(path='r.a', instance={'b': {'c': 1}, 'd': {'e': {'f': 2}}})
+        with tega.idb.tx() as t:  # a frozen root
+            t.put(path='r.x', instance={'y': 1})
+        self.assertEqual(1, tega.idb.get('r.a.b.c'))  # builds the index
+        index = tega.idb._path_index(tega.idb.get('r'), build=False)
+        self.assertEqual({'r', 'r.a', 'r.a.b', 'r.a.d', 'r.a.d.e', 'r.x'},
+                set(index))
+        with tega.idb.tx() as t:
+            t.put(path='r.a.d', instance={'g': {'h': 3}})
+            t.delete('r.x.y')  # deletes r.x too
+            t.put(path='r.a.b.i', instance={'j': 4})
+        root = tega.idb.get('r')
+        index = tega.idb._path_index(root, build=False)  # carried over
+        self.assertEqual({'r', 'r.a', 'r.a.b', 'r.a.b.i', 'r.a.d', 'r.a.d.g'},
+                set(index))
+        for path, node in index.items():
+            walked = root
+            for oid in path.split('.')[1:]:
+                walked = walked._children[oid]
+            self.assertIs(walked, node)
+        self.assertEqual(3, tega.idb.get('r.a.d.g.h'))
+        self.assertEqual(2, tega.idb.get('r.a.d.e.f', version=1))
+        self.assertEqual(1, tega.idb.get('r.x.y', version=-1))
+        for path in ('r.x', 'r.a.d.e', 'r.a.b.c.z', 'r.a.', 's.a'):
+            with self.assertRaises(KeyError):
+                tega.idb.get(path)
+
+        tega.idb.rollback(tega_id, 'r', -1)
+        self.assertEqual(2, tega.idb.get('r.a.d.e.f'))
+        with tega.idb.tx() as t:
+            t.put(path='r.a.b', instance={'k': 5})
+        self.assertEqual(5, tega.idb.get('r.a.b.k'))
+        with self.assertRaises(KeyError):
+            tega.idb.get('r.a.b.c')
+
+    def test_old_roots(self):
+        old = tega.idb.OldRoots(maxlen=2)
+        for version in range(3):
+            old.append((version, str(version)))
+        self.assertEqual([(1, '1'), (2, '2')], list(old))
+        self.assertEqual('2', old.get(2))
+        self.assertIsNone(old.get(0))
+        self.assertEqual((2, '2'), old.pop())
+        self.assertEqual(1, len(old))
+
+        old = tega.idb.OldRoots(max_bytes=100)
+        for version in range(3):
+            old.append((version, str(version)), 40)
+        self.assertEqual([1, 2], [version for version, root in old])
+        self.assertEqual(80, old.bytes)
+        old.append((3, '3'), 200)  # larger than the budget
+        self.assertEqual(([], 0), (list(old), old.bytes))
+
+        old = tega.idb.OldRoots(max_age=60)
+        old.append((0, '0'))
+        old._roots[0] = ('0', 0, time.time() - 61)
+        old.append((1, '1'))
+        self.assertEqual([(1, '1')], list(old))
+
+    def test_old_roots_bytes(self):
+        tega.idb.old_roots_len = None
+        tega.idb.old_roots_bytes = 280 * 1024
+        with tega.idb.tx() as t:
+            t.put(path='r', instance={'big': {str(i): i for i in range(1000)},
+                'small': {'x': 0}})
+        for i in range(1, 50):
+            with tega.idb.tx() as t:
+                t.put(path='r.small', instance={'x': i})
+        old = tega.idb._old_roots['r']
+        self.assertEqual(49, len(old))  # the big subtree is shared
+        self.assertLess(old.size(0), 2 * 1024)
+        self.assertEqual(sum(old.size(v) for v in range(49)), old.bytes)
+        stats = tega.idb.stats()['old_roots']
+        self.assertEqual({'versions': 49, 'bytes': old.bytes},
+                stats['roots']['r'])
+
+        with tega.idb.tx() as t:  # replaces the big subtree
+            t.put(path='r.big', instance={'0': 0})
+        self.assertGreater(old.size(49), 40 * 1024)
+        self.assertLessEqual(old.bytes, tega.idb.old_roots_bytes)
+        versions = [version for version, root in old]
+        self.assertTrue(1 < len(versions) < 49)  # the oldest evicted
+        self.assertEqual(list(range(50 - len(versions), 50)), versions)
+        self.assertEqual(1, tega.idb.get('r.big.1', version=-1))
+
+    def test_snapshot_handle(self):
+        with tega.idb.tx() as t:
+            t.put(path='a', instance={'x': 1})
+            t.put(path='b', instance={'y': 1})
+        with tega.idb.tx() as t:
+            t.put(path='a', instance={'x': 2})
+        s = tega.idb.snapshot()
+        self.assertEqual({'a': 1, 'b': 0}, s.versions())
+        with tega.idb.tx() as t:
+            t.put(path='a', instance={'x': 3})
+            t.put(path='b', instance={'y': 3})
+            t.put(path='c', instance={'z': 3})
+        self.assertEqual(2, s.get('a.x'))
+        self.assertEqual(1, s.get('b.y'))
+        self.assertEqual(1, s.get('a.x', version=0))
+        self.assertEqual(1, s.get('a.x', version=-1))
+        self.assertEqual(['a', 'b'],
+                sorted(m[0] for m in s.get('[a-c]', regex_flag=True)))
+        for path, version in (('c.z', None), ('a.x', 2)):
+            with self.assertRaises(KeyError):
+                s.get(path, version=version)
+        self.assertEqual(3, tega.idb.get('a.x'))
+        self.assertEqual(2, tega.idb.get('a.x', version=1))
+
+    def test_wide_node(self):
+        width = tega.tree.WIDE_NODE + 1
+        with tega.idb.tx() as t:
+            t.put(path='r.routes', instance={str(i): {'nexthop': i}
+                for i in range(width)})
+        with tega.idb.tx() as t:
+            t.put(path='r.routes.0.nexthop', instance={'a': 1})
+        with tega.idb.tx() as t:
+            t.delete('r.routes.1')
+
+        routes = tega.idb.get('r.routes')
+        routes0 = tega.idb.get('r.routes', version=0)
+        self.assertIsInstance(routes._children, tega.hamt.Hamt)
+        self.assertEqual(width - 1, len(routes))
+        self.assertEqual([str(i) for i in range(width) if i != 1],
+                list(routes))  # in insertion order
+        self.assertEqual(width, len(routes0))
+        self.assertEqual({'a': 1}, routes['0'].nexthop)
+        self.assertEqual(0, routes0['0'].nexthop)
+        self.assertIs(routes['2'], routes0['2'])  # shared
+
+        # The shared children are under the newest parent
+        self.assertIs(routes, routes['2']._parent)
+        self.assertIs(tega.idb.get('r.routes', version=1),
+                routes0['1']._parent)  # deleted in ver 2
+
+    def test_old_roots_gc(self):
+        tega.idb.old_roots_len = 1
+        for i in range(300):
+            with tega.idb.tx() as t:
+                t.put(path='r.wide.{}'.format(i), instance={'x': i})
+        gc.collect()
+        copies = [obj for obj in gc.get_objects()
+                if type(obj) is tega.tree.Cont and obj._oid == 'wide']
+        self.assertEqual(2, len(copies))  # the current and the old version
+
+    def test_old_roots_eviction(self):
+        tega.idb.old_roots_len = None
+        tracemalloc.start()
+        try:
+            with tega.idb.tx() as t:
+                t.put(path='r.wide', instance={str(i): {'x': i}
+                    for i in range(tega.tree.WIDE_NODE + 1)})
+            for i in range(30):
+                with tega.idb.tx() as t:
+                    t.put(path='r.wide.{}'.format(i), instance={'x': -i})
+            old = tega.idb._old_roots['r']
+            expected = sum(old.size(version) for version in range(29))
+            gc.collect()
+            before = tracemalloc.get_traced_memory()[0]
+            old.maxlen = 1
+            old.expire()
+            gc.collect()
+            freed = before - tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual([29], [version for version, root in old])
+        self.assertAlmostEqual(1, freed / expected, delta=0.2)
+
     def test_transaction2notifications(self):
         transactions = [['!', [dict(a=1), dict(b=2)]], ['+', [dict(c=3)]]]
         notifications = tega.idb._transactions2notifications(transactions)
@@ -171,7 +449,7 @@ class TestSequence(unittest.TestCase):
         with tega.idb.tx(subscriber = self.subscriber) as t:
             t.delete(path='r.a.c')
             t.put(r.a.d)
-        tega.idb.save_snapshot(tega_id)
+        tega.idb.save_snapshot(tega_id).result()
 
         # ver 2
         with tega.idb.tx(subscriber = self.subscriber) as t:
@@ -181,7 +459,7 @@ class TestSequence(unittest.TestCase):
         # ver 3
         with tega.idb.tx(subscriber = self.subscriber) as t:
             t.put(r.a.g)
-        tega.idb.save_snapshot(tega_id)
+        tega.idb.save_snapshot(tega_id).result()
 
         # ver 4
         with tega.idb.tx(subscriber = self.subscriber) as t:
@@ -231,6 +509,256 @@ class TestSequence(unittest.TestCase):
         self.assertEqual(data2, tega.idb.loglist_for_sync('r', 5))
         self.assertEqual(data3, tega.idb.loglist_for_sync('r', 6))
 
+        # The version index points to the first missing transaction
+        self.assertEqual(2, tega.idb._index_lookup('r', 4)[0])
+        self.assertEqual(data1, tega.idb._loglist_reverse('r', 3, 6))
+        self.assertEqual(data0, tega.idb._loglist_reverse('r', 0, 6))
+
+        # The index of the current segment is rebuilt on start
+        tega.idb.stop()
+        os.remove(os.path.join(script_dir, 'idx.{}.2'.format(tega_id)))
+        tega.idb.start(script_dir, tega_id)
+        self.assertEqual(data1, tega.idb.loglist_for_sync('r', 3))
+
+    def test_sync_buffer(self):
+        class Follower(object):
+            def __init__(self):
+                self.multi = []
+            def on_notify(self, notifications):
+                self.multi.append(notifications)
+
+        self.set_up_idb()
+        tega.idb.rollback(tega_id=tega_id, root_oid='inventory', backto=-1)
+        stats = tega.idb.stats()['sync']
+        self.assertEqual(5, stats['transactions'])
+        for version in (-1, 0, 2, 4):
+            follower = Follower()
+            self.run_sync(tega.idb.sync, 'inventory', version, follower)
+            self.assertEqual(tega.idb.loglist_for_sync('inventory', version),
+                    follower.multi)
+        self.assertEqual(3, tega.idb.stats()['sync']['hits'])  # 4: in sync
+
+        # Evicted: read from the commit log
+        tega.idb._sync_buffer.max_bytes = stats['bytes'] // 2
+        with tega.idb.tx(subscriber=self.subscriber) as t:
+            t.put(path='inventory.ne3', instance=dict(name='Paris'))
+        follower = Follower()
+        self.run_sync(tega.idb.sync, 'inventory', 0, follower)
+        self.assertEqual(tega.idb.loglist_for_sync('inventory', 0),
+                follower.multi)
+        self.assertEqual(1, tega.idb.stats()['sync']['misses'])
+
+    def test_notify_when_durable(self):
+        class Subscriber(object):
+            def __init__(self):
+                self.multi = []
+            def on_notify(self, notifications):
+                self.multi.append(notifications)
+
+        subscriber = Subscriber()
+        future = tega.idb.Future()
+        future.set_exception(IOError('disk full'))
+        with self.assertLogs(level='ERROR') as cm:
+            tega.idb._notify_when_durable(future, {subscriber: ['n']})
+        self.assertIn('disk full', cm.output[0])
+        self.assertEqual([], subscriber.multi)
+        tega.idb._notify_when_durable(None, {subscriber: ['n']})
+        self.assertEqual([['n']], subscriber.multi)
+
+    def test_reload_log(self):
+        self.set_up_idb()
+        with tega.idb.tx(subscriber=self.subscriber) as t:
+            t.put(path='r.a', instance=dict(b=1, c=[1, 2]))
+        tega.idb.save_snapshot(tega_id).result()
+        with tega.idb.tx(subscriber=self.subscriber) as t:
+            t.delete('r.a.b')
+        expected = {k: tega.idb.get(k).serialize_() for k in tega.idb.roots()}
+        versions = tega.idb.roots()
+
+        tega.idb._idb.clear()
+        tega.idb._old_roots.clear()
+        tega.idb.reload_log()
+        self.assertEqual(expected,
+                {k: tega.idb.get(k).serialize_() for k in tega.idb.roots()})
+        self.assertEqual(versions, tega.idb.roots())
+
+    def test_bulk_recovery(self):
+        min_bytes = tega.idb.PARALLEL_REPLAY_MIN_BYTES
+        self.set_up_idb()
+        tega.idb.save_snapshot(tega_id).result()
+        for i in range(15):
+            with tega.idb.tx(subscriber=self.subscriber) as t:
+                t.put(path='r.a{}'.format(i % 4), instance=dict(b=i, c=[i]))
+                if i % 3 == 0:
+                    t.put(path='inventory.ne{}'.format(i), instance=dict(name=str(i)))
+            if i % 5 == 4:
+                with tega.idb.tx(subscriber=self.subscriber) as t:
+                    t.delete('r.a{}.b'.format(i % 4))
+        with tega.idb.tx(subscriber=self.subscriber) as t:
+            t.put(path='s.x', instance=dict(y=1))
+        with tega.idb.tx(subscriber=self.subscriber) as t:
+            t.delete('s')
+        tega.idb.rollback(tega_id=tega_id, root_oid='inventory', backto=-2)
+        with tega.idb.tx(subscriber=self.subscriber) as t:
+            t.put(path='inventory.ne9', instance=dict(name='NE9'))
+
+        def state():
+            return ({k: tega.idb.get(k).serialize_(internal=True)
+                        for k in tega.idb.roots()},
+                    {k: [(v, root.serialize_(internal=True)) for v, root in q]
+                        for k, q in tega.idb._old_roots.items()})
+
+        live = state()
+        states = []
+        for bulk, processes in ((False, 1), (True, 1), (True, 3)):
+            tega.idb._idb.clear()
+            tega.idb._old_roots.clear()
+            tega.idb.PARALLEL_REPLAY_MIN_BYTES = 0
+            tega.idb.reload_log(bulk=bulk, processes=processes)
+            states.append(state())
+        tega.idb.PARALLEL_REPLAY_MIN_BYTES = min_bytes
+        self.assertEqual(live[0], states[0][0])
+        self.assertEqual(states[0], states[1])
+        self.assertEqual(states[0], states[2])
+        self.assertEqual(tega.idb.OLD_ROOTS_LEN, len(tega.idb._old_roots['r']))
+        self.assertTrue(tega.idb.get('r')._frozen)
+
+    def test_save_snapshot(self):
+        self.set_up_idb()
+        future = tega.idb.save_snapshot(tega_id)
+        with tega.idb.tx(subscriber=self.subscriber) as t:
+            t.put(path='r.a', instance=dict(b=1))
+        ss_file = future.result()
+        progress = tega.idb.snapshot_progress()
+        self.assertEqual('done', progress['state'])
+        self.assertEqual(1, progress['roots'])
+        self.assertEqual(1, progress['saved'])
+        self.assertEqual(os.path.join(script_dir,
+            'ss.{}.{}'.format(tega_id, progress['segment'])), ss_file)
+
+        with tega.idb.tx(subscriber=self.subscriber) as t:
+            t.delete('inventory.ne1.name')
+        expected = {k: tega.idb.get(k).serialize_() for k in tega.idb.roots()}
+
+        tega.idb._idb.clear()
+        tega.idb.reload_log()
+        self.assertEqual(expected,
+                {k: tega.idb.get(k).serialize_() for k in tega.idb.roots()})
+
+        # An incomplete snapshot is never loaded
+        os.rename(ss_file, ss_file + '.tmp')
+        tega.idb._idb.clear()
+        tega.idb._old_roots.clear()
+        tega.idb.reload_log()
+        self.assertEqual(expected,
+                {k: tega.idb.get(k).serialize_() for k in tega.idb.roots()})
+        os.remove(ss_file + '.tmp')
+
+    def test_compressed_snapshot(self):
+        tega.idb.stop()
+        tega.idb.start(script_dir, tega_id, compression=True)
+        self.set_up_idb()
+        tega.idb.save_snapshot(tega_id).result()
+        with tega.idb.tx(subscriber=self.subscriber) as t:
+            t.put(path='r.a', instance=dict(b=1))
+        self.assertEqual(4, len(tega.idb.loglist_for_sync('inventory', -1)))
+        expected = {k: tega.idb.get(k).serialize_() for k in tega.idb.roots()}
+
+        tega.idb._idb.clear()
+        tega.idb._old_roots.clear()
+        tega.idb.reload_log()
+        self.assertEqual(expected,
+                {k: tega.idb.get(k).serialize_() for k in tega.idb.roots()})
+        stats = tega.idb.stats()['compression']
+        self.assertTrue(stats['records'] > 0)
+
+    def test_compaction(self):
+        self.set_up_idb()
+        policy = CompactionPolicy(tega_id, max_records=4)
+        self.assertEqual('records', policy.due())
+        policy.check().result()
+        policy.prune()
+        self.assertIsNone(policy.due())  # the new segment is empty
+        files = os.listdir(script_dir)
+        self.assertFalse('log.{}.0'.format(tega_id) in files)
+        self.assertTrue('ss.{}.1'.format(tega_id) in files)
+
+        # A follower behind the pruned segments gets the whole root
+        multi = tega.idb.loglist_for_sync('inventory', 0)
+        self.assertEqual(1, len(multi))
+        self.assertEqual('PUT', multi[0][0]['ope'])
+        self.assertEqual(tega.idb.get('inventory').serialize_(),
+                multi[0][0]['instance'])
+
+        expected = tega.idb.get('inventory').serialize_()
+        tega.idb._idb.clear()
+        tega.idb._old_roots.clear()
+        tega.idb.reload_log()
+        self.assertEqual(expected, tega.idb.get('inventory').serialize_())
+        estimate = tega.idb.replay_estimate()
+        self.assertEqual(2, estimate['files'])  # ss.1 and log.1
+        self.assertTrue(estimate['rate'] > 0)
+
+        # Archives the redundant segments
+        with tempfile.TemporaryDirectory() as archive_dir:
+            with tega.idb.tx(subscriber=self.subscriber) as t:
+                t.put(path='r.a', instance=dict(b=1))
+            tega.idb.save_snapshot(tega_id).result()
+            pruned = tega.idb.prune_segments(archive_dir=archive_dir)
+            self.assertEqual(['log.{}.1'.format(tega_id),
+                'idx.{}.1'.format(tega_id), 'ss.{}.1'.format(tega_id)], pruned)
+            self.assertEqual(set(pruned), set(os.listdir(archive_dir)))
+
+    def test_durability(self):
+        MEMORY = tega.idb.DURABILITY.MEMORY
+        WRITTEN = tega.idb.DURABILITY.WRITTEN
+        tega.idb.reset_commit_stats()
+        with tega.idb.tx(subscriber=self.subscriber) as t:
+            t.put(path='r.b', instance=dict(x=1))
+        with tega.idb.tx(subscriber=self.subscriber, durability=WRITTEN) as t:
+            t.put(path='r.c', instance=dict(x=2))
+        with tega.idb.tx(subscriber=self.subscriber, durability=MEMORY) as t:
+            t.put(path='r.d', instance=dict(x=3))
+        self.assertIsNone(t.future)
+        self.assertEqual({'b': {'x': 1}, 'c': {'x': 2}, 'd': {'x': 3}},
+                tega.idb.get('r').serialize_())
+
+        stats = tega.idb.commit_stats()
+        for level in ('fsync', 'written', 'memory'):
+            self.assertEqual(1, stats[level]['commits'])
+
+        tega.idb._idb.clear()
+        tega.idb._old_roots.clear()
+        tega.idb.reload_log()
+        self.assertEqual({'b': {'x': 1}, 'c': {'x': 2}},
+                tega.idb.get('r').serialize_())
+
+    def test_durability_versions(self):
+        MEMORY = tega.idb.DURABILITY.MEMORY
+        with tega.idb.tx() as t:
+            t.put(path='r.b', instance=dict(x=1))
+        with tega.idb.tx(durability=MEMORY) as t:
+            t.put(path='r.c', instance=dict(x=2))
+        with tega.idb.tx() as t:
+            t.put(path='r.d', instance=dict(x=3))
+        with tega.idb.tx(durability=MEMORY) as t:
+            t.put(path='r.e', instance=dict(x=4))
+        self.assertEqual(3, tega.idb.get('r')._version)
+
+        for bulk, processes in ((False, 1), (True, 1), (True, 3)):
+            tega.idb._idb.clear()
+            tega.idb._old_roots.clear()
+            tega.idb.reload_log(bulk=bulk, processes=processes)
+            self.assertEqual(3, tega.idb.get('r')._version)
+            self.assertEqual({'b': {'x': 1}, 'd': {'x': 3}}, tega.idb.get('r').serialize_())
+
+        with tega.idb.tx() as t:
+            t.put(path='r.f', instance=dict(x=5))
+        self.assertEqual(4, tega.idb.get('r')._version)
+        logs = tega.idb.loglist_for_sync('r', 3)
+        self.assertEqual([['r.f']], [[log['path'] for log in logs_]
+            for logs_ in logs])
+
     def test_idb_edges(self):
 
         def _edges_set(edges):
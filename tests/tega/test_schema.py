@@ -0,0 +1,84 @@
+import os
+import tempfile
+import unittest
+
+import tega.idb
+import tega.schema
+import tega.tree
+import tega.util
+
+sample = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '../../doc/memo/schema_sample.json')
+
+class TestSequence(unittest.TestCase):
+
+    def setUp(self):
+        tega.schema.load_file(sample)
+
+    def tearDown(self):
+        tega.schema.clear()
+
+    def test_compile_(self):
+        validators = tega.schema.compile_({'r': {'a': {'type': 'int'},
+            'b': {'_indexes': ['c'], 'c': {'type': 'list'}}}})
+        self.assertEqual({('r',), ('r', 'a'), ('r', 'b'), ('r', 'b', 'c')},
+                set(validators))
+        self.assertIs(validators[('r', 'b')], validators[('r',)].children['b'])
+        self.assertIn(tega.tree.Cont._types[tuple],
+                validators[('r', 'b', 'c')].types)
+        with self.assertRaises(ValueError):
+            tega.schema.compile_({'r': {'a': {'type': 'dict'}}})
+
+    def test_validate(self):
+        c = tega.util.subtree('root.c', {'e': {'id': 1, 'af': 'ipv4',
+            'dict': {'a': 1, 'b': 'x'}}})
+        tega.schema.validate(c)
+        tega.schema.validate(c.root_())
+        tega.schema.validate(c.e.id)
+        r = tega.tree.Cont('root')
+        r.beatles.members = ['John', 'Paul']
+        r.a = 'a'
+        tega.schema.validate(r)
+
+        for path, value in (('root.a', 1), ('root.c', {'e': {'id': '1'}}),
+                ('root.c', {'e': {'x': 1}}), ('root.c.e', {'id': {'x': 1}}),
+                ('root.a', {'b': 'b'}), ('root.x', 1)):
+            with self.assertRaises(tega.schema.SchemaError):
+                tega.schema.validate(tega.util.subtree(path, value))
+
+        tega.schema.validate(tega.util.subtree('other.x', 1))  # schema-less
+
+    def test_put(self):
+        t = tega.idb.tx()
+        t.put(tega.util.subtree('root.a', 'a'))
+        with self.assertRaises(tega.schema.SchemaError):
+            t.put({'a': 1}, path='root')
+        self.assertEqual(1, len(t.crud_queue))
+        tega.schema.clear()
+        t.put({'a': 1}, path='root')
+        self.assertEqual(2, len(t.crud_queue))
+
+    def test_update_vector(self):
+        data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(data_dir.cleanup)
+        tega.idb.start(data_dir.name, 'test_schema')
+        self.addCleanup(tega.idb.stop)
+        tega.schema.load({'root': {'a': {'type': 'vector'},
+            'b': {'type': 'int'}}})
+        with tega.idb.tx() as t:
+            t.put({'_typecode': 'q', '_value': [1, 2]}, path='root.a')
+            t.update_vector('root.a', [3], start=1)
+        self.assertEqual([1, 3], list(tega.idb.get('root.a')))
+
+        tega.schema.clear()
+        with tega.idb.tx() as t:  # put before the schema is loaded
+            t.put({'_typecode': 'q', '_value': [1, 2]}, path='root.b')
+        tega.schema.load({'root': {'a': {'type': 'vector'},
+            'b': {'type': 'int'}}})
+        with self.assertRaises(tega.schema.SchemaError):
+            with tega.idb.tx() as t:
+                t.update_vector('root.b', [3])
+        self.assertEqual([1, 2], list(tega.idb.get('root.b')))
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -1,3 +1,5 @@
+import gc
+import json
 import unittest
 
 import tega.tree
@@ -53,6 +55,27 @@ class TestSequence(unittest.TestCase):
         self.assertEqual(['r2', 'a'], r1.a.qname_())
         self.assertEqual(['r2', 'a'], r2.a.qname_())
 
+    def test_qname_cache(self):
+        r1 = tega.tree.Cont('r1')
+        r2 = tega.tree.Cont('r2')
+        r1.a.b.c = 1
+        self.assertEqual('r1.a.b', r1.a.b.path_())
+        self.assertEqual('r1.a.b.c', r1.a.b.c.path_())
+        self.assertIs(r1.a.b.path_(), r1.a.b.path_())
+        self.assertEqual(('r1', 'a', 'b'), r1.a.b._qname_cache)
+        a = r1.a
+        a.change_(r2)  # moves the subtree
+        self.assertEqual(['r2', 'a', 'b'], a.b.qname_())
+        self.assertEqual('r2.a.b.c', a.b.c.path_())
+        r2.x = a.b  # moves the subtree under another oid
+        self.assertEqual(['r2', 'b'], r2.x.qname_())
+        self.assertEqual('r2.b.c', r2.x.c.path_())
+        r3 = r2.copy_()
+        r3.x._parent = r3  # same place
+        self.assertEqual('r2.b', r3.x.path_())
+        r3._oid = 'r3'
+        self.assertEqual('r3.b', r3.x.path_())
+
     def test_wrapped_value(self):
         r = tega.tree.Cont('r')
         self.assertEqual(r._get_wrapped_type(int),
@@ -67,18 +90,18 @@ class TestSequence(unittest.TestCase):
 
         # int
         r._set_builtin_attr('a', 1)
-        self.assertEqual(0, r.a.__dict__['_version'])
-        self.assertEqual(r, r.a.__dict__['_parent'])
-        self.assertEqual('a', r.a.__dict__['_oid'])
-        self.assertFalse(r.a.__dict__['_ephemeral'])
+        self.assertEqual(0, r.a._version)
+        self.assertEqual(r, r.a._parent)
+        self.assertEqual('a', r.a._oid)
+        self.assertFalse(r.a._ephemeral)
         self.assertEqual(1, r.a)
 
         # str
         r._set_builtin_attr('a', '1')
-        self.assertEqual(0, r.a.__dict__['_version'])
-        self.assertEqual(r, r.a.__dict__['_parent'])
-        self.assertEqual('a', r.a.__dict__['_oid'])
-        self.assertFalse(r.a.__dict__['_ephemeral'])
+        self.assertEqual(0, r.a._version)
+        self.assertEqual(r, r.a._parent)
+        self.assertEqual('a', r.a._oid)
+        self.assertFalse(r.a._ephemeral)
         self.assertEqual('1', r.a)
 
         # tuple
@@ -94,20 +117,42 @@ class TestSequence(unittest.TestCase):
 
         int_1 = r._wrapped_value(1)
         r._set_wrapped_attr('a', int_1)
-        self.assertEqual(0, r.a.__dict__['_version'])
-        self.assertEqual(r, r.a.__dict__['_parent'])
-        self.assertEqual('a', r.a.__dict__['_oid'])
-        self.assertFalse(r.a.__dict__['_ephemeral'])
+        self.assertEqual(0, r.a._version)
+        self.assertEqual(r, r.a._parent)
+        self.assertEqual('a', r.a._oid)
+        self.assertFalse(r.a._ephemeral)
         self.assertEqual(1, r.a)
 
         str_1 = r._wrapped_value('1')
         r._set_wrapped_attr('a', str_1)
-        self.assertEqual(0, r.a.__dict__['_version'])
-        self.assertEqual(r, r.a.__dict__['_parent'])
-        self.assertEqual('a', r.a.__dict__['_oid'])
-        self.assertFalse(r.a.__dict__['_ephemeral'])
+        self.assertEqual(0, r.a._version)
+        self.assertEqual(r, r.a._parent)
+        self.assertEqual('a', r.a._oid)
+        self.assertFalse(r.a._ephemeral)
         self.assertEqual('1', r.a)
 
+    def test_node_layout(self):
+        r = tega.tree.Cont('r')
+        r.a.b = 1
+        r.a.c = 0.1
+        r.a.d = True
+        self.assertRaises(AttributeError, object.__getattribute__, r, '__dict__')
+        self.assertFalse(hasattr(r.a.c, '__dict__'))
+        self.assertEqual(3, len(r.a))
+        self.assertEqual(['b', 'c', 'd'], list(r.a))
+        self.assertEqual(0, r.a['_version'])
+        self.assertTrue('_version' in r.a)
+        self.assertEqual(0, len(r.a.d))
+
+        r.a._version = 2  # metadata, not a child
+        self.assertEqual(2, r.a._version)
+        self.assertEqual(3, len(r.a))
+
+        r2 = r.copy_()
+        self.assertIs(r.a, r2.a)
+        r2.x = 1
+        self.assertFalse('x' in r)
+
     def test_is_empty_(self):
         r = tega.tree.Cont('r')
 
@@ -229,6 +274,66 @@ class TestSequence(unittest.TestCase):
         with self.assertRaises(AttributeError):
             r._immutability_check()
 
+    def test_lazy_freeze(self):
+        r = tega.tree.Cont('r')
+        r.a.b.c = 1
+        b = r.a.b
+        self.assertFalse(b.is_frozen_())
+        r.freeze_()
+        self.assertFalse(b._frozen)  # marked at the root only
+        self.assertTrue(b.is_frozen_())
+        with self.assertRaises(AttributeError):
+            b.d = 2
+        b_ = b.deepcopy_()  # not frozen, incl. the parents
+        b_.d = 2
+        self.assertEqual(['r', 'a', 'b'], b_.qname_())
+        self.assertFalse(b_._parent.is_frozen_())
+        x = tega.tree.Cont('x')
+        x.y.z = 1
+        y = x.y
+        self.assertFalse(y.is_frozen_())
+        x.change_(b_)  # under a node not frozen
+        self.assertFalse(y.is_frozen_())
+        b_.freeze_()
+        self.assertTrue(y.is_frozen_())
+
+    def test_vector(self):
+        import array
+        r = tega.tree.Cont('r')
+        r.a = array.array('q', [1, 2, 3])
+        v = r.a
+        self.assertIsInstance(v, tega.tree.Vector)
+        self.assertEqual(['r', 'a'], v.qname_())
+        self.assertEqual(3, len(v))
+        self.assertEqual(2, v[1])
+        self.assertEqual(array.array('q', [2, 3]), v[1:])
+        self.assertEqual([1, 2, 3], v)
+        self.assertEqual([1, 2, 3], v.buffer_().tolist())
+        with self.assertRaises(TypeError):
+            v.buffer_()[0] = 0  # read-only
+        v_ = v.updated_([0, 4, 5], start=2)
+        self.assertEqual([1, 2, 0, 4, 5], v_)
+        self.assertEqual([1, 2, 3], v)  # immutable
+        self.assertEqual({'a': [1, 2, 3]}, r.serialize_())
+        self.assertEqual('{"a": [1, 2, 3]}', r.dumps_())
+        self.assertEqual([1, 2, 3], r.serialize_(internal=True)['a']['_value'])
+        self.assertEqual('q', r.serialize_(internal=True)['a']['_typecode'])
+        encoded = r.serialize_(encode_vectors=True)['a']
+        self.assertEqual({'_typecode': 'q', '_value': 'AQAAAAAAAAACAAAAAAAAAA'
+            'MAAAAAAAAA'}, encoded)
+        d = tega.tree.decode_vector('a', r, encoded['_value'], 'q')
+        self.assertEqual(v, d)
+        self.assertEqual('q', d.typecode)
+        self.assertEqual([0.5], tega.tree.Vector('b', r, [0.5]))  # 'd'
+        with self.assertRaises(ValueError):
+            tega.tree.Vector('b', r, ['x'], 'u')
+        c = v.deepcopy_()
+        self.assertEqual(v, c)
+        self.assertIsNot(v._value, c._value)
+        r.freeze_()
+        with self.assertRaises(AttributeError):
+            r.a = array.array('q')
+
     def test_root(self):
         r = tega.tree.Cont('r')
         r.a.b = 1
@@ -366,6 +471,113 @@ class TestSequence(unittest.TestCase):
         r.a.b = func
         self.assertEqual('"%id1.dict(a=2)"', r.a.b.dumps_())
 
+    def test_json_cache(self):
+        tega.tree.json_cache_clear()
+        r = tega.tree.Cont('r')
+        r.a.b = 1
+        r.a.c = [1, 'x']
+        r.a.d = True
+        r.a[0] = 1.5
+        r.e = {}
+        for internal in (False, True):
+            self.assertEqual(json.dumps(r.serialize_(internal=internal)),
+                    r.dumps_(internal=internal))
+        self.assertEqual(0, tega.tree.json_cache_stats()['entries'])
+
+        r.freeze_()
+        json_ = r.dumps_()
+        self.assertIs(json_, r.dumps_())
+        self.assertIs(json_, r.dumps_())
+        stats = tega.tree.json_cache_stats()
+        self.assertEqual(3, stats['entries'])  # r, r.a and r.e
+        self.assertEqual(2, stats['hits'])
+
+        r_ = r.copy_()
+        tega.tree.set_meta(r_, '_version', 1)
+        r_._children['f'] = tega.tree.Cont('f', r_)
+        self.assertEqual(json.dumps(r_.serialize_()), r_.dumps_())
+        self.assertIsNot(json_, r_.dumps_())
+        self.assertEqual(json.dumps(r.serialize_()), r.dumps_())
+
+        tega.tree.set_json_cache_limit(len(json_))
+        self.assertEqual(json.dumps(r.serialize_()), r.dumps_())
+        self.assertLessEqual(tega.tree.json_cache_stats()['bytes'], len(json_))
+        tega.tree.set_json_cache_limit(tega.tree.JSON_CACHE_BYTES)
+
+        # The cache does not keep the nodes alive
+        tega.tree.json_cache_clear()
+        r.dumps_()
+        del r, r_
+        gc.collect()
+        stats = tega.tree.json_cache_stats()
+        self.assertEqual((0, 0), (stats['entries'], stats['bytes']))
+
+    def test_iterdumps_(self):
+        r = tega.tree.Cont('r')
+        r.a.b = 1
+        r.a.c = [1, 'x']
+        r.a.d.e = 0
+        r.a.d.f = False
+        r.a[0] = 1.5
+        r.g = {}
+        r.h.i.j = 'y'
+        r.h.i.ephemeral_()
+        r.h.k.l.m.n = 2
+        r.h.k.l.ephemeral_()
+        r.h.o = True
+        r.p = tega.tree.Func('id1', dict)
+        for freeze in (False, True):
+            if freeze:
+                r.freeze_()
+                r.dumps_()  # cached
+            for internal in (False, True):
+                for serialize_ephemeral in (True, False):
+                    json_ = json.dumps(r.serialize_(internal=internal,
+                        serialize_ephemeral=serialize_ephemeral))
+                    for chunk_size in (1, 20, 1000):
+                        chunks = list(r.iterdumps_(internal=internal,
+                            serialize_ephemeral=serialize_ephemeral,
+                            chunk_size=chunk_size))
+                        self.assertEqual(json_, ''.join(chunks))
+        self.assertGreater(len(list(r.iterdumps_(serialize_ephemeral=False,
+            chunk_size=1))), 1)
+        self.assertEqual(['1'], list(r.a.b.iterdumps_()))
+
+    def test_deep_tree(self):
+        depth = 5000  # deeper than the recursion limit
+        r = tega.tree.Cont('r')
+        c = r
+        for i in range(depth):
+            c = c[str(i)]
+        c.x = 1
+        self.assertEqual(depth + 2, len(c.x.qname_()))
+        self.assertEqual('r.0.1.2', r['0']['1']['2'].path_())
+
+        out = r.serialize_()
+        for i in range(depth):
+            out = out[str(i)]
+        self.assertEqual({'x': 1}, out)
+        c.x.ephemeral_()
+        self.assertEqual({}, r.serialize_(serialize_ephemeral=False))
+        tega.tree.set_meta(c.x, '_ephemeral', False)
+
+        r_ = r.deepcopy_()
+        c_ = r_
+        for i in range(depth):
+            c_ = c_[str(i)]
+        self.assertIsNot(c, c_)
+        self.assertEqual(1, c_.x)
+        self.assertIs(r_, c_.root_())
+
+        r.freeze_()
+        self.assertTrue(c.is_frozen_())
+        json_ = r.dumps_()
+        self.assertTrue(json_.endswith('{"x": 1}' + '}' * depth))
+        self.assertEqual(json_, ''.join(r.iterdumps_(chunk_size=1000)))
+
+        c_.x.delete_()
+        self.assertTrue(r_.is_empty_())
+
     def test_deepcopy_(self):
         r = tega.tree.Cont('r')
         r.a = dict(x=1, y=2)
@@ -77,6 +77,76 @@ class TestSequence(unittest.TestCase):
         self.assertEqual(['a', 'b'], a.b.qname_())
         self.assertEqual(['a'], a.qname_())
 
+    def test_subtree_bulk(self):
+
+        import tega.tree
+
+        dict_ = {'c': {'d': 1, 'e': [1, 2], 'f': True, 'g': 0.5, 'h': {},
+            'i': {'_value': 'x', '_version': 3}, '_version': 2, '_oid': 'c'}}
+        b = tega.util.subtree('a.b', dict_, freeze=True)
+        self.assertEqual({'c': {'d': 1, 'e': (1, 2), 'f': True, 'g': 0.5,
+            'h': {}, 'i': 'x'}}, b.serialize_())
+        self.assertEqual(2, b.c._version)
+        self.assertEqual(3, b.c.i._version)
+        self.assertEqual(['a', 'b', 'c', 'd'], b.c.d.qname_())
+        self.assertIs(b.c, b.c.f._parent)
+        self.assertTrue(b.is_frozen_() and b.c.h.is_frozen_() and
+                b._parent.is_frozen_())
+        self.assertTrue(b.c.f.is_frozen_())
+        with self.assertRaises(AttributeError):
+            b.c.x = 1
+        self.assertFalse(tega.util.subtree('a.b', dict_).is_frozen_())
+
+        c = tega.util.subtree('a.b.c', 1)
+        self.assertEqual(1, c)
+        self.assertEqual(['a', 'b', 'c'], c.qname_())
+        c = tega.util.subtree('a.b.c', {'_value': 0, '_version': 1})
+        self.assertEqual(0, c)
+        self.assertEqual(1, c._version)
+        with self.assertRaises(ValueError):
+            tega.util.subtree('a.b', {'c': None})
+
+    def test_vector(self):
+        import tega.tree
+        v = tega.util.subtree('r.a.v', {'_typecode': 'd',
+            '_value': 'AAAAAAAA4D8=', '_version': 2})
+        self.assertIsInstance(v, tega.tree.Vector)
+        self.assertEqual([0.5], v)
+        self.assertEqual(2, v._version)
+        r = tega.util.dict2cont({'r': {'v': {'_typecode': 'B',
+            '_value': [1, 255]}}})
+        self.assertEqual([1, 255], r.v)
+        d = tega.util.deserialize(r.serialize_(internal=True))
+        self.assertEqual('B', d.v.typecode)
+        self.assertIs(d, d.v._parent)
+        r_, = tega.util.unpack_trees(tega.util.pack_trees([r]))
+        self.assertEqual([1, 255], r_.v)
+        self.assertIs(r_, r_.v._parent)
+
+    def test_deep_tree(self):
+
+        import tega.tree
+
+        depth = 5000  # deeper than the recursion limit
+        r = tega.tree.Cont('r')
+        c = r
+        for i in range(depth):
+            c = c[str(i)]
+        c.x = 1
+        self.assertEqual(2 * (depth + 1), len(list(tega.util.edges(r))))
+        tega.util.align_vector(r)
+        self.assertIs(c, c.x._parent)
+
+        r_, = tega.util.unpack_trees(tega.util.pack_trees([r]))
+        c_ = r_
+        for i in range(depth):
+            c_ = c_[str(i)]
+        self.assertEqual(1, c_.x)
+        self.assertIs(c_, c_.x._parent)
+
+        d = tega.util.deserialize(r.serialize_(internal=True))
+        self.assertEqual(r.dumps_(internal=True), d.dumps_(internal=True))
+
     '''
     def test_plugins(self):
 
@@ -121,6 +191,29 @@ class TestSequence(unittest.TestCase):
         data1 = ['{}-{}'.format(*edge) for edge in tega.util.edges(r)]
         self.assertEqual(set(data0), set(data1))
 
+    def test_pack_trees(self):
+        import pickle
+        r = tega.tree.Cont('r')
+        r.a.x = 1
+        r.a.y = 'y'
+        r.a.z = [1, 2]
+        r.b.flag = True
+        r.freeze_()
+        r2 = r.copy_(freeze=True)  # shares r.a and r.b
+        tega.tree.set_meta(r2, '_version', 1)
+        tega.tree.set_meta(r.a, '_parent', r2)
+
+        packed = pickle.loads(pickle.dumps(tega.util.pack_trees([r2, r])))
+        r2_, r_ = tega.util.unpack_trees(packed)
+        self.assertEqual(r.serialize_(internal=True),
+                r_.serialize_(internal=True))
+        self.assertEqual(1, r2_._version)
+        self.assertIs(r_.a, r2_.a)
+        self.assertIs(r2_, r_.a._parent)
+        self.assertIs(r_.b, r_.b.flag._parent)
+        self.assertTrue(r_.is_frozen_() and r_.a.is_frozen_())
+        self.assertEqual(['r', 'a', 'z'], r_.a.z.qname_())
+
     def test_nested_regex_path(self):
         self.assertEqual('aaa[a-z]*(\.bbb(\.c)?)?',
                 tega.util.nested_regex_path('aaa[a-z]*\.bbb\.c'))